@@ -8,6 +8,9 @@ import json
 import os
 import psutil
 import sys
+from watermark_client import DaemonError, WatermarkClient
+
+PARENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parent_script.py')
 
 class WatermarkGUI:
     def __init__(self, master):
@@ -84,14 +87,20 @@ class WatermarkGUI:
         self.profile_check = ttk.Checkbutton(self.settings_frame, text="Enable Profiling", variable=self.profile_var)
         self.profile_check.grid(row=2, column=1, sticky=tk.W, padx=5, pady=10)
 
+        # Daemon address (optional)
+        self.daemon_label = ttk.Label(self.settings_frame, text="Daemon (optional):")
+        self.daemon_label.grid(row=3, column=0, sticky=tk.W, padx=5, pady=10)
+        self.daemon_entry = ttk.Entry(self.settings_frame, width=30)
+        self.daemon_entry.grid(row=3, column=1, sticky=tk.W, padx=5, pady=10)
+
         # -------------------------------
         # Add Start Button
         # -------------------------------
         self.start_button = ttk.Button(self.settings_frame, text="Start Watermarking", command=self.start_watermarking)
-        self.start_button.grid(row=3, column=0, columnspan=3, pady=20)
+        self.start_button.grid(row=4, column=0, columnspan=3, pady=20)
 
         # Adjust row and column settings if necessary
-        self.settings_frame.rowconfigure(3, weight=1)
+        self.settings_frame.rowconfigure(4, weight=1)
         self.settings_frame.columnconfigure(0, weight=1)
         self.settings_frame.columnconfigure(1, weight=1)
         self.settings_frame.columnconfigure(2, weight=1)
@@ -180,6 +189,7 @@ class WatermarkGUI:
         opacity = self.opacity_scale.get()
         workers = self.workers_spinbox.get()
         profile = self.profile_var.get()
+        daemon = self.daemon_entry.get().strip()
 
         if not all([input_pdf, output_pdf, watermark_image]):
             messagebox.showerror("Error", "Please select all required files.")
@@ -194,45 +204,72 @@ class WatermarkGUI:
         self.progress_bar['maximum'] = 100  # Will be updated based on total pages
 
         # Run the watermarking in a separate thread to keep the GUI responsive
-        threading.Thread(target=self.run_watermarking, args=(input_pdf, output_pdf, watermark_image, opacity, workers, profile), daemon=True).start()
+        if daemon and not profile:
+            threading.Thread(target=self.run_daemon_job, args=(daemon, input_pdf, output_pdf, watermark_image, opacity), daemon=True).start()
+        else:
+            threading.Thread(target=self.run_watermarking, args=(input_pdf, output_pdf, watermark_image, opacity, workers, profile), daemon=True).start()
+
+    def run_daemon_job(self, address, input_pdf, output_pdf, watermark_image, opacity):
+        """
+        Sends the job to a running watermark daemon instead of starting
+        parent_script.py, falling back to it if no daemon answers.
+        """
+        try:
+            client = WatermarkClient(address)
+            if not client.is_available():
+                self.log_message(f"No watermark daemon at {address}; starting the script instead.\n", level="ERROR")
+                self.run_watermarking(input_pdf, output_pdf, watermark_image, opacity, self.workers_spinbox.get(), False)
+                return
+            record = client.submit(input_pdf, output_pdf, watermark_image, opacity=opacity, overwrite=True)
+            self.log_message(json.dumps(record, indent=4) + "\n")
+            self.progress_bar['value'] = 100
+            self.log_message("Watermarking completed successfully.\n", level="INFO")
+        except (DaemonError, OSError, ValueError) as e:
+            self.log_message(f"Error: {e}\n", level="ERROR")
+        self.start_button.config(state='normal')
 
     def run_watermarking(self, input_pdf, output_pdf, watermark_image, opacity, workers, profile):
         try:
+            # Progress arrives as JSON events on a pipe of its own, not in the logs
+            read_fd, write_fd = os.pipe()
+
             # Build the command
             cmd = [
-                'python', 'parent_script.py',
+                sys.executable, PARENT_SCRIPT,
                 input_pdf,
                 output_pdf,
                 watermark_image,
                 '--opacity', str(opacity),
-                '--workers', str(workers)
+                '--workers', str(workers),
+                '--events', str(write_fd)
             ]
 
             if profile:
                 cmd.append('--profile')
 
             # Execute the subprocess
-            self.process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1,
-                universal_newlines=True
-            )
-
-            # Read stdout in real-time
+            try:
+                self.process = subprocess.Popen(
+                    cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    text=True,
+                    bufsize=1,
+                    universal_newlines=True,
+                    pass_fds=(write_fd,)
+                )
+            finally:
+                os.close(write_fd)
+            events = threading.Thread(target=self.read_events, args=(read_fd,), daemon=True)
+            events.start()
+
+            # Read stdout and stderr in real-time
             for line in self.process.stdout:
                 self.log_message(line)
-                self.update_progress(line)
-
-            # Read any remaining stderr
-            stderr = self.process.stderr.read()
-            if stderr:
-                self.log_message(f"Error: {stderr}\n", level="ERROR")
 
             # Wait for the subprocess to finish
             self.process.wait()
+            events.join()
 
             # Re-enable the start button
             self.start_button.config(state='normal')
@@ -264,22 +301,28 @@ class WatermarkGUI:
         self.log_text.see(tk.END)
         self.log_text.config(state='disabled')
 
-    def update_progress(self, message):
+    def read_events(self, read_fd):
         """
-        Updates the progress bar based on the number of pages processed.
-        Expects messages like "Watermarked page X/Y"
+        Reads the newline-delimited JSON events of a run until the pipe closes.
         """
-        if "Watermarked page" in message:
-            try:
-                parts = message.strip().split(' ')
-                page_info = parts[-1]  # "X/Y"
-                x, y = page_info.split('/')
-                x = int(x)
-                y = int(y)
-                progress = (x / y) * 100
-                self.progress_bar['value'] = progress
-            except Exception:
-                pass  # Ignore parsing errors
+        with os.fdopen(read_fd) as stream:
+            for line in stream:
+                try:
+                    self.update_progress(json.loads(line))
+                except json.JSONDecodeError:
+                    pass  # Ignore malformed lines
+
+    def update_progress(self, event):
+        """
+        Updates the progress bar and the log from a watermarking event.
+        """
+        kind = event.get('event')
+        if kind == 'progress' and event.get('total'):
+            self.progress_bar['value'] = event['done'] / event['total'] * 100
+        elif kind == 'stage':
+            self.log_message(f"{event['stage']} took {event['duration']:.2f} seconds.\n", level="INFO")
+        elif kind == 'error':
+            self.log_message(f"Error: {event['error']}\n", level="ERROR")
 
     def update_resource_usage(self):
         """
@@ -4,54 +4,64 @@ import time
 import json
 import argparse
 import os
+import threading
+from watermark_client import DaemonError, WatermarkClient
 
-def watermark_pdf(input_pdf, output_pdf, watermark_image, opacity=0.2, workers=4, profile=False):
+WATERMARK_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'watermark_pdf.py')
+
+def watermark_with_daemon(address, input_pdf, output_pdf, watermark_image, opacity=0.2, engine="auto"):
+    """
+    Sends the job to a running watermark daemon.
+
+    Returns:
+        dict: The job's timing data, or None if no daemon answers at the address.
+    """
+    client = WatermarkClient(address)
+    if not client.is_available():
+        print(f"No watermark daemon at {address}; running watermark_pdf.py instead.", file=sys.stderr)
+        return None
+    # The daemon's jobs already run in a worker process
+    if engine == "process":
+        engine = "serial"
+    # Like the script, replaces an existing output
+    return client.submit(input_pdf, output_pdf, watermark_image, opacity=opacity, engine=engine, overwrite=True)
+
+def watermark_in_process(input_pdf, output_pdf, watermark_image, opacity=0.2, workers=None, engine="auto"):
     """
-    Calls the watermark_pdf.py script as a subprocess, measures execution time, and parses timing data.
+    Runs the job in this process through the pdf_watermarker library,
+    saving the interpreter startup and imports of a subprocess.
+
+    Returns:
+        dict: The job's timing data.
+    """
+    from pdf_watermarker import Engine, WatermarkJob
+
+    result = Engine(engine=engine, max_workers=workers).run(WatermarkJob(input_pdf, output_pdf, watermark_image, opacity=opacity))
+    return result.to_dict()
+
+def watermark_pdf(input_pdf, output_pdf, watermark_image, opacity=0.2, workers=None, profile=False, engine="auto", daemon=None, events=None, in_process=False):
+    """
+    Calls the watermark_pdf.py script as a subprocess, runs it in this process,
+    or sends the job to a watermark daemon, measures execution time, and
+    parses timing data. The timing data is printed last, as a single JSON line.
     """
     try:
         # Recording the start time from the parent script's perspective
         parent_start_time = time.time()
 
-        # Building the command
-        cmd = [
-            'python', 'watermark_pdf.py',
-            input_pdf,
-            output_pdf,
-            watermark_image,
-            '--opacity', str(opacity),
-            '--workers', str(workers)
-        ]
-
-        if profile:
-            cmd.extend(['--profile', '--profile_output', 'profile_output.prof'])
+        json_output = None
+        if daemon and not profile:
+            json_output = watermark_with_daemon(daemon, input_pdf, output_pdf, watermark_image, opacity, engine)
+        if json_output is None and in_process and not profile:
+            json_output = watermark_in_process(input_pdf, output_pdf, watermark_image, opacity, workers, engine)
+        if json_output is None:
+            json_output = run_watermark_script(input_pdf, output_pdf, watermark_image, opacity, workers, profile, engine, events)
 
-        # Executing the watermark_pdf.py script as a subprocess
-        result = subprocess.run(
-            cmd,
-            check=True,
-            capture_output=True,
-            text=True
-        )
-
-        # Recording the end time after subprocess completion
+        # Recording the end time after the job's completion
         parent_end_time = time.time()
 
-        # Capturing the JSON timing data from stdout
-        # Assuming JSON is printed at the end, find the last JSON object
-        stdout = result.stdout.strip()
-        json_output = None
-        for line in reversed(stdout.split('\n')):
-            try:
-                json_output = json.loads(line)
-                break
-            except json.JSONDecodeError:
-                continue
-
         if json_output:
             print("Watermarking completed successfully.")
-            print("Timing data from watermark_pdf.py:")
-            print(json.dumps(json_output, indent=4))
         else:
             print("Watermarking completed successfully, but failed to parse timing data.")
 
@@ -63,11 +73,79 @@ def watermark_pdf(input_pdf, output_pdf, watermark_image, opacity=0.2, workers=4
         parent_total_time = parent_end_time - parent_start_time
         print(f"\nTotal execution time from parent script: {parent_total_time:.2f} seconds.")
 
+        if json_output:
+            # Last, on one line, for callers that parse the output
+            json_output['parent_total_time'] = parent_total_time
+            print(json.dumps(json_output))
+
     except subprocess.CalledProcessError as e:
         print("Error during watermarking:", e.stderr, file=sys.stderr)
+    except DaemonError as e:
+        print(f"Error during watermarking: {e}", file=sys.stderr)
     except Exception as ex:
         print(f"An unexpected error occurred: {ex}", file=sys.stderr)
 
+def run_watermark_script(input_pdf, output_pdf, watermark_image, opacity=0.2, workers=None, profile=False, engine="auto", events=None):
+    """
+    Runs the watermark_pdf.py script as a subprocess and takes its timing data
+    from the "result" event of its event stream.
+
+    Args:
+        events (str): File descriptor number or path that the script's events
+            are relayed to, e.g. for a progress bar.
+
+    Returns:
+        dict: The timing data, or None if the script reported none.
+    """
+    read_fd, write_fd = os.pipe()
+    cmd = [
+        sys.executable, WATERMARK_SCRIPT,
+        input_pdf,
+        output_pdf,
+        watermark_image,
+        '--opacity', str(opacity),
+        '--engine', engine,
+        '--events', str(write_fd)
+    ]
+    if workers:
+        cmd.extend(['--workers', str(workers)])
+
+    if profile:
+        cmd.extend(['--profile', '--profile_output', 'profile_output.prof'])
+
+    relay = None
+    if events:
+        relay = open(int(events) if str(events).isdigit() else events, "w", buffering=1)
+    result = {}
+
+    def read_events():
+        with os.fdopen(read_fd) as stream:
+            for line in stream:
+                if relay:
+                    relay.write(line)
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if event.get('event') == 'result':
+                    result.update((key, value) for key, value in event.items() if key not in ('event', 'time'))
+
+    reader = threading.Thread(target=read_events, daemon=True)
+    reader.start()
+    try:
+        # Executing the watermark_pdf.py script as a subprocess
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, pass_fds=(write_fd,))
+    finally:
+        # Only the child keeps the write end, so the reader sees the end of the stream when it exits
+        os.close(write_fd)
+    stdout, stderr = process.communicate()
+    reader.join()
+    if relay:
+        relay.close()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return result or None
+
 def main():
     """
     Main function to parse command-line arguments and execute watermarking.
@@ -77,8 +155,12 @@ def main():
     parser.add_argument("output_pdf", help="Path to save the watermarked PDF.")
     parser.add_argument("watermark_image", help="Path to the watermark image file.")
     parser.add_argument("--opacity", type=float, default=0.2, help="Opacity level for the watermark (0 to 1). Default is 0.2.")
-    parser.add_argument("--workers", type=int, default=4, help="Number of parallel threads. Default is 4.")
+    parser.add_argument("--workers", type=int, help="Number of parallel worker processes or threads. Default: chosen by the auto engine, otherwise 4.")
+    parser.add_argument("--engine", choices=["auto", "process", "thread", "serial", "stream"], default="auto", help="Page-processing engine; auto chooses one from a preflight analysis of the input. Default is auto.")
     parser.add_argument("--profile", action='store_true', help="Enable profiling to identify performance bottlenecks.")
+    parser.add_argument("--events", metavar="FD_OR_PATH", help="Relay the script's newline-delimited JSON events to this file descriptor number or file.")
+    parser.add_argument("--daemon", metavar="ADDRESS", help="Send the job to a watermark daemon at host:port or unix:/path, falling back to a subprocess if none is running.")
+    parser.add_argument("--in-process", action='store_true', help="Watermark in this process through the pdf_watermarker library instead of a subprocess.")
     args = parser.parse_args()
 
     watermark_pdf(
@@ -87,7 +169,11 @@ def main():
         watermark_image=args.watermark_image,
         opacity=args.opacity,
         workers=args.workers,
-        profile=args.profile
+        profile=args.profile,
+        engine=args.engine,
+        daemon=args.daemon,
+        events=args.events,
+        in_process=args.in_process
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,15 @@
+"""
+Library interface of the PDF watermarking tool.
+
+Importing the package is cheap: PyMuPDF, Pillow and psutil are only loaded
+when the first job runs.
+
+    from pdf_watermarker import Engine, WatermarkJob
+
+    engine = Engine(engine="thread", max_workers=4)
+    result = engine.run(WatermarkJob("input.pdf", "output.pdf", "watermark.png", opacity=0.3))
+    print(result.pages, result.total_time)
+"""
+from pdf_watermarker.api import Engine, WatermarkJob, WatermarkResult
+
+__all__ = ["Engine", "WatermarkJob", "WatermarkResult"]
@@ -0,0 +1,197 @@
+import os
+
+# Engine-level options, forwarded to watermark_pdf.watermark_pdf
+ENGINE_OPTIONS = ("engine", "max_workers", "cpu_threshold", "memory_threshold", "chunk_size", "cache", "index")
+
+# WatermarkJob attributes that make up the vector_options of watermark_pdf
+VECTOR_OPTIONS = ("text", "rotation", "font", "font_size", "color")
+
+def _core():
+    # The engine module pulls in PyMuPDF, so it is only imported when a job runs
+    import watermark_pdf
+    return watermark_pdf
+
+class WatermarkJob:
+    """
+    A document to watermark and how. Options left as None take the defaults
+    of watermark_pdf.py.
+
+    Args:
+        input: Path to the input PDF, or the PDF itself as a bytes-like or
+            readable binary file object.
+        output: Path to save the watermarked PDF, or a writable binary file object.
+        watermark (str): Path to the watermark image, or to a PDF or SVG logo.
+        opacity (float): Opacity level for the watermark (0 to 1).
+        text (str): Text watermark; replaces the watermark image.
+        rotation (float): Counter-clockwise rotation of vector watermarks in degrees.
+        font (str): Base-14 font name or font file for text watermarks.
+        font_size (float): Font size for text watermarks.
+        color (str): Color for text watermarks as #RRGGBB.
+        watermark_dpi (int): Resolution the watermark image is downsampled to;
+            0 keeps the source resolution.
+        share_image (bool): Embed the watermark once and reference it from every page.
+        save_profile (str): "fast", "balanced" or "smallest"; None lets the
+            auto engine choose, and is "fast" otherwise.
+        incremental (bool): Append the watermark as an incremental update.
+        force (bool): Watermark even if the input already carries this watermark.
+        strict (bool): Retry pages that fail and raise if they still do.
+        checkpoint_dir (str): Work directory keeping finished page ranges of
+            the process engine, so an interrupted job can be resumed.
+        resume (bool): Continue from the page ranges finished in checkpoint_dir.
+    """
+
+    def __init__(self, input, output, watermark=None, opacity=0.2, text=None, rotation=None, font=None, font_size=None, color=None, watermark_dpi=None, share_image=True, save_profile=None, incremental=False, force=False, strict=False, checkpoint_dir=None, resume=False):
+        if not watermark and not text:
+            raise ValueError("A watermark image or text is required")
+        self.input = input
+        self.output = output
+        self.watermark = watermark
+        self.opacity = opacity
+        self.text = text
+        self.rotation = rotation
+        self.font = font
+        self.font_size = font_size
+        self.color = color
+        self.watermark_dpi = watermark_dpi
+        self.share_image = share_image
+        self.save_profile = save_profile
+        self.incremental = incremental
+        self.force = force
+        self.strict = strict
+        self.checkpoint_dir = checkpoint_dir
+        self.resume = resume
+
+    def options(self):
+        """
+        Returns the keyword arguments of watermark_pdf.watermark_pdf for this job.
+        """
+        options = {
+            'input_pdf_path': self.input,
+            'output_pdf_path': self.output,
+            'watermark_image_path': self.watermark,
+            'opacity': self.opacity,
+            'share_image': self.share_image,
+            'save_profile': self.save_profile,
+            'incremental': self.incremental,
+            'force': self.force,
+            'strict': self.strict,
+            'checkpoint_dir': self.checkpoint_dir,
+            'resume': self.resume,
+            'vector_options': {name: getattr(self, name) for name in VECTOR_OPTIONS if getattr(self, name) is not None},
+        }
+        if self.watermark_dpi is not None:
+            options['watermark_dpi'] = self.watermark_dpi
+        return options
+
+    def __repr__(self):
+        return f"WatermarkJob({self.input!r}, {self.output!r}, {self.watermark or self.text!r})"
+
+class WatermarkResult:
+    """
+    Outcome of a WatermarkJob.
+
+    Attributes:
+        job (WatermarkJob): The job that ran.
+        timing (dict): Timing data of the run, as printed by watermark_pdf.py.
+    """
+
+    def __init__(self, job, timing):
+        self.job = job
+        self.timing = timing
+
+    @property
+    def output(self):
+        return self.job.output
+
+    @property
+    def pages(self):
+        return self.timing.get('pages')
+
+    @property
+    def total_time(self):
+        return self.timing.get('total_time')
+
+    @property
+    def skipped(self):
+        """
+        Why no watermarking was needed ("indexed" or "already_watermarked"), or None.
+        """
+        return self.timing.get('skipped')
+
+    @property
+    def failed_pages(self):
+        """
+        1-based numbers of pages left without a watermark; empty when all succeeded.
+        """
+        return self.timing.get('failed_pages', [])
+
+    @property
+    def metrics(self):
+        """
+        Per-stage latency summary (open, prepare, page, merge, save) and peak memory of the run.
+        """
+        return self.timing.get('metrics')
+
+    @property
+    def output_size(self):
+        if 'output_size' in self.timing:
+            return self.timing['output_size']
+        if isinstance(self.job.output, (str, os.PathLike)):
+            return os.path.getsize(self.job.output)
+        return None
+
+    def to_dict(self):
+        return dict(self.timing)
+
+    def __repr__(self):
+        return f"WatermarkResult({self.output!r}, pages={self.pages}, total_time={self.total_time})"
+
+class Engine:
+    """
+    Runs watermarking jobs in the calling process. Nothing is printed and
+    logging is left to the application; the engine module and its
+    dependencies are imported on the first run.
+
+    Args:
+        engine (str): "auto", "process", "thread", "serial" or "stream"; auto
+            chooses one per document from a preflight analysis.
+        max_workers (int): Maximum number of processes or threads; None lets
+            the auto engine choose, and means 4 for the others.
+        cpu_threshold (int): CPU usage percentage above which concurrency is reduced.
+        memory_threshold (int): Memory usage percentage above which concurrency is reduced.
+        chunk_size (int): Pages per chunk of the stream engine; None for the default.
+        cache (WatermarkCache): Prepared-watermark cache; None for the process-wide cache.
+        index (ResultIndex): Index of earlier results to reuse; None disables it.
+    """
+
+    def __init__(self, engine="auto", max_workers=None, cpu_threshold=80, memory_threshold=80, chunk_size=None, cache=None, index=None):
+        self.engine = engine
+        self.max_workers = max_workers
+        self.cpu_threshold = cpu_threshold
+        self.memory_threshold = memory_threshold
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.index = index
+
+    def run(self, job):
+        """
+        Watermarks one document.
+
+        Args:
+            job (WatermarkJob): The document and watermark options.
+
+        Returns:
+            WatermarkResult: The result; errors are raised.
+        """
+        options = {name: getattr(self, name) for name in ENGINE_OPTIONS if getattr(self, name) is not None}
+        timing = _core().watermark_pdf(**options, **job.options())
+        return WatermarkResult(job, timing)
+
+    def run_all(self, jobs):
+        """
+        Watermarks several documents one after the other.
+
+        Returns:
+            list: One WatermarkResult per job, in order.
+        """
+        return [self.run(job) for job in jobs]
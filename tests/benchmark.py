@@ -0,0 +1,382 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    # The legacy "fitz" name prints a deprecation notice to stdout, where the report goes
+    import pymupdf as fitz
+except ImportError:
+    import fitz
+import psutil
+from PIL import Image, ImageDraw, ImageFilter
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+WATERMARK_SCRIPT = os.path.join(ROOT_DIR, 'watermark_pdf.py')
+
+# Page sizes (width, height in points) cycled through by documents with mixed sizes
+PAGE_SIZES = {
+    'letter': (612, 792),
+    'a4': (595, 842),
+    'legal': (612, 1008),
+    'a5': (420, 595),
+    'tabloid-landscape': (1224, 792),
+}
+
+# Benchmark documents: page count, page sizes, and whether pages are scanned images
+CORPUS = {
+    'text-200': {'pages': 200, 'sizes': ['letter'], 'scanned': False},
+    'mixed-2000': {'pages': 2000, 'sizes': list(PAGE_SIZES), 'scanned': False},
+    'scans-100': {'pages': 100, 'sizes': ['letter', 'a4'], 'scanned': True},
+    'text-10000': {'pages': 10000, 'sizes': ['letter'], 'scanned': False},
+    'mixed-50000': {'pages': 50000, 'sizes': list(PAGE_SIZES), 'scanned': False},
+    'scans-2000': {'pages': 2000, 'sizes': ['letter', 'a4'], 'scanned': True},
+}
+
+# Watermark images: pixel size of the source image
+WATERMARKS = {
+    'small': (300, 150),
+    'large': (4000, 4000),
+}
+
+# Documents benchmarked by each suite
+SUITES = {
+    'quick': ['text-200', 'mixed-2000', 'scans-100'],
+    'full': list(CORPUS),
+}
+
+# Engines that take a worker count; the others always run with one worker
+PARALLEL_ENGINES = ('process', 'thread')
+
+# Allowed change against the baseline before a case counts as a regression
+DEFAULT_MAX_SLOWDOWN = 0.10
+DEFAULT_MAX_RSS_GROWTH = 0.15
+DEFAULT_MAX_SIZE_GROWTH = 0.05
+DEFAULT_MAX_STARTUP_GROWTH = 0.25
+
+# Modules whose import time is measured in a fresh interpreter
+STARTUP_MODULES = ('pdf_watermarker', 'watermark_pdf')
+
+# Fresh interpreters started per startup metric; the median is recorded
+STARTUP_RUNS = 5
+
+# Interval at which the memory of a benchmarked process tree is sampled
+RSS_SAMPLE_INTERVAL = 0.05
+
+# Distinct scan images per document; pages cycle through them
+SCAN_VARIANTS = 16
+
+def scan_image(width, height, seed):
+    """
+    Returns JPEG data resembling a grey page scan: paper noise with lines of
+    "text". The noise is smoothed so the images compress like real scans.
+    """
+    rng = random.Random(seed)
+    noise = Image.frombytes('L', (width // 8, height // 8), bytes(rng.randrange(225, 256) for _ in range((width // 8) * (height // 8))))
+    img = noise.resize((width, height)).filter(ImageFilter.GaussianBlur(1))
+    draw = ImageDraw.Draw(img)
+    for y in range(height // 10, height - height // 10, 24):
+        x = width // 10
+        while x < width - width // 10:
+            word = rng.randrange(20, 90)
+            draw.rectangle((x, y, min(x + word, width - width // 10), y + 10), fill=rng.randrange(20, 80))
+            x += word + 12
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=70)
+    return buffer.getvalue()
+
+def create_document(path, pages, sizes, scanned, seed=0):
+    """
+    Writes a benchmark PDF.
+
+    Args:
+        path (str): Path of the PDF to write.
+        pages (int): Number of pages.
+        sizes (list): Names of PAGE_SIZES the pages cycle through.
+        scanned (bool): Fill every page with a scanned image instead of text.
+        seed (int): Seed of the scan images, for reproducible documents.
+    """
+    scans = [scan_image(850, 1100, seed + variant) for variant in range(SCAN_VARIANTS)] if scanned else []
+    with fitz.open() as pdf:
+        for number in range(pages):
+            width, height = PAGE_SIZES[sizes[number % len(sizes)]]
+            page = pdf.new_page(width=width, height=height)
+            if scanned:
+                page.insert_image(page.rect, stream=scans[number % SCAN_VARIANTS])
+            else:
+                page.insert_text((72, 72), f"Page {number + 1}", fontsize=12)
+                page.insert_text((72, 96), "Benchmark document " * 4, fontsize=9)
+        pdf.save(path, garbage=1, deflate=True)
+
+def create_watermark(path, width, height):
+    """
+    Writes a semi-transparent RGBA PNG watermark with a gradient, so that the
+    image does not compress away.
+    """
+    img = Image.linear_gradient('L').resize((width, height))
+    watermark = Image.merge('RGBA', (img, img.rotate(90), img.transpose(Image.Transpose.FLIP_LEFT_RIGHT), img.point(lambda value: value // 2 + 64)))
+    ImageDraw.Draw(watermark).text((width // 10, height // 2), "CONFIDENTIAL", fill=(200, 0, 0, 255))
+    watermark.save(path)
+
+def prepare_corpus(corpus_dir, documents, watermarks):
+    """
+    Creates the documents and watermarks that do not exist yet in corpus_dir.
+
+    Returns:
+        tuple: Paths of the documents and of the watermarks, keyed by name.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    document_paths = {}
+    for name in documents:
+        spec = CORPUS[name]
+        path = os.path.join(corpus_dir, f"{name}.pdf")
+        if not os.path.exists(path):
+            print(f"Generating {path} ({spec['pages']} pages)...", file=sys.stderr)
+            create_document(path + ".tmp", spec['pages'], spec['sizes'], spec['scanned'])
+            os.replace(path + ".tmp", path)
+        document_paths[name] = path
+    watermark_paths = {}
+    for name in watermarks:
+        path = os.path.join(corpus_dir, f"watermark-{name}.png")
+        if not os.path.exists(path):
+            create_watermark(path, *WATERMARKS[name])
+        watermark_paths[name] = path
+    return document_paths, watermark_paths
+
+def benchmark_cases(documents, watermarks, engines, worker_counts):
+    """
+    Returns the (document, watermark, engine, workers) combinations to run.
+    """
+    cases = []
+    for document in documents:
+        for watermark in watermarks:
+            for engine in engines:
+                for workers in (worker_counts if engine in PARALLEL_ENGINES else [1]):
+                    cases.append((document, watermark, engine, workers))
+    return cases
+
+def case_key(document, watermark, engine, workers):
+    return f"{document}/{watermark}/{engine}/{workers}"
+
+def run_case(input_pdf, watermark, engine, workers, work_dir):
+    """
+    Runs watermark_pdf.py once in a fresh process and measures it. The peak
+    memory is sampled over the whole process tree, so that the worker
+    processes of the process engine are counted. Every run gets an empty
+    watermark cache, so watermark preparation is always measured.
+
+    Returns:
+        dict: Pages per second, peak RSS of the process tree and of the main
+        process in MB, output size in bytes and the timing data of the run.
+    """
+    output_pdf = os.path.join(work_dir, "output.pdf")
+    cache_dir = tempfile.mkdtemp(prefix="cache_", dir=work_dir)
+    command = [
+        sys.executable, WATERMARK_SCRIPT, input_pdf, output_pdf, watermark,
+        '--engine', engine, '--workers', str(workers), '--cache-dir', cache_dir
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, cwd=work_dir)
+    peak_rss = 0
+    root = psutil.Process(process.pid)
+    while process.poll() is None:
+        try:
+            tree = [root] + root.children(recursive=True)
+            rss = 0
+            for member in tree:
+                try:
+                    rss += member.memory_info().rss
+                except psutil.Error:
+                    pass
+            peak_rss = max(peak_rss, rss)
+        except psutil.Error:
+            pass
+        time.sleep(RSS_SAMPLE_INTERVAL)
+    stdout = process.stdout.read()
+    process.stdout.close()
+    if process.returncode != 0:
+        raise RuntimeError(f"watermark_pdf.py failed with exit code {process.returncode}: {' '.join(command)}")
+    timing_data = json.loads(stdout.strip().splitlines()[-1])
+    return {
+        'pages': timing_data['pages'],
+        'pages_per_sec': timing_data['pages'] / timing_data['total_time'],
+        'peak_rss_mb': max(peak_rss / (1024 * 1024), timing_data['peak_rss_mb']),
+        'main_peak_rss_mb': timing_data['peak_rss_mb'],
+        'output_size': timing_data['output_size'],
+        'total_time': timing_data['total_time'],
+    }
+
+def run_benchmarks(cases, document_paths, watermark_paths, repeat=1):
+    """
+    Runs every case repeat times, keeping the median of each metric.
+
+    Returns:
+        dict: Results keyed by case_key.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="watermark_benchmark_") as work_dir:
+        for document, watermark, engine, workers in cases:
+            key = case_key(document, watermark, engine, workers)
+            runs = [run_case(document_paths[document], watermark_paths[watermark], engine, workers, work_dir) for _ in range(repeat)]
+            results[key] = {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+            print(
+                f"{key:<40} {results[key]['pages_per_sec']:>10.1f} pages/s {results[key]['peak_rss_mb']:>8.1f} MB "
+                f"{results[key]['output_size'] / (1024 * 1024):>9.2f} MB out",
+                file=sys.stderr
+            )
+    return results
+
+def measure_startup(watermark_path, work_dir, runs=STARTUP_RUNS):
+    """
+    Measures the import time of the library and the engine module, and the
+    cold-start time of the CLI: the wall time of watermarking a one-page
+    document in a fresh process, which is dominated by interpreter startup
+    and imports.
+
+    Returns:
+        dict: Median import time of each STARTUP_MODULES entry in ms
+        ("import_<module>_ms") and the median cold-start time in seconds.
+    """
+    input_pdf = os.path.join(work_dir, "startup.pdf")
+    create_document(input_pdf, 1, ['letter'], False)
+    startup = {}
+    for module in STARTUP_MODULES:
+        code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+        samples = [
+            float(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=ROOT_DIR).stdout)
+            for _ in range(runs)
+        ]
+        startup[f'import_{module}_ms'] = statistics.median(samples) * 1000
+    command = [sys.executable, WATERMARK_SCRIPT, input_pdf, os.path.join(work_dir, "startup_out.pdf"), os.path.abspath(watermark_path), '--engine', 'serial']
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, capture_output=True, check=True, cwd=work_dir)
+        samples.append(time.perf_counter() - start)
+    startup['cold_start_s'] = statistics.median(samples)
+    print("  ".join(f"{metric} {value:.3f}" for metric, value in startup.items()), file=sys.stderr)
+    return startup
+
+def compare_startup(startup, baseline, max_growth=DEFAULT_MAX_STARTUP_GROWTH):
+    """
+    Compares startup metrics with a baseline. Metrics missing from either side are skipped.
+
+    Returns:
+        list: One message per regression; empty when there is none.
+    """
+    return [
+        f"startup: {metric} {value:.3f}, baseline {baseline[metric]:.3f}"
+        for metric, value in startup.items()
+        if metric in baseline and value > baseline[metric] * (1 + max_growth)
+    ]
+
+def environment():
+    """
+    Describes the machine, so baselines from different machines are not mixed up.
+    """
+    return {
+        'python': platform.python_version(),
+        'pymupdf': fitz.VersionBind,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'memory_mb': psutil.virtual_memory().total // (1024 * 1024),
+    }
+
+def compare_results(results, baseline, max_slowdown=DEFAULT_MAX_SLOWDOWN, max_rss_growth=DEFAULT_MAX_RSS_GROWTH, max_size_growth=DEFAULT_MAX_SIZE_GROWTH):
+    """
+    Compares results with a baseline. Cases missing from either side are skipped.
+
+    Args:
+        results (dict): Results keyed by case_key, as returned by run_benchmarks.
+        baseline (dict): Results of an earlier run, keyed the same way.
+        max_slowdown (float): Allowed relative drop in pages per second.
+        max_rss_growth (float): Allowed relative growth of the peak RSS.
+        max_size_growth (float): Allowed relative growth of the output size.
+
+    Returns:
+        list: One message per regression; empty when there is none.
+    """
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        if result['pages_per_sec'] < reference['pages_per_sec'] * (1 - max_slowdown):
+            regressions.append(f"{key}: {result['pages_per_sec']:.1f} pages/s, baseline {reference['pages_per_sec']:.1f} pages/s")
+        if result['peak_rss_mb'] > reference['peak_rss_mb'] * (1 + max_rss_growth):
+            regressions.append(f"{key}: peak RSS {result['peak_rss_mb']:.1f} MB, baseline {reference['peak_rss_mb']:.1f} MB")
+        if result['output_size'] > reference['output_size'] * (1 + max_size_growth):
+            regressions.append(f"{key}: output {result['output_size']} bytes, baseline {reference['output_size']} bytes")
+    return regressions
+
+def build_parser():
+    engines = ('process', 'thread', 'serial', 'stream')
+    parser = argparse.ArgumentParser(description="Benchmark the watermarking engines and check for performance regressions.")
+    parser.add_argument("--suite", choices=SUITES, default='quick', help="Documents to benchmark: quick (up to 2000 pages) or full (up to 50000 pages). Default is quick.")
+    parser.add_argument("--documents", nargs='+', choices=CORPUS, help="Benchmark these documents instead of a suite.")
+    parser.add_argument("--watermarks", nargs='+', choices=WATERMARKS, default=list(WATERMARKS), help="Watermark images to use. Default is all.")
+    parser.add_argument("--engines", nargs='+', choices=engines, default=list(engines), help="Engines to benchmark. Default is all.")
+    parser.add_argument("--workers", nargs='+', type=int, default=[1, 4], help="Worker counts of the process and thread engines. Default is 1 4.")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case; the median is recorded. Default is 1.")
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "watermark_benchmark_corpus"), help="Directory the generated documents are kept in between runs.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with; the run fails on regressions.")
+    parser.add_argument("--update-baseline", action='store_true', help="Merge the results into the --baseline file instead of comparing.")
+    parser.add_argument("--max-slowdown", type=float, default=DEFAULT_MAX_SLOWDOWN, help="Allowed relative drop in pages per second. Default is 0.10.")
+    parser.add_argument("--max-rss-growth", type=float, default=DEFAULT_MAX_RSS_GROWTH, help="Allowed relative growth of the peak RSS. Default is 0.15.")
+    parser.add_argument("--max-size-growth", type=float, default=DEFAULT_MAX_SIZE_GROWTH, help="Allowed relative growth of the output size. Default is 0.05.")
+    parser.add_argument("--max-startup-growth", type=float, default=DEFAULT_MAX_STARTUP_GROWTH, help="Allowed relative growth of import and cold-start times. Default is 0.25.")
+    parser.add_argument("--no-startup", action='store_true', help="Skip the import and cold-start measurements.")
+    return parser
+
+def main(argv=None):
+    """
+    Main function to run the benchmarks.
+
+    Returns:
+        int: Exit status, 1 if a regression was found.
+    """
+    args = build_parser().parse_args(argv)
+    documents = args.documents or SUITES[args.suite]
+    document_paths, watermark_paths = prepare_corpus(args.corpus_dir, documents, args.watermarks)
+    cases = benchmark_cases(documents, args.watermarks, args.engines, args.workers)
+    results = run_benchmarks(cases, document_paths, watermark_paths, args.repeat)
+    report = {'environment': environment(), 'results': results}
+    if not args.no_startup:
+        with tempfile.TemporaryDirectory(prefix="watermark_startup_") as work_dir:
+            report['startup'] = measure_startup(next(iter(watermark_paths.values())), work_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if not args.baseline:
+        return 0
+    if args.update_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                previous = json.load(f)
+            report['results'] = dict(previous['results'], **results)
+            report.setdefault('startup', previous.get('startup', {}))
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline {args.baseline} updated with {len(results)} cases.", file=sys.stderr)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('environment', {}).get('cpu_count') != os.cpu_count():
+        print("Warning: the baseline was recorded on a machine with a different CPU count.", file=sys.stderr)
+    regressions = compare_results(results, baseline['results'], args.max_slowdown, args.max_rss_growth, args.max_size_growth)
+    regressions += compare_startup(report.get('startup', {}), baseline.get('startup', {}), args.max_startup_growth)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    compared = len(set(results) & set(baseline['results']))
+    print(f"{compared} cases compared with {args.baseline}: {len(regressions)} regressions.", file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
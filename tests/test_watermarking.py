@@ -1,10 +1,60 @@
 import unittest
+from unittest import mock
+import asyncio
 import subprocess
+import socket
 import os
 import sys
 import json
+import shutil
+import tempfile
+import threading
+import time
+import io
+import logging
+import contextlib
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+from concurrent.futures import ProcessPoolExecutor
+import fitz
+from PIL import Image
 from PyPDF2 import PdfReader
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import watermark_pdf
+import pdf_watermarker
+import parent_script
+import watermark_daemon
+from watermark_cache import WatermarkCache
+from watermark_client import DaemonError, WatermarkClient
+from watermark_index import ResultIndex
+import watermark_metrics
+import watermark_cluster
+import benchmark
+
+TEST_PDFS_DIR = os.path.join(os.path.dirname(__file__), 'test_pdfs')
+WATERMARK_IMAGE = os.path.join(os.path.dirname(__file__), '..', 'watermark.png')
+
+class TempDirMixin:
+    """
+    Gives every test a temporary directory, temp_dir, removed afterwards,
+    and input_pdf, the test PDF named by input_name.
+    """
+    input_dir = TEST_PDFS_DIR
+    input_name = 'medium.pdf'
+    watermark_image = WATERMARK_IMAGE
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.input_pdf = os.path.join(self.input_dir, self.input_name)
+
+class TempDirTestCase(TempDirMixin, unittest.TestCase):
+    pass
+
 class TestWatermarking(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -90,5 +140,1529 @@ class TestWatermarking(unittest.TestCase):
         self.assertEqual(len(reader.pages), 200)
         # Further verification can be added here
 
+class TestSharedWatermarkImage(TempDirTestCase):
+    def watermark(self, name):
+        input_pdf = os.path.join(self.input_dir, f'{name}.pdf')
+        output_pdf = os.path.join(self.temp_dir, f'{name}_shared.pdf')
+        watermark_pdf.watermark_pdf(input_pdf, output_pdf, self.watermark_image, opacity=0.3, max_workers=2)
+        return input_pdf, output_pdf
+
+    def test_single_image_stream(self):
+        _, output_pdf = self.watermark('medium')
+        with fitz.open(output_pdf) as pdf:
+            xrefs = {image[0] for page in pdf for image in page.get_images()}
+            self.assertEqual(len(xrefs), 1)
+            self.assertTrue(all(page.get_images() for page in pdf))
+
+    def test_size_independent_of_page_count(self):
+        small_in, small_out = self.watermark('small')
+        large_in, large_out = self.watermark('large')
+        small_overhead = os.path.getsize(small_out) - os.path.getsize(small_in)
+        large_overhead = os.path.getsize(large_out) - os.path.getsize(large_in)
+        with fitz.open(large_out) as pdf:
+            image_size = len(pdf.xref_stream_raw(pdf[0].get_images()[0][0]))
+        # Each extra page may only add a content-stream reference, not image data
+        per_page = (large_overhead - small_overhead) / 195
+        self.assertLess(per_page, image_size / 20)
+
+def make_form_pdf(path, pages):
+    """
+    Writes a PDF with a text field on every page, page labels and an
+    attachment: the document-level parts an engine that rebuilds the
+    document page by page would lose.
+    """
+    with fitz.open() as pdf:
+        for i in range(pages):
+            page = pdf.new_page()
+            page.insert_text((72, 72), f'Page {i + 1}')
+            widget = fitz.Widget()
+            widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+            widget.field_name = f'field_{i + 1}'
+            widget.field_value = f'value {i + 1}'
+            widget.rect = fitz.Rect(72, 100, 300, 130)
+            page.add_widget(widget)
+        pdf.set_page_labels([{'startpage': 0, 'prefix': 'A-', 'style': 'r', 'firstpagenum': 1}, {'startpage': 2, 'prefix': '', 'style': 'D', 'firstpagenum': 1}])
+        pdf.embfile_add('notes.txt', b'attached notes', filename='notes.txt')
+        pdf.save(path)
+    return path
+
+class TestEngines(TempDirTestCase):
+    input_name = 'large.pdf'
+
+    def check_engine(self, engine, workers=4):
+        output_pdf = os.path.join(self.temp_dir, f'large_{engine}.pdf')
+        watermark_pdf.watermark_pdf(self.input_pdf, output_pdf, self.watermark_image, opacity=0.3, max_workers=workers, engine=engine)
+        with fitz.open(self.input_pdf) as source, fitz.open(output_pdf) as pdf:
+            self.assertEqual(pdf.page_count, 200)
+            self.assertTrue(all(page.get_images() for page in pdf))
+            self.assertEqual(len({image[0] for page in pdf for image in page.get_images()}), 1)
+            self.assertEqual(pdf[137].get_text(), source[137].get_text())
+
+    def test_serial_engine(self):
+        self.check_engine('serial')
+
+    def test_thread_engine(self):
+        self.check_engine('thread')
+
+    def test_process_engine(self):
+        self.check_engine('process')
+
+    def test_process_engine_more_workers_than_pages(self):
+        output_pdf = os.path.join(self.temp_dir, 'small_process.pdf')
+        small_pdf = os.path.join(self.input_dir, 'small.pdf')
+        watermark_pdf.watermark_pdf(small_pdf, output_pdf, self.watermark_image, max_workers=8, engine='process')
+        with fitz.open(output_pdf) as pdf:
+            self.assertEqual([page.get_text().strip() for page in pdf], [f'Page {i}' for i in range(1, 6)])
+
+    def check_document_structure(self, output_pdf, pages):
+        with fitz.open(output_pdf) as pdf:
+            self.assertTrue(all(page.get_images() for page in pdf))
+            self.assertEqual([page.get_label() for page in pdf][:4], ['A-i', 'A-ii', '1', '2'])
+            self.assertEqual(pdf.embfile_names(), ['notes.txt'])
+            self.assertEqual(pdf.embfile_get('notes.txt'), b'attached notes')
+            fields = {widget.field_name: widget.field_value for page in pdf for widget in page.widgets()}
+            self.assertEqual(fields, {f'field_{i}': f'value {i}' for i in range(1, pages + 1)})
+
+    def test_process_engine_keeps_document_structure(self):
+        input_pdf = make_form_pdf(os.path.join(self.temp_dir, 'form.pdf'), 12)
+        output_pdf = os.path.join(self.temp_dir, 'form_process.pdf')
+        watermark_pdf.watermark_pdf(input_pdf, output_pdf, self.watermark_image, max_workers=2, engine='process')
+        self.check_document_structure(output_pdf, 12)
+
+    def test_stream_engine(self):
+        self.check_engine('stream')
+
+    def test_stream_engine_keeps_document_structure(self):
+        input_pdf = make_form_pdf(os.path.join(self.temp_dir, 'form.pdf'), 12)
+        output_pdf = os.path.join(self.temp_dir, 'form_stream.pdf')
+        watermark_pdf.watermark_pdf(input_pdf, output_pdf, self.watermark_image, engine='stream', chunk_size=5)
+        self.check_document_structure(output_pdf, 12)
+
+    def test_stream_engine_appends_chunks_incrementally(self):
+        output_pdf = os.path.join(self.temp_dir, 'large_stream_chunks.pdf')
+        watermark_pdf.watermark_pdf(self.input_pdf, output_pdf, self.watermark_image, engine='stream', chunk_size=30)
+        with fitz.open(output_pdf) as pdf:
+            self.assertEqual(pdf.page_count, 200)
+            self.assertEqual(len({image[0] for page in pdf for image in page.get_images()}), 1)
+        # One full save followed by an incremental update per further chunk and one for the watermark marker
+        with open(output_pdf, 'rb') as f:
+            self.assertEqual(f.read().count(b'%%EOF'), 8)
+
+    def test_split_page_ranges(self):
+        self.assertEqual(watermark_pdf.split_page_ranges(10, 3), [(0, 4), (4, 7), (7, 10)])
+        self.assertEqual(watermark_pdf.split_page_ranges(2, 8), [(0, 1), (1, 2)])
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            watermark_pdf.watermark_pdf(self.input_pdf, os.path.join(self.temp_dir, 'unused.pdf'), self.watermark_image, engine='gpu')
+
+class TestPlacement(TempDirTestCase):
+    # (width, height, crop box, rotation) of the pages of the test document
+    PAGES = [
+        (612, 792, None, 0),
+        (612, 792, None, 90),
+        (842, 595, None, 0),
+        (612, 792, (50, 100, 400, 700), 180),
+        (612, 792, None, 270),
+        (612, 792, (50, 100, 400, 700), 90),
+        (612, 792, None, 90),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.input_pdf = os.path.join(self.temp_dir, 'rotated.pdf')
+        with fitz.open() as pdf:
+            for width, height, cropbox, rotation in self.PAGES:
+                page = pdf.new_page(width=width, height=height)
+                if cropbox:
+                    page.set_cropbox(fitz.Rect(*cropbox))
+                page.set_rotation(rotation)
+            pdf.save(self.input_pdf)
+        # Red top half, blue bottom half: shows both position and orientation
+        img = Image.new('RGB', (200, 100), (255, 0, 0))
+        img.paste((0, 0, 255), (0, 50, 200, 100))
+        buffer = io.BytesIO()
+        img.save(buffer, format='PNG')
+        self.watermark = buffer.getvalue()
+
+    def colour_box(self, pix, colour):
+        points = [
+            (x, y) for y in range(pix.height) for x in range(pix.width)
+            if all(abs(a - b) < 60 for a, b in zip(pix.pixel(x, y), colour))
+        ]
+        xs, ys = [x for x, _ in points], [y for _, y in points]
+        return min(xs), min(ys), max(xs) + 1, max(ys) + 1
+
+    def check_output(self, output_pdf):
+        with fitz.open(output_pdf) as pdf:
+            self.assertEqual(pdf.page_count, len(self.PAGES))
+            for page in pdf:
+                pix = page.get_pixmap(dpi=36)
+                red = self.colour_box(pix, (255, 0, 0))
+                blue = self.colour_box(pix, (0, 0, 255))
+                # Upright: red above blue
+                self.assertLessEqual(red[3], blue[1] + 1, f"page {page.number + 1}")
+                centre = ((red[0] + blue[2]) / 2, (red[1] + blue[3]) / 2)
+                self.assertAlmostEqual(centre[0], pix.width / 2, delta=2, msg=f"page {page.number + 1}")
+                self.assertAlmostEqual(centre[1], pix.height / 2, delta=2, msg=f"page {page.number + 1}")
+
+    def test_groups_pages_by_geometry(self):
+        with fitz.open(self.input_pdf) as pdf:
+            groups = watermark_pdf.plan_watermark_placements(pdf)
+            self.assertEqual([page_numbers for _, page_numbers in groups], [[0], [1, 6], [2], [3], [4], [5]])
+            self.assertEqual([rotation for (_, rotation), _ in groups], [0, 90, 0, 180, 270, 90])
+            for placement, page_numbers in groups:
+                self.assertEqual(placement, watermark_pdf.watermark_placement(pdf[page_numbers[-1]]))
+
+    def test_inherited_geometry(self):
+        with fitz.open() as pdf:
+            for _ in range(3):
+                pdf.new_page()
+            for page in pdf:
+                pdf.xref_set_key(page.xref, 'Rotate', 'null')
+            root = int(pdf.xref_get_key(pdf.pdf_catalog(), 'Pages')[1].split()[0])
+            pdf.xref_set_key(root, 'Rotate', '90')
+            pdf.xref_set_key(pdf[2].xref, 'Rotate', '0')
+            groups = watermark_pdf.plan_watermark_placements(pdf)
+            self.assertEqual([(rotation, page_numbers) for (_, rotation), page_numbers in groups], [(90, [0, 1]), (0, [2])])
+
+    def test_rotated_and_cropped_pages(self):
+        for engine in ('serial', 'thread', 'process', 'stream'):
+            output_pdf = os.path.join(self.temp_dir, f'{engine}.pdf')
+            watermark_pdf.watermark_document(self.input_pdf, output_pdf, self.watermark, max_workers=2, engine=engine, chunk_size=3)
+            self.check_output(output_pdf)
+
+def failing_pages(pages, times=None):
+    """
+    Returns a stand-in for watermark_pdf.watermark_page_under that raises for
+    the pages of the test PDFs labelled with the given numbers, every time or
+    only the first `times` times. Pages are recognised by their "Page N"
+    label, since the process engine numbers the pages of each part from 0.
+    """
+    original = watermark_pdf.watermark_page_under
+    failures = {}
+
+    def watermark_page_under(pdf_page, *args, **kwargs):
+        number = int(pdf_page.get_text().split()[1])
+        if number in pages and (times is None or failures.get(number, 0) < times):
+            failures[number] = failures.get(number, 0) + 1
+            raise RuntimeError(f"broken page {number}")
+        return original(pdf_page, *args, **kwargs)
+    return watermark_page_under
+
+class TestPageFailures(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+
+    def watermarked_pages(self, path):
+        with fitz.open(path) as pdf:
+            return [page.number + 1 for page in pdf if page.get_images()]
+
+    def test_failed_pages_are_reported(self):
+        for engine in ('serial', 'thread', 'stream', 'process'):
+            with self.subTest(engine=engine), mock.patch.object(watermark_pdf, 'watermark_page_under', failing_pages({3, 40})):
+                timing = watermark_pdf.watermark_pdf(self.input_pdf, self.output_pdf, self.watermark_image, engine=engine, max_workers=2, chunk_size=20)
+                self.assertEqual(timing['failed_pages'], [3, 40])
+                self.assertEqual(len(self.watermarked_pages(self.output_pdf)), 48)
+                # An incomplete output is not marked as watermarked
+                with fitz.open(self.output_pdf) as pdf:
+                    self.assertIsNone(watermark_pdf.read_watermark_marker(pdf))
+
+    def test_strict_mode_retries_then_fails(self):
+        with mock.patch.object(watermark_pdf, 'watermark_page_under', failing_pages({7}, times=1)):
+            timing = watermark_pdf.watermark_pdf(self.input_pdf, self.output_pdf, self.watermark_image, engine='serial', strict=True)
+        self.assertNotIn('failed_pages', timing)
+        self.assertEqual(len(self.watermarked_pages(self.output_pdf)), 50)
+        with mock.patch.object(watermark_pdf, 'watermark_page_under', failing_pages({7})):
+            with self.assertRaises(watermark_pdf.WatermarkPageError) as raised:
+                watermark_pdf.watermark_pdf(self.input_pdf, self.output_pdf, self.watermark_image, engine='thread', strict=True)
+        self.assertEqual(raised.exception.pages, [7])
+
+    def test_resume_from_checkpoint(self):
+        checkpoint_dir = os.path.join(self.temp_dir, 'checkpoint')
+        options = {'engine': 'process', 'max_workers': 1, 'chunk_size': 10, 'checkpoint_dir': checkpoint_dir}
+        with mock.patch.object(watermark_pdf, 'watermark_page_under', failing_pages({35})):
+            with self.assertRaises(watermark_pdf.WatermarkPageError):
+                watermark_pdf.watermark_pdf(self.input_pdf, self.output_pdf, self.watermark_image, strict=True, **options)
+        with open(os.path.join(checkpoint_dir, 'manifest.json')) as f:
+            finished = set(json.load(f)['parts'])
+        self.assertTrue({'0', '1', '2'} <= finished)
+        self.assertNotIn('3', finished)
+
+        timing = watermark_pdf.watermark_pdf(self.input_pdf, self.output_pdf, self.watermark_image, resume=True, **options)
+        self.assertEqual(timing['resumed_chunks'], len(finished))
+        self.assertEqual(self.watermarked_pages(self.output_pdf), list(range(1, 51)))
+        self.assertFalse(os.path.exists(checkpoint_dir))
+        with self.assertRaises(ValueError):
+            watermark_pdf.watermark_pdf(self.input_pdf, self.output_pdf, self.watermark_image, engine='serial', checkpoint_dir=checkpoint_dir)
+
+    def test_checkpoint_only_deletes_its_own_files(self):
+        checkpoint_dir = os.path.join(self.temp_dir, 'checkpoint')
+        os.makedirs(checkpoint_dir)
+        unrelated = os.path.join(checkpoint_dir, 'part_of_something_else.pdf')
+        with open(unrelated, 'wb') as f:
+            f.write(b'keep')
+        options = {'engine': 'process', 'max_workers': 1, 'chunk_size': 10, 'checkpoint_dir': checkpoint_dir}
+        # A directory with files but no manifest is not a checkpoint
+        with self.assertRaisesRegex(ValueError, 'not empty'):
+            watermark_pdf.watermark_pdf(self.input_pdf, self.output_pdf, self.watermark_image, **options)
+        self.assertEqual(os.listdir(checkpoint_dir), ['part_of_something_else.pdf'])
+        os.remove(unrelated)
+
+        with mock.patch.object(watermark_pdf, 'watermark_page_under', failing_pages({35})):
+            with self.assertRaises(watermark_pdf.WatermarkPageError):
+                watermark_pdf.watermark_pdf(self.input_pdf, self.output_pdf, self.watermark_image, strict=True, **options)
+        # Files added to a checkpoint directory survive a fresh start and the final cleanup
+        with open(unrelated, 'wb') as f:
+            f.write(b'keep')
+        watermark_pdf.watermark_pdf(self.input_pdf, self.output_pdf, self.watermark_image, **options)
+        self.assertEqual(os.listdir(checkpoint_dir), ['part_of_something_else.pdf'])
+        self.assertEqual(self.watermarked_pages(self.output_pdf), list(range(1, 51)))
+
+class TestPlanning(TempDirTestCase):
+    input_name = 'small.pdf'
+
+    def analysis(self, pages, **overrides):
+        analysis = {
+            'pages': pages, 'file_size': pages * 2000, 'needs_password': False, 'encrypted': False,
+            'linearized': False, 'object_streams': False, 'repaired': False,
+            'page_geometries': 1, 'image_bytes': 0, 'content_bytes': pages * 1500,
+            'forms': False, 'page_labels': False, 'attachments': False,
+        }
+        analysis.update(overrides)
+        return analysis
+
+    def plan(self, analysis, **options):
+        options.setdefault('cpu_count', 8)
+        options.setdefault('available_memory_mb', 8000)
+        return watermark_pdf.plan_watermarking(analysis, **options)
+
+    def test_preflight(self):
+        analysis = watermark_pdf.preflight(self.input_pdf)
+        self.assertEqual(analysis['pages'], 5)
+        self.assertEqual(analysis['page_geometries'], 1)
+        self.assertEqual(analysis['image_bytes'], 0)
+        self.assertGreater(analysis['content_bytes'], 0)
+        self.assertFalse(analysis['needs_password'])
+
+    def test_plan_choices(self):
+        plan = self.plan(self.analysis(10000))
+        self.assertEqual(plan['engine'], 'process')
+        self.assertGreater(plan['workers'], 1)
+        # Few pages, a single CPU, image-heavy input or an incremental save stay serial
+        self.assertEqual(self.plan(self.analysis(50))['engine'], 'serial')
+        self.assertEqual(self.plan(self.analysis(10000), cpu_count=1)['engine'], 'serial')
+        self.assertEqual(self.plan(self.analysis(10000, image_bytes=15000000))['engine'], 'serial')
+        self.assertEqual(self.plan(self.analysis(10000), incremental=True)['engine'], 'serial')
+        # Workers are limited by memory
+        self.assertEqual(self.plan(self.analysis(10000), available_memory_mb=400)['workers'], 4)
+        huge = self.plan(self.analysis(100000), cpu_count=1)
+        self.assertEqual(huge['engine'], 'stream')
+        self.assertLessEqual(huge['chunk_size'], watermark_pdf.PLAN_MAX_CHUNK_SIZE)
+        self.assertEqual(self.plan(self.analysis(50), checkpoint=True)['engine'], 'process')
+        self.assertEqual(self.plan(self.analysis(50, object_streams=True))['save_profile'], 'balanced')
+        # Given options are kept
+        kept = self.plan(self.analysis(10000), engine='thread', max_workers=3, chunk_size=7, save_profile='smallest')
+        self.assertEqual((kept['engine'], kept['workers'], kept['chunk_size'], kept['save_profile']), ('thread', 3, 7, 'smallest'))
+        self.assertTrue(self.plan(self.analysis(50, linearized=True))['warnings'])
+
+    def test_document_structure_plans_serial(self):
+        analysis = watermark_pdf.preflight(make_form_pdf(os.path.join(self.temp_dir, 'form.pdf'), 3))
+        self.assertEqual((analysis['forms'], analysis['page_labels'], analysis['attachments']), (True, True, True))
+        self.assertEqual(watermark_pdf.preflight(self.input_pdf)['forms'], False)
+        # Planned as if it had enough pages for the process engine, or for the stream engine
+        for pages in (10000, 100000):
+            analysis.update(pages=pages, file_size=pages * 2000)
+            plan = self.plan(analysis)
+            self.assertEqual((plan['engine'], plan['workers']), ('serial', 1))
+            self.assertIn('form fields, page labels, attachments', plan['reasons'][-1])
+        self.assertTrue(plan['warnings'])
+        self.assertEqual(self.plan(self.analysis(10000, page_labels=True))['engine'], 'serial')
+        # An engine or a checkpoint asked for is kept
+        self.assertEqual(self.plan(analysis, engine='stream')['engine'], 'stream')
+        self.assertEqual(self.plan(analysis, checkpoint=True)['engine'], 'process')
+
+    def test_auto_engine(self):
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        timing = watermark_pdf.watermark_pdf(self.input_pdf, output_pdf, self.watermark_image, engine='auto')
+        self.assertIn(timing['engine'], watermark_pdf.ENGINES)
+        self.assertIn('preflight', timing)
+        with fitz.open(output_pdf) as pdf:
+            self.assertTrue(all(page.get_images() for page in pdf))
+
+    def test_dry_run(self):
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        script = os.path.join(os.path.dirname(__file__), '..', 'watermark_pdf.py')
+        result = subprocess.run(
+            [sys.executable, script, self.input_pdf, output_pdf, self.watermark_image, '--dry-run'],
+            capture_output=True, text=True, check=True,
+        )
+        report = json.loads(result.stdout)
+        self.assertEqual(report['document']['pages'], 5)
+        self.assertEqual(report['plan']['engine'], 'serial')
+        self.assertFalse(os.path.exists(output_pdf))
+
+class TestDistributed(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.work_dir = os.path.join(self.temp_dir, 'work')
+
+    def assert_watermarked(self, path, pages):
+        with fitz.open(path) as pdf:
+            self.assertEqual(pdf.page_count, pages)
+            self.assertTrue(all(page.get_images() for page in pdf))
+            # The merged ranges share one image object
+            self.assertEqual(len({page.get_images()[0][0] for page in pdf}), 1)
+            self.assertIsNotNone(watermark_pdf.read_watermark_marker(pdf))
+
+    def test_local_worker_processes(self):
+        input_dir = os.path.join(self.temp_dir, 'in')
+        output_dir = os.path.join(self.temp_dir, 'out')
+        os.makedirs(input_dir)
+        for name in ('small.pdf', 'medium.pdf'):
+            shutil.copy(os.path.join(self.input_dir, name), input_dir)
+        script = os.path.join(os.path.dirname(__file__), '..', 'watermark_cluster.py')
+        result = subprocess.run(
+            [sys.executable, script, 'coordinator', self.watermark_image, '--batch', input_dir, '--output-dir', output_dir,
+             '--work-dir', self.work_dir, '--range-pages', '20', '--local-workers', '2', '--lease', '5'],
+            capture_output=True, text=True, check=True, cwd=self.temp_dir, timeout=120,
+        )
+        records = {os.path.basename(record['input']): record for record in map(json.loads, result.stdout.splitlines())}
+        self.assertEqual(records['medium.pdf']['tasks'], 3)
+        self.assertEqual(records['small.pdf']['tasks'], 1)
+        self.assertTrue(all(record['status'] == 'ok' for record in records.values()))
+        self.assert_watermarked(os.path.join(output_dir, 'medium.pdf'), 50)
+        self.assert_watermarked(os.path.join(output_dir, 'small.pdf'), 5)
+        self.assertEqual(os.listdir(os.path.join(self.work_dir, 'parts')), [])
+
+    def test_expired_lease_is_taken_over(self):
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        coordinator = watermark_cluster.Coordinator(self.work_dir, range_pages=20)
+        self.assertEqual(coordinator.submit([(os.path.join(self.input_dir, 'medium.pdf'), output_pdf)], self.watermark_image), 3)
+        coordinator.queue.update_settings(closed=True)
+        # A worker that stops renewing its lease
+        lost = coordinator.queue.claim('lost-worker', lease_seconds=0.1)
+        time.sleep(0.2)
+        self.assertEqual(watermark_cluster.run_worker(self.work_dir, 'worker', poll_interval=0.05), 3)
+        self.assertFalse(coordinator.queue.complete(lost, {'part': 'stale.pdf', 'failed_pages': []}))
+        records = coordinator.run(poll_interval=0.05)
+        self.assertEqual(records[0]['status'], 'ok')
+        self.assertEqual(records[0]['workers'], ['worker'])
+        self.assert_watermarked(output_pdf, 50)
+
+    def test_expired_leases_fail_without_workers(self):
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        coordinator = watermark_cluster.Coordinator(self.work_dir, range_pages=20, max_attempts=1)
+        coordinator.submit([(os.path.join(self.input_dir, 'medium.pdf'), output_pdf)], self.watermark_image)
+        # A worker that dies after its first claim, with nobody to take over
+        coordinator.queue.claim('lost-worker', lease_seconds=0.1, max_attempts=1)
+        records = coordinator.run(poll_interval=0.05, worker_timeout=0.5)
+        self.assertEqual(records[0]['status'], 'error')
+        self.assertIn('lease expired', records[0]['error'])
+        self.assertEqual(coordinator.queue.counts()['failed'], 3)
+        self.assertFalse(os.path.exists(output_pdf))
+
+    def test_worker_waits_for_settings(self):
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        completed = []
+        worker = threading.Thread(target=lambda: completed.append(watermark_cluster.run_worker(self.work_dir, 'early', poll_interval=0.05)))
+        worker.start()
+        time.sleep(0.2)
+        self.assertTrue(worker.is_alive())
+        coordinator = watermark_cluster.Coordinator(self.work_dir)
+        coordinator.submit([(os.path.join(self.input_dir, 'small.pdf'), output_pdf)], self.watermark_image)
+        records = coordinator.run(poll_interval=0.05)
+        worker.join(30)
+        self.assertEqual(completed, [1])
+        self.assertEqual(records[0]['status'], 'ok')
+
+    def test_submissions_keep_their_watermarks(self):
+        coordinator = watermark_cluster.Coordinator(self.work_dir, range_pages=20)
+        outputs = {opacity: os.path.join(self.temp_dir, f'{opacity}.pdf') for opacity in (0.2, 0.6)}
+        # Both submissions are queued before any worker reads a watermark
+        for opacity, output_pdf in outputs.items():
+            coordinator.submit([(os.path.join(self.input_dir, 'medium.pdf'), output_pdf)], self.watermark_image, opacity=opacity)
+        coordinator.queue.update_settings(closed=True)
+        self.assertEqual(len([name for name in os.listdir(self.work_dir) if name.startswith('watermark_')]), 2)
+        self.assertEqual(watermark_cluster.run_worker(self.work_dir, 'worker', poll_interval=0.05), 6)
+        records = coordinator.run(poll_interval=0.05)
+        self.assertEqual([record['status'] for record in records], ['ok', 'ok'])
+        max_side = watermark_pdf.watermark_pixel_size(watermark_pdf.BATCH_REFERENCE_PAGE_SIDE, watermark_pdf.DEFAULT_WATERMARK_DPI)
+        for opacity, output_pdf in outputs.items():
+            self.assert_watermarked(output_pdf, 50)
+            expected = watermark_pdf.watermark_digest(watermark_pdf.load_watermark(self.watermark_image, opacity, max_side))
+            with fitz.open(output_pdf) as pdf:
+                self.assertEqual(watermark_pdf.read_watermark_marker(pdf), expected)
+
+    def test_failing_task_fails_its_document(self):
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        coordinator = watermark_cluster.Coordinator(self.work_dir, range_pages=20, max_attempts=2)
+        coordinator.submit([(os.path.join(self.input_dir, 'medium.pdf'), output_pdf)], self.watermark_image, strict=True)
+        coordinator.queue.update_settings(closed=True)
+        with mock.patch.object(watermark_pdf, 'watermark_page_under', failing_pages({25})):
+            self.assertEqual(watermark_cluster.run_worker(self.work_dir, 'worker', poll_interval=0.05), 2)
+        self.assertEqual(coordinator.queue.counts()['failed'], 1)
+        record = coordinator.run(poll_interval=0.05)[0]
+        self.assertEqual(record['status'], 'error')
+        self.assertIn('could not be watermarked', record['error'])
+        self.assertFalse(os.path.exists(output_pdf))
+        self.assertEqual(os.listdir(os.path.join(self.work_dir, 'parts')), [])
+
+class TestFanout(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = WatermarkCache(os.path.join(self.temp_dir, 'cache'))
+
+    def output(self, name):
+        return os.path.join(self.temp_dir, name)
+
+    def render(self, path, page_number=10):
+        with fitz.open(path) as pdf:
+            return pdf[page_number].get_pixmap(dpi=30).samples
+
+    def test_variants_share_a_pass(self):
+        variants = [
+            {'output': self.output('light.pdf'), 'opacity': 0.1},
+            {'output': self.output('dark.pdf'), 'opacity': 0.5},
+            {'output': self.output('text.pdf'), 'text': 'DRAFT'},
+            {'output': self.output('copy.pdf'), 'opacity': 0.1},
+        ]
+        timing_data = watermark_pdf.watermark_fanout(self.input_pdf, variants, self.watermark_image, cache=self.cache)
+        self.assertEqual(timing_data['passes'], 2)
+        records = timing_data['variants']
+        self.assertEqual([record['pass_number'] for record in records], [0, 0, 1, 0])
+        for record in records:
+            self.assertEqual(record['output_size'], os.path.getsize(record['output']))
+        # Identical variants are saved once
+        with open(self.output('light.pdf'), 'rb') as light, open(self.output('copy.pdf'), 'rb') as copy:
+            self.assertEqual(light.read(), copy.read())
+        self.assertNotEqual(self.render(self.output('light.pdf')), self.render(self.output('dark.pdf')))
+        for name in ('light.pdf', 'dark.pdf'):
+            with fitz.open(self.output(name)) as pdf:
+                self.assertTrue(all(page.get_images() for page in pdf))
+                self.assertEqual(len({page.get_images()[0][0] for page in pdf}), 1)
+        # A replaced image gives the same output as watermarking separately
+        separate_pdf = self.output('separate.pdf')
+        watermark_pdf.watermark_pdf(self.input_pdf, separate_pdf, self.watermark_image, opacity=0.5, engine="serial", cache=self.cache)
+        self.assertEqual(self.render(self.output('dark.pdf')), self.render(separate_pdf))
+        with fitz.open(self.output('dark.pdf')) as dark, fitz.open(separate_pdf) as separate:
+            self.assertEqual(watermark_pdf.read_watermark_marker(dark), watermark_pdf.read_watermark_marker(separate))
+        with fitz.open(self.output('text.pdf')) as pdf:
+            self.assertTrue(all(pdf.get_page_xobjects(page.number) for page in pdf))
+
+    def test_in_memory_input_and_outputs(self):
+        with open(self.input_pdf, 'rb') as f:
+            data = f.read()
+        outputs = [io.BytesIO(), io.BytesIO()]
+        timing_data = watermark_pdf.watermark_fanout(
+            data, [{'output': outputs[0]}, {'output': outputs[1], 'opacity': 0.6}], self.watermark_image, cache=self.cache
+        )
+        self.assertEqual([record['output'] for record in timing_data['variants']], ["<stream>", "<stream>"])
+        for output in outputs:
+            with fitz.open(stream=output.getvalue(), filetype="pdf") as pdf:
+                self.assertEqual(pdf.page_count, 50)
+                self.assertIsNotNone(watermark_pdf.read_watermark_marker(pdf))
+
+    def test_failed_pages_are_reported_per_variant(self):
+        variants = [{'output': self.output('a.pdf')}, {'output': self.output('b.pdf'), 'opacity': 0.4}]
+        with mock.patch.object(watermark_pdf, 'watermark_page_under', failing_pages({7})):
+            timing_data = watermark_pdf.watermark_fanout(self.input_pdf, variants, self.watermark_image, cache=self.cache)
+        self.assertEqual([record['failed_pages'] for record in timing_data['variants']], [[7], [7]])
+        with fitz.open(self.output('b.pdf')) as pdf:
+            self.assertIsNone(watermark_pdf.read_watermark_marker(pdf))
+            self.assertEqual(sum(1 for page in pdf if page.get_images()), 49)
+
+    def test_variants_after_all_pages_failed(self):
+        variants = [{'output': self.output(f'{opacity}.pdf'), 'opacity': opacity} for opacity in (0.2, 0.4, 0.6)]
+        # Every page fails once, that is for the first variant only
+        with mock.patch.object(watermark_pdf, 'watermark_page_under', failing_pages(set(range(1, 51)), times=1)):
+            timing_data = watermark_pdf.watermark_fanout(self.input_pdf, variants, self.watermark_image, cache=self.cache)
+        records = timing_data['variants']
+        self.assertEqual(records[0]['failed_pages'], list(range(1, 51)))
+        self.assertNotIn('failed_pages', records[1])
+        self.assertNotIn('failed_pages', records[2])
+        with fitz.open(self.output('0.2.pdf')) as pdf:
+            self.assertFalse(any(page.get_images() for page in pdf))
+        for opacity in (0.4, 0.6):
+            separate_pdf = self.output(f'separate_{opacity}.pdf')
+            watermark_pdf.watermark_pdf(self.input_pdf, separate_pdf, self.watermark_image, opacity=opacity, engine='serial', cache=self.cache)
+            with fitz.open(self.output(f'{opacity}.pdf')) as pdf:
+                self.assertTrue(all(page.get_images() for page in pdf))
+            self.assertEqual(self.render(self.output(f'{opacity}.pdf')), self.render(separate_pdf))
+
+    def test_command_line_manifest(self):
+        manifest = self.output('variants.jsonl')
+        with open(manifest, 'w') as f:
+            f.write(json.dumps({'output': 'out/a.pdf', 'opacity': 0.3}) + "\n")
+            f.write(json.dumps({'output': 'out/b.pdf', 'text': 'COPY', 'rotation': 45}) + "\n")
+        script = os.path.join(os.path.dirname(__file__), '..', 'watermark_pdf.py')
+        result = subprocess.run(
+            [sys.executable, script, self.input_pdf, self.watermark_image, '--fanout', manifest],
+            capture_output=True, text=True, check=True, cwd=self.temp_dir, timeout=120,
+        )
+        timing_data = json.loads(result.stdout)
+        self.assertEqual(timing_data['passes'], 2)
+        for name in ('a.pdf', 'b.pdf'):
+            with fitz.open(self.output(os.path.join('out', name))) as pdf:
+                self.assertEqual(pdf.page_count, 50)
+        with open(manifest, 'a') as f:
+            f.write(json.dumps({'output': 'c.pdf', 'dpi': 72}) + "\n")
+        result = subprocess.run(
+            [sys.executable, script, self.input_pdf, self.watermark_image, '--fanout', manifest],
+            capture_output=True, text=True, cwd=self.temp_dir, timeout=120,
+        )
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("may only set", result.stderr)
+
+class TestIncrementalSave(TempDirTestCase):
+    def watermark(self, engine, incremental, output_pdf=None):
+        output_pdf = output_pdf or os.path.join(self.temp_dir, f'{engine}_{incremental}.pdf')
+        with fitz.open(self.input_pdf) as pdf:
+            max_side = watermark_pdf.watermark_target_size(pdf, watermark_pdf.DEFAULT_WATERMARK_DPI)
+        processed = watermark_pdf.prepare_watermark(self.watermark_image, 0.3, max_side=max_side)
+        timing = watermark_pdf.watermark_document(self.input_pdf, output_pdf, processed, engine=engine, chunk_size=20, incremental=incremental)
+        return output_pdf, timing
+
+    def test_appends_to_a_copy_of_the_input(self):
+        with open(self.input_pdf, 'rb') as f:
+            original = f.read()
+        for engine in ('serial', 'thread', 'stream'):
+            output_pdf, timing = self.watermark(engine, True)
+            self.assertEqual(timing['save_mode'], 'incremental')
+            with open(output_pdf, 'rb') as f:
+                self.assertTrue(f.read().startswith(original))
+            with fitz.open(output_pdf) as pdf:
+                self.assertEqual(pdf.page_count, 50)
+                self.assertTrue(all(page.get_images() for page in pdf))
+                self.assertEqual(len({image[0] for page in pdf for image in page.get_images()}), 1)
+
+    def test_writes_less_than_a_full_rewrite(self):
+        _, full = self.watermark('serial', False)
+        _, incremental = self.watermark('serial', True)
+        self.assertEqual(full['save_mode'], 'full')
+        self.assertLess(incremental['bytes_written'], full['bytes_written'])
+        self.assertIn('saving', incremental)
+
+    def test_in_place(self):
+        output_pdf = os.path.join(self.temp_dir, 'in_place.pdf')
+        shutil.copyfile(self.input_pdf, output_pdf)
+        self.input_pdf = output_pdf
+        _, timing = self.watermark('serial', True, output_pdf)
+        self.assertNotIn('copying', timing)
+        with fitz.open(output_pdf) as pdf:
+            self.assertTrue(all(page.get_images() for page in pdf))
+
+    def test_process_engine_rejected(self):
+        with self.assertRaises(ValueError):
+            self.watermark('process', True)
+
+class TestResultIndex(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index = ResultIndex(os.path.join(self.temp_dir, 'index.sqlite3'))
+
+    def run_watermark(self, output_name, input_pdf=None, **options):
+        output_pdf = os.path.join(self.temp_dir, output_name)
+        options.setdefault('index', self.index)
+        return output_pdf, watermark_pdf.watermark_pdf(input_pdf or self.input_pdf, output_pdf, self.watermark_image, engine='serial', **options)
+
+    def test_repeated_run_copies_indexed_output(self):
+        first_pdf, first = self.run_watermark('first.pdf')
+        self.assertNotIn('skipped', first)
+        second_pdf, second = self.run_watermark('second.pdf')
+        self.assertEqual(second['skipped'], 'indexed')
+        self.assertEqual(second['reused_output'], first_pdf)
+        self.assertEqual(second['reuse'], 'copied')
+        self.assertFalse(os.path.samefile(first_pdf, second_pdf))
+        with open(first_pdf, 'rb') as first_file, open(second_pdf, 'rb') as second_file:
+            self.assertEqual(first_file.read(), second_file.read())
+        # Other settings make a different run
+        _, third = self.run_watermark('third.pdf', save_profile='balanced')
+        self.assertNotIn('skipped', third)
+        # Rewriting a reused output must leave the indexed result alone
+        with open(first_pdf, 'rb') as f:
+            first_bytes = f.read()
+        self.run_watermark('second.pdf', force=True)
+        with open(first_pdf, 'rb') as f:
+            self.assertEqual(f.read(), first_bytes)
+
+    def test_failed_run_keeps_existing_output(self):
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        with open(output_pdf, 'wb') as f:
+            f.write(b'keep')
+        for engine in ('serial', 'stream', 'process'):
+            with self.subTest(engine=engine), mock.patch('watermark_pdf.watermark_page_under', failing_pages({3})):
+                with self.assertRaises(watermark_pdf.WatermarkPageError):
+                    watermark_pdf.watermark_pdf(self.input_pdf, output_pdf, self.watermark_image, engine=engine, max_workers=2, strict=True)
+                with open(output_pdf, 'rb') as f:
+                    self.assertEqual(f.read(), b'keep')
+                self.assertEqual(sorted(os.listdir(self.temp_dir)), ['index.sqlite3', 'out.pdf'])
+
+    def test_changed_output_is_not_reused(self):
+        first_pdf, _ = self.run_watermark('first.pdf')
+        with open(first_pdf, 'ab') as f:
+            f.write(b'\n')
+        _, second = self.run_watermark('second.pdf')
+        self.assertNotIn('skipped', second)
+
+    def test_already_watermarked_input_is_skipped(self):
+        first_pdf, _ = self.run_watermark('first.pdf', index=None)
+        with fitz.open(first_pdf) as pdf:
+            self.assertIsNotNone(watermark_pdf.read_watermark_marker(pdf))
+        again_pdf, again = self.run_watermark('again.pdf', input_pdf=first_pdf, index=None)
+        self.assertEqual(again['skipped'], 'already_watermarked')
+        self.assertEqual(again['pages'], 50)
+        self.assertEqual(again['reuse'], 'copied')
+        self.assertEqual(os.path.getsize(again_pdf), os.path.getsize(first_pdf))
+        # A different watermark is still applied
+        _, other = self.run_watermark('other.pdf', input_pdf=first_pdf, index=None, opacity=0.5)
+        self.assertNotIn('skipped', other)
+        _, forced = self.run_watermark('forced.pdf', input_pdf=first_pdf, index=None, force=True)
+        self.assertNotIn('skipped', forced)
+
+    def test_eviction(self):
+        index = ResultIndex(os.path.join(self.temp_dir, 'small.sqlite3'), max_entries=2)
+        for number in range(3):
+            output_pdf = os.path.join(self.temp_dir, f'{number}.pdf')
+            shutil.copyfile(self.input_pdf, output_pdf)
+            index.record(f'key{number}', output_pdf)
+            time.sleep(0.01)
+        self.assertEqual(len(index), 2)
+        self.assertIsNone(index.lookup('key0'))
+        self.assertEqual(index.lookup('key2'), os.path.join(self.temp_dir, '2.pdf'))
+
+class TestInMemoryIO(TempDirTestCase):
+    input_name = 'small.pdf'
+
+    def setUp(self):
+        super().setUp()
+        with open(self.input_pdf, 'rb') as f:
+            self.data = f.read()
+
+    def assert_watermarked(self, data):
+        with fitz.open(stream=data, filetype='pdf') as pdf:
+            self.assertEqual(pdf.page_count, 5)
+            self.assertTrue(all(page.get_images() for page in pdf))
+            self.assertIsNotNone(watermark_pdf.read_watermark_marker(pdf))
+
+    def test_buffer_and_file_object_sources(self):
+        mapped = open(self.input_pdf, 'rb')
+        self.addCleanup(mapped.close)
+        sources = [self.data, bytearray(self.data), memoryview(self.data), io.BytesIO(self.data), mapped]
+        for source in sources:
+            with self.subTest(source=type(source).__name__):
+                output = io.BytesIO()
+                timing = watermark_pdf.watermark_pdf(source, output, self.watermark_image, engine='process')
+                # File-based engines fall back to the serial engine
+                self.assertEqual(timing['engine'], 'serial')
+                self.assert_watermarked(output.getvalue())
+
+    def test_memory_source_to_path_and_already_watermarked(self):
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        timing = watermark_pdf.watermark_pdf(self.data, output_pdf, self.watermark_image, engine='thread', incremental=True)
+        self.assertEqual(timing['output_size'], os.path.getsize(output_pdf))
+        with open(output_pdf, 'rb') as f:
+            watermarked = f.read()
+        self.assert_watermarked(watermarked)
+        again = io.BytesIO()
+        timing = watermark_pdf.watermark_pdf(watermarked, again, self.watermark_image)
+        self.assertEqual(timing['skipped'], 'already_watermarked')
+        with fitz.open(stream=again.getvalue(), filetype='pdf') as pdf:
+            self.assertEqual(len(pdf[0].get_images()), 1)
+
+    def test_cli_pipes_stdin_to_stdout(self):
+        script = os.path.join(os.path.dirname(__file__), '..', 'watermark_pdf.py')
+        result = subprocess.run(
+            [sys.executable, script, '-', '-', self.watermark_image, '--engine', 'thread'],
+            input=self.data, capture_output=True, check=True, cwd=self.temp_dir
+        )
+        self.assert_watermarked(result.stdout)
+        # Timing data goes to stderr when the PDF is written to stdout
+        timing = json.loads(result.stderr.decode().strip().splitlines()[-1])
+        self.assertEqual(timing['pages'], 5)
+        self.assertEqual(os.listdir(self.temp_dir), ['watermark_log.log'])
+
+class TestLibraryAPI(TempDirTestCase):
+    input_name = 'small.pdf'
+
+    def test_import_defers_heavy_modules(self):
+        code = "import sys, pdf_watermarker; print(sorted(m for m in ('fitz', 'pymupdf', 'PIL', 'psutil', 'watermark_pdf') if m in sys.modules))"
+        result = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True, check=True,
+            cwd=os.path.join(os.path.dirname(__file__), '..')
+        )
+        self.assertEqual(result.stdout.strip(), '[]')
+
+    @unittest.skipIf(tomllib is None, "tomllib needs Python 3.11")
+    def test_packaged_modules_are_self_contained(self):
+        repo_root = os.path.join(os.path.dirname(__file__), '..')
+        with open(os.path.join(repo_root, 'pyproject.toml'), 'rb') as f:
+            setuptools_config = tomllib.load(f)['tool']['setuptools']
+        # Only what the packaging config ships, outside the repository
+        site_dir = os.path.join(self.temp_dir, 'site')
+        for package in setuptools_config['packages']:
+            shutil.copytree(os.path.join(repo_root, package), os.path.join(site_dir, package), ignore=shutil.ignore_patterns('__pycache__'))
+        for module in setuptools_config['py-modules']:
+            shutil.copy(os.path.join(repo_root, f'{module}.py'), site_dir)
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        code = (
+            "import sys, pdf_watermarker; "
+            f"result = pdf_watermarker.Engine(engine='serial').run(pdf_watermarker.WatermarkJob({self.input_pdf!r}, {output_pdf!r}, {self.watermark_image!r})); "
+            "print(result.pages, sys.modules['watermark_pdf'].__file__)"
+        )
+        env = {name: value for name, value in os.environ.items() if name != 'PYTHONPATH'}
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=site_dir, env=env)
+        pages, module_path = result.stdout.split()
+        self.assertEqual(pages, '5')
+        self.assertEqual(os.path.dirname(module_path), site_dir)
+
+    def test_engine_returns_result_without_printing(self):
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        job = pdf_watermarker.WatermarkJob(self.input_pdf, output_pdf, self.watermark_image, opacity=0.3)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            result = pdf_watermarker.Engine(engine='thread', max_workers=2).run(job)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIsInstance(result, pdf_watermarker.WatermarkResult)
+        self.assertEqual(result.pages, 5)
+        self.assertEqual(result.output_size, os.path.getsize(output_pdf))
+        self.assertIsNone(result.skipped)
+        self.assertEqual(result.to_dict()['engine'], 'thread')
+        # The same job again finds the watermark already in place
+        again = pdf_watermarker.Engine(engine='serial').run(pdf_watermarker.WatermarkJob(output_pdf, os.path.join(self.temp_dir, 'again.pdf'), self.watermark_image, opacity=0.3))
+        self.assertEqual(again.skipped, 'already_watermarked')
+
+    def test_auto_engine_chooses_save_profile(self):
+        # Object streams in the input make the planner choose the balanced profile
+        input_pdf = os.path.join(self.temp_dir, 'objstms.pdf')
+        with fitz.open(self.input_pdf) as pdf:
+            pdf.save(input_pdf, use_objstms=1)
+        job = pdf_watermarker.WatermarkJob(input_pdf, os.path.join(self.temp_dir, 'out.pdf'), self.watermark_image)
+        with mock.patch.object(watermark_pdf, 'save_document', wraps=watermark_pdf.save_document) as save_document:
+            pdf_watermarker.Engine().run(job)
+        self.assertEqual(save_document.call_args_list[0].args[2], 'balanced')
+
+    def test_text_job_in_memory(self):
+        with open(self.input_pdf, 'rb') as f:
+            data = f.read()
+        output = io.BytesIO()
+        results = pdf_watermarker.Engine(engine='serial').run_all([pdf_watermarker.WatermarkJob(data, output, text='DRAFT', rotation=45)])
+        self.assertEqual(results[0].pages, 5)
+        with fitz.open(stream=output.getvalue(), filetype='pdf') as pdf:
+            self.assertTrue(pdf[0].get_xobjects())
+        with self.assertRaises(ValueError):
+            pdf_watermarker.WatermarkJob(self.input_pdf, 'out.pdf')
+
+class TestSaveProfiles(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with fitz.open(self.input_pdf) as pdf:
+            max_side = watermark_pdf.watermark_target_size(pdf, watermark_pdf.DEFAULT_WATERMARK_DPI)
+        self.processed = watermark_pdf.prepare_watermark(self.watermark_image, 0.3, max_side=max_side)
+
+    def watermark(self, engine, save_profile):
+        output_pdf = os.path.join(self.temp_dir, f'{engine}_{save_profile}.pdf')
+        timing = watermark_pdf.watermark_document(self.input_pdf, output_pdf, self.processed, max_workers=2, engine=engine, chunk_size=20, save_profile=save_profile)
+        with fitz.open(output_pdf) as pdf:
+            self.assertEqual(pdf.page_count, 50)
+            self.assertEqual(len({image[0] for page in pdf for image in page.get_images()}), 1)
+        self.assertEqual(timing['save_profile'], save_profile)
+        self.assertEqual(timing['output_size'], os.path.getsize(output_pdf))
+        self.assertGreaterEqual(timing['saving'], 0)
+        return timing
+
+    def test_profiles_trade_size_for_time(self):
+        for engine in ('serial', 'process', 'stream'):
+            sizes = {profile: self.watermark(engine, profile)['output_size'] for profile in watermark_pdf.SAVE_PROFILES}
+            self.assertLess(sizes['balanced'], sizes['fast'])
+            self.assertLessEqual(sizes['smallest'], sizes['balanced'])
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            self.watermark('serial', 'tiny')
+
+class TestStreamingMemory(TempDirTestCase):
+    def make_pdf(self, pages):
+        path = os.path.join(self.temp_dir, f'{pages}.pdf')
+        with fitz.open() as pdf:
+            for i in range(pages):
+                page = pdf.new_page()
+                buffer = io.BytesIO()
+                Image.frombytes('RGB', (64, 64), os.urandom(64 * 64 * 3)).save(buffer, format='PNG')
+                page.insert_image(fitz.Rect(72, 72, 272, 272), stream=buffer.getvalue())
+                page.insert_text((72, 320), f'Page {i + 1}')
+            pdf.save(path)
+        return path
+
+    def peak_rss(self, pages):
+        input_pdf = self.make_pdf(pages)
+        output_pdf = os.path.join(self.temp_dir, f'{pages}_out.pdf')
+        script = os.path.join(os.path.dirname(__file__), '..', 'watermark_pdf.py')
+        result = subprocess.run(
+            [sys.executable, script, input_pdf, output_pdf, self.watermark_image, '--engine', 'stream', '--chunk-size', '100'],
+            capture_output=True, text=True, check=True
+        )
+        with fitz.open(output_pdf) as pdf:
+            self.assertEqual(pdf.page_count, pages)
+        return json.loads(result.stdout.strip().splitlines()[-1])['peak_rss_mb'], os.path.getsize(input_pdf)
+
+    def test_peak_memory_bounded_by_chunk_size(self):
+        small_rss, small_size = self.peak_rss(200)
+        large_rss, large_size = self.peak_rss(1600)
+        input_growth = (large_size - small_size) / (1024 * 1024)
+        # Eight times the pages may only cost a fraction of the extra input size
+        self.assertLess(large_rss - small_rss, input_growth / 2)
+
+class TestDaemon(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.address = f"unix:{os.path.join(cls.temp_dir, 'daemon.sock')}"
+        cls.executor = watermark_daemon.start_workers(1)
+        cls.server = watermark_daemon.create_server(cls.address, cls.executor, 1)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.client = WatermarkClient(cls.address)
+        cls.input_pdf = os.path.join(TEST_PDFS_DIR, 'medium.pdf')
+        cls.watermark_image = WATERMARK_IMAGE
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.executor.shutdown()
+        shutil.rmtree(cls.temp_dir)
+
+    def test_health(self):
+        self.assertTrue(self.client.is_available())
+        self.assertEqual(self.client.health()['workers'], 1)
+        self.assertFalse(WatermarkClient(f"unix:{os.path.join(self.temp_dir, 'missing.sock')}").is_available())
+
+    def test_path_job(self):
+        output_pdf = os.path.join(self.temp_dir, 'job.pdf')
+        record = self.client.submit(self.input_pdf, output_pdf, self.watermark_image, opacity=0.3, engine='stream', chunk_size=20)
+        self.assertEqual(record['status'], 'ok')
+        self.assertEqual(record['pages'], 50)
+        with fitz.open(output_pdf) as pdf:
+            self.assertTrue(all(page.get_images() for page in pdf))
+
+    def test_streamed_upload(self):
+        output = io.BytesIO()
+        with open(self.input_pdf, 'rb') as source:
+            record = self.client.watermark_stream(source, output, text='DRAFT')
+        self.assertEqual(record['status'], 'ok')
+        with fitz.open(stream=output.getvalue(), filetype='pdf') as pdf:
+            self.assertEqual(pdf.page_count, 50)
+            self.assertIn('DRAFT', pdf[0].get_text())
+
+    def test_default_engine_job(self):
+        output_pdf = os.path.join(self.temp_dir, 'default.pdf')
+        # parent_script.py sends its default engine, "auto"
+        record = parent_script.watermark_with_daemon(self.address, self.input_pdf, output_pdf, self.watermark_image)
+        self.assertEqual(record['status'], 'ok')
+        self.assertIn(record['engine'], ('serial', 'stream'))
+        with fitz.open(output_pdf) as pdf:
+            self.assertTrue(all(page.get_images() for page in pdf))
+
+    def test_truncated_upload_is_rejected(self):
+        jobs_served = self.client.health()['jobs_served']
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.address[len('unix:'):])
+            connection.sendall(
+                b"POST /watermark?text=DRAFT HTTP/1.1\r\nHost: localhost\r\n"
+                b"Content-Length: 100000\r\n\r\n%PDF-1.7\n"
+            )
+            connection.shutdown(socket.SHUT_WR)
+            response = connection.makefile('rb').read()
+        self.assertTrue(response.startswith(b"HTTP/1.1 400"))
+        self.assertIn(b"short of its Content-Length", response)
+        self.assertEqual(self.client.health()['jobs_served'], jobs_served)
+
+    def test_existing_output_needs_overwrite(self):
+        output_pdf = os.path.join(self.temp_dir, 'existing.pdf')
+        with open(output_pdf, 'wb') as f:
+            f.write(b'keep')
+        with self.assertRaises(DaemonError) as raised:
+            self.client.submit(self.input_pdf, output_pdf, self.watermark_image)
+        self.assertEqual(raised.exception.status, 400)
+        with open(output_pdf, 'rb') as f:
+            self.assertEqual(f.read(), b'keep')
+        record = self.client.submit(self.input_pdf, output_pdf, self.watermark_image, overwrite=True)
+        self.assertEqual(record['status'], 'ok')
+
+    def test_paths_confined_to_roots(self):
+        roots = (os.path.realpath(self.temp_dir),)
+        job = watermark_daemon.parse_job({'input': os.path.join(self.temp_dir, 'in.pdf'), 'output': os.path.join(self.temp_dir, 'out.pdf'), 'text': 'DRAFT'})
+        watermark_daemon.check_job_paths(job, roots)
+        for name, path in (('input', self.input_pdf), ('output', os.path.join(self.temp_dir, '..', 'out.pdf'))):
+            with self.assertRaisesRegex(ValueError, f"The {name} path"):
+                watermark_daemon.check_job_paths(dict(job, **{name: path}), roots)
+        with self.assertRaisesRegex(ValueError, "The watermark path"):
+            watermark_daemon.check_job_paths(dict(job, watermark=self.watermark_image), roots)
+        # Font files are confined too; base-14 font names are not paths
+        with self.assertRaisesRegex(ValueError, "The font path"):
+            watermark_daemon.check_job_paths(dict(job, font=self.input_pdf), roots)
+        watermark_daemon.check_job_paths(dict(job, font='helv'), roots)
+
+    def test_upload_paths_confined_to_roots(self):
+        root = os.path.join(self.temp_dir, 'root')
+        os.makedirs(root, exist_ok=True)
+        inside = shutil.copy(self.watermark_image, os.path.join(root, 'watermark.png'))
+        address = f"unix:{os.path.join(self.temp_dir, 'confined.sock')}"
+        server = watermark_daemon.create_server(address, self.executor, 1, roots=(root,))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        client = WatermarkClient(address)
+        with open(self.input_pdf, 'rb') as f:
+            data = f.read()
+        # The uploaded input and private output are outside the roots; the files named by options may not be
+        for options in ({'watermark': self.watermark_image}, {'text': 'DRAFT', 'font': self.input_pdf}):
+            with self.subTest(options=options), self.assertRaises(DaemonError) as raised:
+                client.watermark_stream(io.BytesIO(data), io.BytesIO(), **options)
+            self.assertEqual(raised.exception.status, 400)
+        output = io.BytesIO()
+        record = client.watermark_stream(io.BytesIO(data), output, watermark=inside)
+        self.assertEqual(record['status'], 'ok')
+        with fitz.open(stream=output.getvalue(), filetype='pdf') as pdf:
+            self.assertTrue(all(page.get_images() for page in pdf))
+
+    def test_rejected_and_failed_jobs(self):
+        with self.assertRaises(DaemonError) as raised:
+            self.client.submit(self.input_pdf, 'out.pdf', self.watermark_image, engine='process')
+        self.assertEqual(raised.exception.status, 400)
+        with self.assertRaises(DaemonError) as raised:
+            self.client.submit(os.path.join(self.temp_dir, 'missing.pdf'), 'out.pdf', self.watermark_image)
+        self.assertEqual(raised.exception.status, 500)
+        self.assertEqual(raised.exception.record['status'], 'error')
+
+class TestEventStream(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.script = os.path.join(os.path.dirname(__file__), '..', 'watermark_pdf.py')
+
+    def run_with_events(self, engine):
+        events_path = os.path.join(self.temp_dir, f'{engine}.ndjson')
+        output_pdf = os.path.join(self.temp_dir, f'{engine}.pdf')
+        result = subprocess.run(
+            [sys.executable, self.script, self.input_pdf, output_pdf, self.watermark_image, '--engine', engine, '--events', events_path],
+            capture_output=True, text=True, check=True
+        )
+        with open(events_path) as f:
+            events = [json.loads(line) for line in f]
+        return events, json.loads(result.stdout.strip().splitlines()[-1])
+
+    def test_progress_stages_and_result(self):
+        for engine in ('serial', 'thread', 'process', 'stream'):
+            events, timing_data = self.run_with_events(engine)
+            kinds = [event['event'] for event in events]
+            self.assertEqual(kinds[-1], 'result')
+            self.assertIn('resources', kinds)
+            self.assertEqual(events[kinds.index('start')]['pages'], 50)
+            progress = [event for event in events if event['event'] == 'progress']
+            self.assertEqual(progress[-1]['done'], 50)
+            self.assertEqual(sum(event['last_page'] - event['first_page'] + 1 for event in progress), 50)
+            self.assertTrue(all(event['pages_per_sec'] > 0 for event in progress))
+            stages = {event['stage'] for event in events if event['event'] == 'stage'}
+            self.assertTrue({'watermark_preparation', 'watermarking', 'saving'} <= stages)
+            result = {key: value for key, value in events[-1].items() if key not in ('event', 'time')}
+            self.assertEqual(result, timing_data)
+
+    def test_parent_script_relays_events(self):
+        events_path = os.path.join(self.temp_dir, 'parent.ndjson')
+        parent_script = os.path.join(os.path.dirname(__file__), '..', 'parent_script.py')
+        result = subprocess.run(
+            [sys.executable, parent_script, self.input_pdf, os.path.join(self.temp_dir, 'parent.pdf'), self.watermark_image, '--engine', 'serial', '--events', events_path],
+            capture_output=True, text=True, check=True
+        )
+        timing_data = json.loads(result.stdout.strip().splitlines()[-1])
+        with open(events_path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(events[-1]['total_time'], timing_data['total_time'])
+        self.assertIn('parent_total_time', timing_data)
+
+class TestStageMetrics(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+
+    def test_histogram_percentiles(self):
+        histogram = watermark_metrics.Histogram()
+        for millisecond in range(1, 101):
+            histogram.observe(millisecond / 1000)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.percentile(0.5), 0.05, delta=0.05 * 0.2)
+        self.assertAlmostEqual(histogram.percentile(0.99), 0.099, delta=0.099 * 0.2)
+        self.assertEqual(histogram.percentile(1), 0.1)
+        other = watermark_metrics.Histogram()
+        other.observe(2.0)
+        histogram.merge(other)
+        self.assertEqual((histogram.count, histogram.max), (101, 2.0))
+
+    def test_exports(self):
+        metrics = watermark_metrics.StageMetrics()
+        for seconds in (0.001, 0.002, 0.004):
+            metrics.observe('page', seconds)
+        metrics.peak_rss_mb = 10
+        lines = metrics.to_prometheus().splitlines()
+        self.assertIn('watermark_stage_seconds_bucket{stage="page",le="+Inf"} 3', lines)
+        self.assertIn('watermark_stage_seconds_count{stage="page"} 3', lines)
+        self.assertIn(f'watermark_peak_rss_bytes{{process="main"}} {10 * 1024 * 1024}', lines)
+        buckets = [int(line.rsplit(' ', 1)[1]) for line in lines if line.startswith('watermark_stage_seconds_bucket')]
+        self.assertEqual(buckets, sorted(buckets))
+        data = json.loads(json.dumps(metrics.to_dict()))
+        self.assertEqual(sum(count for _, count in data['stages']['page']['buckets']), 3)
+
+    def test_timing_data_has_stage_metrics(self):
+        for engine in ('serial', 'process'):
+            with self.subTest(engine=engine):
+                metrics = watermark_metrics.StageMetrics()
+                timing = watermark_pdf.watermark_pdf(self.input_pdf, self.output_pdf, self.watermark_image, engine=engine, max_workers=2, metrics=metrics)
+                stages = timing['metrics']['stages']
+                self.assertEqual(stages['page']['count'], 50)
+                self.assertLessEqual(stages['page']['p50'], stages['page']['p99'])
+                self.assertTrue({'open', 'prepare', 'save'} <= set(stages))
+                self.assertGreater(timing['metrics']['peak_rss_mb'], 0)
+                self.assertEqual(metrics.histograms['page'].count, 50)
+        # Pages of the process engine are timed in the workers
+        self.assertIn('merge', stages)
+        self.assertGreater(timing['metrics']['worker_peak_rss_mb'], 0)
+        self.assertIsNone(watermark_metrics.current_metrics())
+
+    def test_cli_exports(self):
+        script = os.path.join(os.path.dirname(__file__), '..', 'watermark_pdf.py')
+        metrics_path = os.path.join(self.temp_dir, 'metrics.prom')
+        samples_path = os.path.join(self.temp_dir, 'samples.txt')
+        subprocess.run(
+            [sys.executable, script, self.input_pdf, self.output_pdf, self.watermark_image, '--engine', 'serial',
+             '--metrics', metrics_path, '--sample-profile', samples_path, '--sample-interval', '1'],
+            capture_output=True, text=True, check=True, cwd=self.temp_dir,
+        )
+        with open(metrics_path) as f:
+            self.assertIn('watermark_stage_seconds_count{stage="page"} 50', f.read())
+        with open(samples_path) as f:
+            stacks = f.read().splitlines()
+        self.assertTrue(stacks)
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in stacks))
+
+class TestLogging(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log_file = os.path.join(self.temp_dir, 'watermark.log')
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        self.addCleanup(root.setLevel, level)
+        self.addCleanup(setattr, root, 'handlers', handlers)
+        self.addCleanup(watermark_pdf.stop_logging)
+
+    def read_log(self, listener):
+        watermark_pdf.stop_logging()
+        for handler in listener.handlers:
+            handler.close()
+        with open(self.log_file) as f:
+            return f.read()
+
+    def test_setup_logging_is_idempotent(self):
+        root = logging.getLogger()
+        handler_count = len(root.handlers)
+        listener = watermark_pdf.setup_logging(self.log_file)
+        self.assertIs(watermark_pdf.setup_logging(self.log_file), listener)
+        self.assertEqual(len(root.handlers), handler_count + 1)
+        logging.info("logged once")
+        self.assertEqual(self.read_log(listener).count("logged once"), 1)
+
+    def test_worker_process_records_reach_the_log(self):
+        listener = watermark_pdf.setup_logging(self.log_file)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            executor.submit(logging.warning, "from worker %d", 1).result()
+        time.sleep(0.5)
+        self.assertIn("WARNING - from worker 1", self.read_log(listener))
+
+    def test_progress_logging_is_aggregated(self):
+        progress = watermark_pdf.ProgressReporter(250)
+        with self.assertLogs(level='INFO') as logs:
+            for page in range(1, 251):
+                progress.update(page, page, page)
+        self.assertEqual(logs.output, [
+            'INFO:root:Watermarked 100/250 pages',
+            'INFO:root:Watermarked 200/250 pages',
+            'INFO:root:Watermarked 250/250 pages',
+        ])
+
+class TestPageBudget(unittest.IsolatedAsyncioTestCase):
+    async def test_interactive_waiters_served_first(self):
+        budget = watermark_pdf.PageBudget(10)
+        self.assertEqual(await budget.acquire(10), 10)
+        order = []
+
+        async def waiter(name, priority):
+            pages = await budget.acquire(6, priority)
+            order.append(name)
+            budget.release(pages)
+
+        tasks = [asyncio.create_task(waiter('bulk', watermark_pdf.PRIORITY_BULK))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(waiter('interactive', watermark_pdf.PRIORITY_INTERACTIVE)))
+        await asyncio.sleep(0)
+        budget.release(10)
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ['interactive', 'bulk'])
+        self.assertEqual(budget.available, 10)
+
+    async def test_requests_capped_at_budget(self):
+        budget = watermark_pdf.PageBudget(4)
+        self.assertEqual(await budget.acquire(100), 4)
+
+    async def test_cancelled_waiter_releases_its_place(self):
+        budget = watermark_pdf.PageBudget(4)
+        await budget.acquire(4)
+        waiter = asyncio.create_task(budget.acquire(4))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        budget.release(4)
+        self.assertEqual(budget.available, 4)
+
+class TestJobScheduler(TempDirMixin, unittest.IsolatedAsyncioTestCase):
+
+    def paths(self, name, output_name=None):
+        return os.path.join(self.input_dir, f'{name}.pdf'), os.path.join(self.temp_dir, f'{output_name or name}.pdf')
+
+    async def test_runs_jobs_concurrently(self):
+        async with watermark_pdf.JobScheduler(max_workers=2, page_budget=40, chunk_size=15) as scheduler:
+            jobs = [await scheduler.submit(*self.paths(name), self.watermark_image) for name in ('small', 'medium', 'large')]
+        records = [await job.wait() for job in jobs]
+        self.assertEqual([record['status'] for record in records], ['ok'] * 3)
+        self.assertEqual([record['pages'] for record in records], [5, 50, 200])
+        for job in jobs:
+            with fitz.open(job.output_pdf_path) as pdf:
+                self.assertTrue(all(page.get_images() for page in pdf))
+                self.assertEqual(len({image[0] for page in pdf for image in page.get_images()}), 1)
+
+    async def test_interactive_job_overtakes_bulk_job(self):
+        finished = []
+        async with watermark_pdf.JobScheduler(max_workers=1, page_budget=10, chunk_size=10) as scheduler:
+            bulk = await scheduler.submit(*self.paths('large'), self.watermark_image)
+            while not bulk.pages_done:
+                await asyncio.sleep(0.01)
+            interactive = await scheduler.submit(*self.paths('small'), self.watermark_image, priority=watermark_pdf.PRIORITY_INTERACTIVE)
+            for job in asyncio.as_completed([bulk.wait(), interactive.wait()]):
+                finished.append((await job)['input'])
+        self.assertEqual(finished, [interactive.input_pdf_path, bulk.input_pdf_path])
+
+    async def test_cancel_running_and_queued_jobs(self):
+        async with watermark_pdf.JobScheduler(max_workers=1, page_budget=10, chunk_size=10, max_active_jobs=1) as scheduler:
+            running = await scheduler.submit(*self.paths('large'), self.watermark_image)
+            queued = await scheduler.submit(*self.paths('medium'), self.watermark_image)
+            while not running.pages_done:
+                await asyncio.sleep(0.01)
+            running.cancel()
+            queued.cancel()
+        self.assertEqual((await running.wait())['status'], 'cancelled')
+        self.assertEqual((await queued.wait())['status'], 'cancelled')
+        self.assertFalse(os.path.exists(running.output_pdf_path))
+        self.assertFalse(os.path.exists(queued.output_pdf_path))
+
+    async def test_bounded_queue(self):
+        async with watermark_pdf.JobScheduler(max_workers=1, max_queued=1, max_active_jobs=1) as scheduler:
+            first = scheduler.submit_nowait(*self.paths('small', 'first'), self.watermark_image)
+            await asyncio.sleep(0.05)
+            scheduler.submit_nowait(*self.paths('small', 'second'), self.watermark_image)
+            with self.assertRaises(asyncio.QueueFull):
+                scheduler.submit_nowait(*self.paths('small', 'third'), self.watermark_image)
+        self.assertEqual((await first.wait())['status'], 'ok')
+
+class FakeSampler:
+    def __init__(self, cpu, memory=10):
+        self.sequence = 0
+        self.cpu = cpu
+        self.memory = memory
+
+    def latest(self):
+        self.sequence += 1
+        return self.sequence, self.cpu, self.memory
+
+class TestBenchmark(TempDirTestCase):
+    def test_cases_only_vary_workers_of_parallel_engines(self):
+        cases = benchmark.benchmark_cases(['text-200'], ['small'], ['process', 'serial'], [1, 4])
+        self.assertEqual(cases, [
+            ('text-200', 'small', 'process', 1),
+            ('text-200', 'small', 'process', 4),
+            ('text-200', 'small', 'serial', 1),
+        ])
+
+    def test_compare_results_applies_thresholds(self):
+        baseline = {'a': {'pages_per_sec': 100, 'peak_rss_mb': 100, 'output_size': 1000}}
+        within = {'a': {'pages_per_sec': 95, 'peak_rss_mb': 110, 'output_size': 1040}, 'new': baseline['a']}
+        self.assertEqual(benchmark.compare_results(within, baseline), [])
+        worse = {'a': {'pages_per_sec': 80, 'peak_rss_mb': 130, 'output_size': 1100}}
+        self.assertEqual(len(benchmark.compare_results(worse, baseline)), 3)
+        self.assertEqual(benchmark.compare_results(worse, baseline, max_slowdown=0.5, max_rss_growth=0.5, max_size_growth=0.5), [])
+
+    def test_run_against_baseline(self):
+        baseline = os.path.join(self.temp_dir, 'baseline.json')
+        argv = [
+            '--documents', 'scans-100', '--watermarks', 'small', '--engines', 'serial',
+            '--corpus-dir', self.temp_dir, '--baseline', baseline, '--no-startup'
+        ]
+        self.assertEqual(benchmark.main(argv + ['--update-baseline']), 0)
+        with open(baseline) as f:
+            report = json.load(f)
+        result = report['results']['scans-100/small/serial/1']
+        self.assertEqual(result['pages'], 100)
+        self.assertGreater(result['peak_rss_mb'], 0)
+        with fitz.open(os.path.join(self.temp_dir, 'scans-100.pdf')) as pdf:
+            self.assertEqual(len(pdf[0].get_images()), 1)
+        report['results']['scans-100/small/serial/1']['output_size'] //= 2
+        with open(baseline, 'w') as f:
+            json.dump(report, f)
+        self.assertEqual(benchmark.main(argv), 1)
+
+    def test_startup_metrics(self):
+        startup = benchmark.measure_startup(self.watermark_image, self.temp_dir, runs=1)
+        self.assertEqual(set(startup), {'import_pdf_watermarker_ms', 'import_watermark_pdf_ms', 'cold_start_s'})
+        self.assertLess(startup['import_pdf_watermarker_ms'], startup['import_watermark_pdf_ms'])
+        self.assertEqual(benchmark.compare_startup(startup, startup), [])
+        slower = {metric: value * 2 for metric, value in startup.items()}
+        self.assertEqual(len(benchmark.compare_startup(slower, startup)), 3)
+
+class TestAdaptiveScheduler(unittest.TestCase):
+    def run_tasks(self, scheduler, count=20):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def task(index):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            return index
+
+        with watermark_pdf.ThreadPoolExecutor(max_workers=scheduler.max_workers) as executor:
+            results = sorted(future.result() for _, future in scheduler.run(executor, task, ((i,) for i in range(count))))
+        self.assertEqual(results, list(range(count)))
+        return state['peak']
+
+    def test_shrinks_under_load(self):
+        scheduler = watermark_pdf.AdaptiveScheduler(4, FakeSampler(cpu=95), cpu_threshold=80)
+        self.run_tasks(scheduler)
+        self.assertEqual(scheduler.limit, 1)
+        self.assertEqual([event['to'] for event in scheduler.scaling_events], [3, 2, 1])
+        self.assertTrue(all('timestamp' in event for event in scheduler.scaling_events))
+
+    def test_grows_back_when_idle(self):
+        sampler = FakeSampler(cpu=10)
+        scheduler = watermark_pdf.AdaptiveScheduler(4, sampler)
+        scheduler.limit = 1
+        peak = self.run_tasks(scheduler)
+        self.assertEqual(scheduler.limit, 4)
+        self.assertLessEqual(peak, 4)
+
+    def test_window_bounds_tasks_in_flight(self):
+        scheduler = watermark_pdf.AdaptiveScheduler(4, FakeSampler(cpu=95, memory=95))
+        scheduler.limit = 1
+        self.assertEqual(self.run_tasks(scheduler), 1)
+
+    def test_sampler_does_not_block(self):
+        with watermark_pdf.ResourceSampler(interval=0.05) as sampler:
+            start = time.time()
+            sampler.latest()
+            self.assertLess(time.time() - start, 0.05)
+            time.sleep(0.2)
+            self.assertGreater(sampler.latest()[0], 0)
+
+class TestBatchMode(TempDirTestCase):
+    def test_collect_directory_and_glob(self):
+        output_dir = os.path.join(self.temp_dir, 'out')
+        from_dir = watermark_pdf.collect_batch_jobs(self.input_dir, output_dir)
+        from_glob = watermark_pdf.collect_batch_jobs(os.path.join(self.input_dir, '*.pdf'), output_dir)
+        self.assertEqual(from_dir, from_glob)
+        self.assertEqual([os.path.basename(output) for _, output in from_dir], ['large.pdf', 'medium.pdf', 'small.pdf'])
+        with self.assertRaises(ValueError):
+            watermark_pdf.collect_batch_jobs(self.input_dir)
+
+    def test_manifest_batch(self):
+        manifest = os.path.join(self.temp_dir, 'manifest.jsonl')
+        with open(manifest, 'w') as f:
+            f.write(json.dumps({'input': os.path.join(self.input_dir, 'small.pdf'), 'output': 'out/a.pdf'}) + '\n')
+            f.write(json.dumps({'input': os.path.join(self.input_dir, 'medium.pdf'), 'output': 'out/b.pdf'}) + '\n')
+            f.write(json.dumps({'input': 'missing.pdf', 'output': 'out/c.pdf'}) + '\n')
+        results = os.path.join(self.temp_dir, 'results.jsonl')
+        jobs = watermark_pdf.collect_batch_jobs(manifest)
+        records = watermark_pdf.watermark_batch(jobs, self.watermark_image, max_workers=2, results_path=results)
+
+        by_output = {os.path.basename(record['output']): record for record in records}
+        self.assertEqual(by_output['a.pdf']['status'], 'ok')
+        self.assertEqual(by_output['b.pdf']['pages'], 50)
+        self.assertEqual(by_output['c.pdf']['status'], 'error')
+        with open(results) as f:
+            self.assertEqual(len(f.readlines()), 3)
+        with fitz.open(os.path.join(self.temp_dir, 'out', 'b.pdf')) as pdf:
+            self.assertTrue(all(page.get_images() for page in pdf))
+
+    def test_batch_cli(self):
+        output_dir = os.path.join(self.temp_dir, 'out')
+        script = os.path.join(os.path.dirname(__file__), '..', 'watermark_pdf.py')
+        result = subprocess.run(
+            [sys.executable, script, '--batch', self.input_dir, '--output-dir', output_dir, self.watermark_image],
+            capture_output=True, text=True
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        records = [json.loads(line) for line in result.stdout.splitlines() if line.startswith('{')]
+        self.assertEqual(sorted(record['pages'] for record in records), [5, 50, 200])
+
+class TestWatermarkCache(TempDirTestCase):
+    def test_repeated_preparation_hits_cache(self):
+        cache = WatermarkCache(self.temp_dir)
+        first = watermark_pdf.prepare_watermark(self.watermark_image, 0.3, cache)
+        second = watermark_pdf.prepare_watermark(self.watermark_image, 0.3, cache)
+        self.assertEqual(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(os.listdir(self.temp_dir)), 1)
+
+        # A fresh process only has the disk tier
+        other_process = WatermarkCache(self.temp_dir)
+        self.assertEqual(watermark_pdf.prepare_watermark(self.watermark_image, 0.3, other_process), first)
+        self.assertEqual(other_process.hits, 1)
+
+    def test_unwritable_cache_dir(self):
+        blocker = os.path.join(self.temp_dir, 'not_a_dir')
+        open(blocker, 'w').close()
+        cache = WatermarkCache(os.path.join(blocker, 'cache'))
+        data = watermark_pdf.prepare_watermark(self.watermark_image, 0.3, cache)
+        self.assertTrue(data.startswith(b'\x89PNG'))
+        self.assertEqual(watermark_pdf.prepare_watermark(self.watermark_image, 0.3, cache), data)
+
+        output_pdf = os.path.join(self.temp_dir, 'out.pdf')
+        with fitz.open() as pdf:
+            pdf.new_page()
+            watermark_pdf.watermark_pages_serial(pdf, data)
+            self.assertEqual(len(pdf[0].get_images()), 1)
+            pdf.save(output_pdf)
+
+    def test_key_depends_on_content_and_opacity(self):
+        cache = WatermarkCache(self.temp_dir)
+        low = watermark_pdf.prepare_watermark(self.watermark_image, 0.2, cache)
+        high = watermark_pdf.prepare_watermark(self.watermark_image, 0.6, cache)
+        self.assertNotEqual(low, high)
+        copy = os.path.join(self.temp_dir, 'copy.png')
+        shutil.copy(self.watermark_image, copy)
+        watermark_pdf.prepare_watermark(copy, 0.2, cache)
+        self.assertEqual(cache.hits, 1)
+
+    def test_size_based_eviction(self):
+        cache = WatermarkCache(self.temp_dir, max_disk_bytes=250, max_memory_bytes=250)
+        for index in range(5):
+            cache.put(f'key{index}', bytes(100))
+            os.utime(cache.path(f'key{index}'), (index, index))
+        cache.evict()
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['key3.png', 'key4.png'])
+        self.assertLessEqual(sum(len(data) for data in cache._memory.values()), 250)
+
+class TestWatermarkPreparation(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = WatermarkCache(self.temp_dir)
+
+    def test_downsamples_to_target_size(self):
+        data = watermark_pdf.prepare_watermark(self.watermark_image, 0.5, self.cache, max_side=100)
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(max(img.size), 100)
+            self.assertEqual(img.mode, 'RGBA')
+        # Never upsampled
+        data = watermark_pdf.prepare_watermark(self.watermark_image, 0.5, self.cache, max_side=5000)
+        with Image.open(io.BytesIO(data)) as img, Image.open(self.watermark_image) as source:
+            self.assertEqual(img.size, source.size)
+
+    def test_alpha_scaled_by_opacity(self):
+        data = watermark_pdf.prepare_watermark(self.watermark_image, 0.5, self.cache)
+        with Image.open(io.BytesIO(data)) as img, Image.open(self.watermark_image) as source:
+            expected = bytes(int(value * 0.5) for value in source.convert('RGBA').getchannel('A').tobytes())
+            self.assertEqual(img.getchannel('A').tobytes(), expected)
+
+    def test_target_size_follows_largest_page(self):
+        with fitz.open() as pdf:
+            pdf.new_page(width=612, height=792)
+            pdf.new_page(width=1224, height=792)
+            self.assertEqual(watermark_pdf.watermark_target_size(pdf, dpi=72), 408)
+            self.assertEqual(watermark_pdf.watermark_target_size(pdf, dpi=144), 816)
+            self.assertIsNone(watermark_pdf.watermark_target_size(pdf, dpi=0))
+
+    def test_embedded_image_is_compressed(self):
+        data = watermark_pdf.prepare_watermark(self.watermark_image, 0.5, self.cache)
+        with fitz.open() as pdf:
+            page = pdf.new_page()
+            xref = watermark_pdf.watermark_page_under(page, data)
+            smask = int(pdf.xref_get_key(xref, 'SMask')[1].split()[0])
+            for image_xref in (xref, smask):
+                self.assertEqual(pdf.xref_get_key(image_xref, 'Filter'), ('name', '/FlateDecode'))
+            self.assertEqual(pdf.extract_image(xref)['width'], 460)
+
+class TestVectorWatermark(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = WatermarkCache(os.path.join(self.temp_dir, 'cache'))
+
+    def shared_templates(self, pdf):
+        templates = set()
+        for page in pdf:
+            for xref, _, invoker, _ in page.get_xobjects():
+                if invoker == 0:
+                    templates.add(pdf.xref_get_key(xref, 'Resources/XObject/fullpage')[1])
+        return templates
+
+    def test_text_watermark(self):
+        output_pdf = os.path.join(self.temp_dir, 'text.pdf')
+        watermark_pdf.watermark_pdf(self.input_pdf, output_pdf, None, opacity=0.3, engine='serial', vector_options={'text': 'CONFIDENTIAL', 'rotation': 45})
+        with fitz.open(output_pdf) as pdf:
+            self.assertTrue(all('CONFIDENTIAL' in page.get_text() for page in pdf))
+            self.assertFalse(any(page.get_images() for page in pdf))
+            self.assertEqual(len(self.shared_templates(pdf)), 1)
+
+    def test_process_engine_shares_one_template(self):
+        form_counts = []
+        for engine in ('serial', 'process'):
+            output_pdf = os.path.join(self.temp_dir, f'{engine}.pdf')
+            watermark_pdf.watermark_pdf(self.input_pdf, output_pdf, None, engine=engine, max_workers=4, vector_options={'text': 'DRAFT'})
+            with fitz.open(output_pdf) as pdf:
+                self.assertTrue(all('DRAFT' in page.get_text() for page in pdf))
+                self.assertEqual(len(self.shared_templates(pdf)), 1)
+                form_counts.append(sum(pdf.xref_get_key(xref, 'Subtype') == ('name', '/Form') for xref in range(1, pdf.xref_length())))
+        # One Form XObject per page plus a single copy of the template, however many parts were merged
+        self.assertEqual(form_counts[1], form_counts[0])
+
+    def test_rotation_and_opacity_baked_into_template(self):
+        flat = watermark_pdf.prepare_vector_watermark(text='DRAFT', opacity=0.4, cache=self.cache)
+        turned = watermark_pdf.prepare_vector_watermark(text='DRAFT', opacity=0.4, rotation=90, cache=self.cache)
+        with fitz.open('pdf', flat) as flat_pdf, fitz.open('pdf', turned) as turned_pdf:
+            self.assertAlmostEqual(flat_pdf[0].rect.width, turned_pdf[0].rect.height, places=3)
+            opacity = flat_pdf.xref_get_key(flat_pdf[0].xref, 'Resources/ExtGState/fzWmOpacity/ca')[1]
+            self.assertAlmostEqual(float(opacity), 0.4)
+
+    def test_pdf_and_svg_logos(self):
+        logo_pdf = os.path.join(self.temp_dir, 'logo.pdf')
+        with fitz.open() as logo:
+            page = logo.new_page(width=200, height=100)
+            page.draw_rect(fitz.Rect(10, 10, 190, 90), color=(1, 0, 0), fill=(1, 0, 0))
+            logo.new_page()
+            logo.save(logo_pdf)
+        logo_svg = os.path.join(self.temp_dir, 'logo.svg')
+        with open(logo_svg, 'w') as f:
+            f.write('<svg xmlns="http://www.w3.org/2000/svg" width="200" height="100"><circle cx="100" cy="50" r="40" fill="blue"/></svg>')
+
+        for logo_path in (logo_pdf, logo_svg):
+            data = watermark_pdf.load_watermark(logo_path, 0.5, cache=self.cache)
+            self.assertTrue(watermark_pdf.is_vector_watermark(data))
+            output_pdf = os.path.join(self.temp_dir, 'logo_out.pdf')
+            watermark_pdf.watermark_pdf(self.input_pdf, output_pdf, logo_path, engine='process', max_workers=2)
+            with fitz.open(output_pdf) as pdf:
+                self.assertEqual(pdf.page_count, 50)
+                self.assertTrue(all(page.get_xobjects() for page in pdf))
+                self.assertFalse(any(page.get_images() for page in pdf))
+                self.assertTrue(pdf[10].get_drawings())
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
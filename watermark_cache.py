@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Bumped whenever prepare_watermark changes its output, so stale entries are never reused
+PREPARATION_VERSION = 2
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "watermark_cache")
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_MEMORY_BYTES = 64 * 1024 * 1024
+
+class WatermarkCache:
+    """
+    Content-addressed cache of prepared watermark images.
+
+    Entries are keyed by the SHA-256 of the source image bytes plus the
+    opacity, and live in two tiers: an in-process LRU dictionary and a
+    directory shared by every process on the host. Both tiers evict least
+    recently used entries once their size budget is exceeded. Disk writes go
+    through a temporary file and os.replace, so concurrent runs never see a
+    half-written entry.
+
+    Args:
+        cache_dir (str): Directory holding the on-disk entries.
+        max_disk_bytes (int): Size budget of the on-disk tier.
+        max_memory_bytes (int): Size budget of the in-memory tier.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_disk_bytes=DEFAULT_MAX_DISK_BYTES, max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image_bytes, opacity, *params):
+        """
+        Returns the cache key for a source image, an opacity and any further
+        preparation parameters.
+        """
+        digest = hashlib.sha256(image_bytes)
+        digest.update(repr((PREPARATION_VERSION, float(opacity)) + params).encode())
+        return digest.hexdigest()
+
+    def path(self, key, suffix=".png"):
+        """
+        Returns the on-disk location of an entry.
+        """
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def get(self, key, suffix=".png"):
+        """
+        Looks an entry up, memory first and then disk.
+
+        Returns:
+            bytes: The prepared image, or None on a miss.
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+
+        path = self.path(key, suffix)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Refreshing the mtime keeps recently used entries out of eviction
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data, suffix=".png"):
+        """
+        Stores an entry in both tiers. A read-only or full cache directory only
+        disables the disk tier; the entry is still kept in memory.
+
+        Returns:
+            str: Path of the on-disk entry, or None if it could not be written.
+        """
+        self._remember(key, data)
+        temp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self.path(key, suffix)
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp_")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.debug("Could not write cached watermark to %s: %s", self.cache_dir, e)
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        self.evict()
+        return path
+
+    def _remember(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def evict(self):
+        """
+        Removes the least recently used on-disk entries until the directory
+        fits in max_disk_bytes.
+        """
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as scan:
+                for entry in scan:
+                    if entry.is_file() and not entry.name.startswith(".tmp_"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                logging.debug("Evicted cached watermark %s", path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear_memory(self):
+        """
+        Drops the in-memory tier.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+_default_cache = None
+
+def get_default_cache():
+    """
+    Returns the process-wide cache, creating it with the default settings on first use.
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = WatermarkCache()
+    return _default_cache
+
+def set_default_cache(cache):
+    """
+    Replaces the process-wide cache.
+    """
+    global _default_cache
+    _default_cache = cache
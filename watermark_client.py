@@ -0,0 +1,182 @@
+import http.client
+import json
+import os
+import shutil
+import socket
+from urllib.parse import urlencode
+
+# Address the daemon listens on when none is given: "host:port" or "unix:/path/to/socket"
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+
+# Block size for streamed uploads and downloads
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+class DaemonError(Exception):
+    """
+    Raised when the daemon rejects a request or a job fails.
+
+    Args:
+        message (str): Error reported by the daemon.
+        status (int): HTTP status of the response.
+        record (dict): Result record of a failed job, if any.
+    """
+
+    def __init__(self, message, status=None, record=None):
+        super().__init__(message)
+        self.status = status
+        self.record = record
+
+def parse_address(address):
+    """
+    Splits a daemon address into its transport and location.
+
+    Args:
+        address (str): "host:port", "http://host:port" or "unix:/path/to/socket".
+
+    Returns:
+        tuple: ("unix", path) or ("tcp", host, port).
+    """
+    if address.startswith("unix:"):
+        return ("unix", address[len("unix:"):])
+    if address.startswith("http://"):
+        address = address[len("http://"):]
+    host, _, port = address.rstrip("/").rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"Invalid daemon address {address!r}; expected host:port or unix:/path")
+    return ("tcp", host, int(port))
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix domain socket.
+    """
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout, blocksize=STREAM_CHUNK_SIZE)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+class WatermarkClient:
+    """
+    Client of the watermark daemon (see watermark_daemon.py). It only depends
+    on the standard library, so callers do not pay for importing PyMuPDF.
+
+    Args:
+        address (str): Daemon address, see parse_address.
+        timeout (float): Socket timeout in seconds; None waits for long jobs.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        self.address = address
+        self.timeout = timeout
+        self._location = parse_address(address)
+
+    def _connection(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if self._location[0] == "unix":
+            return UnixHTTPConnection(self._location[1], timeout=timeout)
+        return http.client.HTTPConnection(self._location[1], self._location[2], timeout=timeout, blocksize=STREAM_CHUNK_SIZE)
+
+    @staticmethod
+    def _read_json(response):
+        try:
+            return json.loads(response.read() or b"{}")
+        except json.JSONDecodeError:
+            return {}
+
+    def _check(self, response, body):
+        if response.status != 200:
+            record = body if 'status' in body else None
+            raise DaemonError(body.get('error', response.reason), response.status, record)
+
+    def health(self, timeout=None):
+        """
+        Returns the daemon's status: pid, worker count and jobs served.
+        """
+        connection = self._connection(timeout)
+        try:
+            connection.request("GET", "/health")
+            response = connection.getresponse()
+            body = self._read_json(response)
+            self._check(response, body)
+            return body
+        finally:
+            connection.close()
+
+    def is_available(self, timeout=1.0):
+        """
+        Returns True if a daemon answers at the address.
+        """
+        try:
+            self.health(timeout)
+            return True
+        except (OSError, DaemonError, http.client.HTTPException):
+            return False
+
+    def submit(self, input_pdf, output_pdf, watermark=None, **options):
+        """
+        Watermarks a file the daemon can read and writes the result to a path
+        it can write. Relative paths are resolved here, not in the daemon.
+
+        Args:
+            input_pdf (str): Path to the input PDF file.
+            output_pdf (str): Path to save the watermarked PDF.
+            watermark (str): Path to the watermark image, PDF or SVG file.
+            **options: Job options: opacity, engine, share_image,
+                watermark_dpi, chunk_size, incremental, save_profile, text,
+                rotation, font, font_size, color and overwrite (replace an
+                existing output).
+
+        Returns:
+            dict: Result record with the timing data of the job.
+        """
+        job = dict(options, input=os.path.abspath(input_pdf), output=os.path.abspath(output_pdf))
+        if watermark:
+            job['watermark'] = os.path.abspath(watermark)
+        connection = self._connection()
+        try:
+            connection.request("POST", "/jobs", body=json.dumps(job), headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            body = self._read_json(response)
+            self._check(response, body)
+            return body
+        finally:
+            connection.close()
+
+    def watermark_stream(self, source, destination, watermark=None, **options):
+        """
+        Uploads a PDF, and streams the watermarked PDF back, without either
+        side holding the whole document in memory.
+
+        Args:
+            source: Seekable binary file object positioned at the start of the input PDF.
+            destination: Binary file object receiving the watermarked PDF.
+            watermark (str): Path to the watermark file, on the daemon's host.
+            **options: Job options, as for submit.
+
+        Returns:
+            dict: Result record with the timing data of the job.
+        """
+        if watermark:
+            options['watermark'] = os.path.abspath(watermark)
+        position = source.tell()
+        length = source.seek(0, os.SEEK_END) - position
+        source.seek(position)
+        connection = self._connection()
+        try:
+            connection.request(
+                "POST", "/watermark?" + urlencode(options), body=source,
+                headers={"Content-Type": "application/pdf", "Content-Length": str(length)}
+            )
+            response = connection.getresponse()
+            if response.status != 200:
+                self._check(response, self._read_json(response))
+            record = json.loads(response.getheader("X-Watermark-Result", "{}"))
+            shutil.copyfileobj(response, destination, STREAM_CHUNK_SIZE)
+            return record
+        finally:
+            connection.close()
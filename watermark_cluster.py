@@ -0,0 +1,684 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+try:
+    # The legacy "fitz" name prints a deprecation notice to stdout, where the records go
+    import pymupdf as fitz
+except ImportError:
+    import fitz
+from watermark_pdf import (
+    BATCH_REFERENCE_PAGE_SIDE, DEFAULT_WATERMARK_DPI, SAVE_PROFILES, collect_batch_jobs, load_watermark,
+    mark_watermarked, merge_page_ranges, setup_logging, watermark_batch_file, watermark_digest,
+    watermark_page_range, watermark_pixel_size
+)
+
+# Documents with more pages than this are split into page ranges of this size
+DEFAULT_RANGE_PAGES = 2000
+
+# Seconds a claimed task stays leased without a renewal; workers renew a
+# third of the way through, so a worker is given up on after one lease
+DEFAULT_LEASE_SECONDS = 60
+
+# Attempts per task before its job fails
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Seconds between polls of idle workers and of the coordinator
+DEFAULT_POLL_INTERVAL = 0.5
+
+# Seconds the coordinator waits for a worker while tasks are queued and none
+# is leased before it fails them, so a run whose workers all died ends
+DEFAULT_WORKER_TIMEOUT = 600
+
+QUEUE_FILE = "queue.sqlite3"
+PARTS_DIR = "parts"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    input TEXT NOT NULL,
+    output TEXT NOT NULL,
+    pages INTEGER NOT NULL,
+    watermark TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    submitted REAL NOT NULL,
+    record TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    start INTEGER,
+    stop INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_token TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id);
+CREATE INDEX IF NOT EXISTS tasks_job ON tasks (job_id);
+"""
+
+def watermark_file(work_dir, digest):
+    """
+    Returns the path of the prepared watermark with the given digest (see
+    watermark_digest) in a work directory. Files are named by content, so
+    a submission with another watermark never changes the file of one
+    already queued.
+    """
+    return os.path.join(work_dir, f"watermark_{digest}.bin")
+
+class WorkQueue:
+    """
+    Task queue of a distributed run, kept in an SQLite database in the work
+    directory that the coordinator and every worker share.
+
+    A task is a whole document or a page range of one. Workers claim the
+    oldest pending task, or one whose lease expired because its worker
+    stopped renewing it, under a lease token. Only the holder of the current
+    token can complete or fail the task, so a worker that lost its lease
+    cannot overwrite the result of the worker that took over. Leases are
+    compared against the wall clock of each host, so hosts need synchronised
+    clocks (NTP) well within the lease duration.
+
+    The database uses the rollback journal rather than WAL, which needs
+    shared memory and therefore does not work across hosts; every call opens
+    its own connection, like ResultIndex.
+
+    Args:
+        work_dir (str): Shared work directory.
+    """
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, QUEUE_FILE)
+        os.makedirs(os.path.join(work_dir, PARTS_DIR), exist_ok=True)
+        # executescript commits on its own, so it runs outside _connect
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # Claims need BEGIN IMMEDIATE, so transactions are started explicitly
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def settings(self):
+        """
+        Returns the settings of the run, as stored by the coordinator.
+        """
+        with self._connect() as connection:
+            return {key: json.loads(value) for key, value in connection.execute("SELECT key, value FROM settings")}
+
+    def update_settings(self, **settings):
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in settings.items()]
+            )
+
+    def add_job(self, input_pdf_path, output_pdf_path, pages, page_ranges, watermark):
+        """
+        Adds a document and its tasks.
+
+        Args:
+            page_ranges (list): (start, stop) ranges of page-range tasks, or
+                an empty list for a single task covering the whole document.
+            watermark (str): Digest of the document's watermark (see watermark_file).
+
+        Returns:
+            int: Id of the job.
+        """
+        with self._connect() as connection:
+            job_id = connection.execute(
+                "INSERT INTO jobs (input, output, pages, watermark, submitted) VALUES (?, ?, ?, ?, ?)",
+                (input_pdf_path, output_pdf_path, pages, watermark, time.time())
+            ).lastrowid
+            connection.executemany(
+                "INSERT INTO tasks (job_id, start, stop) VALUES (?, ?, ?)",
+                [(job_id, start, stop) for start, stop in page_ranges] or [(job_id, None, None)]
+            )
+        return job_id
+
+    @staticmethod
+    def _expire_leases(connection, now, max_attempts):
+        # Tasks whose worker stopped renewing the lease go back to the queue,
+        # or fail once they used up their attempts
+        connection.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "error = 'lease expired', lease_token = NULL WHERE status = 'leased' AND lease_expires < ?",
+            (max_attempts, now)
+        )
+
+    def expire_leases(self, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        Requeues the tasks whose lease expired, failing those that had
+        max_attempts attempts. Claims do the same, but the coordinator also
+        calls this, since no claims come once every worker is gone.
+        """
+        with self._connect() as connection:
+            self._expire_leases(connection, time.time(), max_attempts)
+
+    def fail_pending(self, error):
+        """
+        Fails every task still waiting for a worker.
+
+        Returns:
+            int: Number of tasks failed.
+        """
+        with self._connect() as connection:
+            return connection.execute("UPDATE tasks SET status = 'failed', error = ? WHERE status = 'pending'", (error,)).rowcount
+
+    def claim(self, worker, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        Leases the next task to a worker, after requeueing or failing tasks
+        whose lease expired (see expire_leases).
+
+        Returns:
+            dict: The task with its job's input and watermark digest, its
+            lease token and the attempt number, or None if no task is available.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            self._expire_leases(connection, now, max_attempts)
+            row = connection.execute(
+                "SELECT tasks.id, tasks.job_id, tasks.start, tasks.stop, tasks.attempts, jobs.input, jobs.watermark "
+                "FROM tasks JOIN jobs ON jobs.id = tasks.job_id "
+                "WHERE tasks.status = 'pending' ORDER BY tasks.id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            token = uuid.uuid4().hex
+            connection.execute(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_token = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, token, now + lease_seconds, row[0])
+            )
+        task_id, job_id, start, stop, attempts, input_pdf_path, watermark = row
+        return {
+            'id': task_id, 'job_id': job_id, 'start': start, 'stop': stop, 'input': input_pdf_path,
+            'watermark': watermark, 'worker': worker, 'token': token, 'attempt': attempts + 1,
+        }
+
+    def renew(self, task, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Extends the lease of a task.
+
+        Returns:
+            bool: False if the lease was lost to another worker.
+        """
+        with self._connect() as connection:
+            return connection.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE id = ? AND lease_token = ? AND status = 'leased'",
+                (time.time() + lease_seconds, task['id'], task['token'])
+            ).rowcount == 1
+
+    def complete(self, task, result):
+        """
+        Records the result of a task.
+
+        Returns:
+            bool: False if the lease was lost, in which case the result is dropped.
+        """
+        with self._connect() as connection:
+            return connection.execute(
+                "UPDATE tasks SET status = 'done', result = ? WHERE id = ? AND lease_token = ? AND status = 'leased'",
+                (json.dumps(result), task['id'], task['token'])
+            ).rowcount == 1
+
+    def fail(self, task, error, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        Returns a task to the queue after an error, or fails it for good
+        after max_attempts attempts.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, lease_token = NULL WHERE id = ? AND lease_token = ? AND status = 'leased'",
+                (max_attempts, error, task['id'], task['token'])
+            )
+
+    def settled_jobs(self):
+        """
+        Returns the running jobs none of whose tasks is pending or leased
+        any more, with their tasks in page order.
+
+        Returns:
+            list: (job, tasks) pairs of dicts.
+        """
+        with self._connect() as connection:
+            connection.row_factory = sqlite3.Row
+            jobs = connection.execute(
+                "SELECT * FROM jobs WHERE status = 'running' AND NOT EXISTS "
+                "(SELECT 1 FROM tasks WHERE tasks.job_id = jobs.id AND tasks.status IN ('pending', 'leased'))"
+            ).fetchall()
+            return [
+                (dict(job), [dict(task) for task in connection.execute(
+                    "SELECT * FROM tasks WHERE job_id = ? ORDER BY start, id", (job['id'],)
+                )])
+                for job in jobs
+            ]
+
+    def finish_job(self, job_id, record):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, record = ? WHERE id = ?",
+                ('done' if record['status'] == 'ok' else 'error', json.dumps(record), job_id)
+            )
+
+    def records(self):
+        """
+        Returns the records of the finished jobs in submission order.
+        """
+        with self._connect() as connection:
+            return [json.loads(record) for record, in connection.execute("SELECT record FROM jobs WHERE record IS NOT NULL ORDER BY id")]
+
+    def counts(self):
+        """
+        Returns the number of tasks in each status and of running jobs.
+        """
+        with self._connect() as connection:
+            counts = dict(connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+            counts['running_jobs'] = connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+        return counts
+
+    def drained(self):
+        """
+        Returns True once the coordinator closed the queue and no task is
+        pending or leased, which is when workers stop.
+        """
+        with self._connect() as connection:
+            closed = connection.execute("SELECT value FROM settings WHERE key = 'closed'").fetchone()
+            if not closed or not json.loads(closed[0]):
+                return False
+            return connection.execute("SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'leased')").fetchone()[0] == 0
+
+def part_path(work_dir, task):
+    """
+    Returns the part file of a task attempt; every lease writes its own, so
+    a worker that lost its lease never overwrites the part of its successor.
+    """
+    return os.path.join(work_dir, PARTS_DIR, f"task_{task['id']:06d}_{task['token'][:12]}.pdf")
+
+class LeaseKeeper:
+    """
+    Renews the lease of a task from a background thread while the task runs.
+
+    Args:
+        queue (WorkQueue): Queue holding the task.
+        task (dict): Task from WorkQueue.claim.
+        lease_seconds (float): Lease duration; renewed every third of it.
+    """
+
+    def __init__(self, queue, task, lease_seconds):
+        self.queue = queue
+        self.task = task
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-keeper", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                if not self.queue.renew(self.task, self.lease_seconds):
+                    logging.warning("Lost the lease of task %s", self.task['id'])
+                    self.lost = True
+                    return
+            except sqlite3.Error as e:
+                # A busy or briefly unreachable shared directory; the next renewal may succeed
+                logging.warning("Could not renew the lease of task %s: %s", self.task['id'], e)
+
+def run_task(work_dir, settings, processed_watermark, task):
+    """
+    Watermarks the document or page range of a task into its part file.
+
+    Returns:
+        dict: Result stored with the task: the part file, the 1-based
+        numbers of pages left without a watermark and, for page ranges, the
+        watermark image name (see watermark_page_range).
+
+    Raises:
+        RuntimeError: If the document could not be watermarked.
+    """
+    path = part_path(work_dir, task)
+    start_time = time.time()
+    if task['start'] is None:
+        record = watermark_batch_file(
+            task['input'], path, processed_watermark, settings['share_image'], settings['save_profile'],
+            force=settings['force'], strict=settings['strict']
+        )
+        if record['status'] != 'ok':
+            raise RuntimeError(record['error'])
+        return {'part': path, 'failed_pages': record.get('failed_pages', []), 'skipped': record.get('skipped'), 'time': time.time() - start_time}
+    image_name, failed, _ = watermark_page_range(
+        task['input'], path, processed_watermark, task['start'], task['stop'], settings['share_image'], settings['strict']
+    )
+    return {'part': path, 'failed_pages': failed, 'image_name': image_name, 'time': time.time() - start_time}
+
+def run_worker(work_dir, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS, poll_interval=DEFAULT_POLL_INTERVAL, max_tasks=None):
+    """
+    Runs tasks from the queue in work_dir until the coordinator closed it
+    and no task is left, or max_tasks tasks have been run.
+
+    Args:
+        work_dir (str): Shared work directory.
+        worker_id (str): Name recorded with claimed tasks; defaults to host:pid.
+        lease_seconds (float): Lease duration of claimed tasks.
+        poll_interval (float): Seconds to wait when no task is available.
+        max_tasks (int): Stop after this many tasks.
+
+    Returns:
+        int: Number of tasks completed.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    queue = WorkQueue(work_dir)
+    completed = 0
+    logging.info("Worker %s started on %s", worker_id, work_dir)
+    # The coordinator stores the watermark, then the settings, then queues
+    # tasks, so claims always use its max_attempts
+    settings = queue.settings()
+    while 'max_attempts' not in settings:
+        time.sleep(poll_interval)
+        settings = queue.settings()
+    # Prepared watermarks by digest, read when a task first needs one
+    watermarks = {}
+    while max_tasks is None or completed < max_tasks:
+        task = queue.claim(worker_id, lease_seconds, settings['max_attempts'])
+        if task is None:
+            if queue.drained():
+                break
+            time.sleep(poll_interval)
+            continue
+        pages = "all pages" if task['start'] is None else f"pages {task['start'] + 1}-{task['stop']}"
+        logging.info("Worker %s: task %s (%s, %s), attempt %s", worker_id, task['id'], task['input'], pages, task['attempt'])
+        try:
+            with LeaseKeeper(queue, task, lease_seconds) as lease:
+                if task['watermark'] not in watermarks:
+                    with open(watermark_file(work_dir, task['watermark']), "rb") as f:
+                        watermarks[task['watermark']] = f.read()
+                result = run_task(work_dir, settings, watermarks[task['watermark']], task)
+        except Exception as e:
+            logging.error("Worker %s: task %s failed: %s", worker_id, task['id'], e)
+            queue.fail(task, str(e), settings['max_attempts'])
+            continue
+        if lease.lost or not queue.complete(task, result):
+            logging.warning("Worker %s: dropping the result of task %s, whose lease was lost", worker_id, task['id'])
+            with contextlib.suppress(OSError):
+                os.remove(result['part'])
+            continue
+        completed += 1
+    logging.info("Worker %s finished after %s tasks", worker_id, completed)
+    return completed
+
+class Coordinator:
+    """
+    Splits a batch into tasks in the queue of a shared work directory and
+    turns the parts that workers write into the outputs. Documents with more
+    than range_pages pages are split into page ranges that are merged by the
+    coordinator; smaller documents are single tasks whose part is moved to
+    the output. Inputs, outputs and the work directory must be reachable
+    under the same paths on every host.
+
+    A coordinator restarted on the same work directory carries on with the
+    jobs already queued.
+
+    Args:
+        work_dir (str): Shared work directory.
+        range_pages (int): Largest document kept as a single task, and page
+            count of the ranges larger ones are split into.
+        max_attempts (int): Attempts per task before its document fails.
+    """
+
+    def __init__(self, work_dir, range_pages=DEFAULT_RANGE_PAGES, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        if range_pages < 1:
+            raise ValueError(f"range_pages must be at least 1, got {range_pages}")
+        self.work_dir = os.path.abspath(work_dir)
+        self.range_pages = range_pages
+        self.max_attempts = max_attempts
+        self.queue = WorkQueue(self.work_dir)
+
+    def submit(self, jobs, watermark_image_path=None, opacity=0.2, watermark_dpi=DEFAULT_WATERMARK_DPI, vector_options=None, share_image=True, save_profile="fast", force=False, strict=False):
+        """
+        Prepares the watermark once and queues the tasks of every document.
+        The watermark is sized for pages of BATCH_REFERENCE_PAGE_SIDE points,
+        as in batch mode.
+
+        Args:
+            jobs (list): (input_pdf_path, output_pdf_path) tuples.
+            Other arguments as for watermark_batch.
+
+        Returns:
+            int: Number of tasks queued.
+        """
+        if save_profile not in SAVE_PROFILES:
+            raise ValueError(f"Unknown save profile {save_profile!r}; expected one of {', '.join(SAVE_PROFILES)}")
+        if self.queue.settings().get('closed'):
+            raise ValueError(f"The queue in {self.work_dir} is closed")
+        max_side = watermark_pixel_size(BATCH_REFERENCE_PAGE_SIDE, watermark_dpi)
+        processed_watermark = load_watermark(watermark_image_path, opacity, max_side, **(vector_options or {}))
+        digest = watermark_digest(processed_watermark)
+        watermark_path = watermark_file(self.work_dir, digest)
+        if not os.path.exists(watermark_path):
+            temp_path = f"{watermark_path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(processed_watermark)
+            os.replace(temp_path, watermark_path)
+        self.queue.update_settings(
+            share_image=share_image, save_profile=save_profile, force=force, strict=strict,
+            max_attempts=self.max_attempts
+        )
+        tasks = 0
+        for input_pdf_path, output_pdf_path in jobs:
+            with fitz.open(input_pdf_path) as pdf:
+                pages = pdf.page_count
+            page_ranges = []
+            if pages > self.range_pages:
+                page_ranges = [(start, min(start + self.range_pages, pages)) for start in range(0, pages, self.range_pages)]
+            self.queue.add_job(os.path.abspath(input_pdf_path), os.path.abspath(output_pdf_path), pages, page_ranges, digest)
+            tasks += len(page_ranges) or 1
+        logging.info("Queued %s documents as %s tasks in %s", len(jobs), tasks, self.work_dir)
+        return tasks
+
+    def finalize(self, job, tasks):
+        """
+        Builds the output of a job whose tasks are settled: moves the part of
+        a whole-document task, or merges the page-range parts.
+
+        Returns:
+            dict: Result record of the job, like those of batch mode.
+        """
+        record = {
+            'input': job['input'], 'output': job['output'], 'pages': job['pages'], 'tasks': len(tasks),
+            'workers': sorted({task['worker'] for task in tasks if task['worker']}),
+        }
+        results = [json.loads(task['result']) if task['result'] else None for task in tasks]
+        try:
+            failed_tasks = [task for task in tasks if task['status'] != 'done']
+            if failed_tasks:
+                raise RuntimeError(f"task {failed_tasks[0]['id']} failed: {failed_tasks[0]['error']}")
+            os.makedirs(os.path.dirname(job['output']), exist_ok=True)
+            failed_pages = sorted(page for result in results for page in result['failed_pages'])
+            settings = self.queue.settings()
+            if tasks[0]['start'] is None:
+                shutil.move(results[0]['part'], job['output'])
+                if results[0].get('skipped'):
+                    record['skipped'] = results[0]['skipped']
+            else:
+                record['merging'], record['saving'] = merge_page_ranges(
+                    job['input'], job['output'], [result['part'] for result in results],
+                    [result['image_name'] for result in results], settings['share_image'], settings['save_profile']
+                )
+                if not failed_pages:
+                    record['saving'] += mark_watermarked(job['output'], job['watermark'])
+            if failed_pages:
+                record['failed_pages'] = failed_pages
+            record['output_size'] = os.path.getsize(job['output'])
+            record['status'] = 'ok'
+        except Exception as e:
+            logging.error("Failed to watermark %s: %s", job['input'], e)
+            record['status'] = 'error'
+            record['error'] = str(e)
+        finally:
+            for result in results:
+                if result:
+                    with contextlib.suppress(OSError):
+                        os.remove(result['part'])
+        record['total_time'] = time.time() - job['submitted']
+        return record
+
+    def run(self, poll_interval=DEFAULT_POLL_INTERVAL, on_record=None, worker_timeout=DEFAULT_WORKER_TIMEOUT):
+        """
+        Closes the queue to new documents, then finalizes documents as their
+        tasks settle until none is left. Expired leases are requeued, or
+        failed after max_attempts attempts, on every poll.
+
+        Args:
+            poll_interval (float): Seconds between polls of the queue.
+            on_record (callable): Called with each result record as its document finishes.
+            worker_timeout (float): Seconds without a leased or finished task
+                after which the queued tasks are failed; None waits for
+                workers indefinitely.
+
+        Returns:
+            list: Result records of every document of the queue, in submission order.
+        """
+        self.queue.update_settings(closed=True)
+        progress = None
+        progress_time = time.time()
+        while True:
+            self.queue.expire_leases(self.max_attempts)
+            for job, tasks in self.queue.settled_jobs():
+                record = self.finalize(job, tasks)
+                self.queue.finish_job(job['id'], record)
+                logging.info("Watermarked %s (%s)", job['input'], record['status'])
+                if on_record:
+                    on_record(record)
+            counts = self.queue.counts()
+            if not counts['running_jobs']:
+                break
+            if counts.get('leased') or (counts.get('done'), counts.get('failed')) != progress:
+                progress = (counts.get('done'), counts.get('failed'))
+                progress_time = time.time()
+            elif worker_timeout is not None and time.time() - progress_time > worker_timeout:
+                failed = self.queue.fail_pending(f"no worker claimed the task within {worker_timeout:g} seconds")
+                logging.error("No worker claimed a task within %g seconds; failed %d queued tasks", worker_timeout, failed)
+                continue
+            time.sleep(poll_interval)
+        return self.queue.records()
+
+def start_local_workers(work_dir, count, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Starts worker processes on this host, standing in for the workers of
+    other nodes; they exit once the queue is drained.
+
+    Returns:
+        list: The subprocess.Popen objects.
+    """
+    command = [sys.executable, os.path.abspath(__file__), "worker", "--work-dir", work_dir, "--lease", str(lease_seconds)]
+    return [subprocess.Popen(command + ["--worker-id", f"{socket.gethostname()}:local-{index}"]) for index in range(count)]
+
+def main(argv=None):
+    """
+    Main function to run a coordinator or a worker.
+    """
+    parser = argparse.ArgumentParser(description="Watermark a batch of PDFs on several hosts sharing a work directory.")
+    subparsers = parser.add_subparsers(dest="role", required=True)
+    coordinator_parser = subparsers.add_parser("coordinator", help="Queue a batch, then build the outputs from the parts written by workers.")
+    coordinator_parser.add_argument("watermark_image", nargs="?", help="Path to the watermark image file, or a PDF/SVG logo drawn as vector content.")
+    coordinator_parser.add_argument("--batch", help="Directory of PDFs, glob pattern, or JSONL manifest of input/output pairs.")
+    coordinator_parser.add_argument("--output-dir", help="Directory for watermarked PDFs (directory and glob sources).")
+    coordinator_parser.add_argument("--resume", action='store_true', help="Carry on with the documents already queued in --work-dir instead of queueing a batch.")
+    coordinator_parser.add_argument("--results", help="Path of a JSONL file receiving one result record per document.")
+    coordinator_parser.add_argument("--text", help="Draw this text as a vector watermark instead of an image.")
+    coordinator_parser.add_argument("--rotation", type=float, default=0, help="Counter-clockwise rotation of vector watermarks in degrees.")
+    coordinator_parser.add_argument("--opacity", type=float, default=0.2, help="Opacity level for the watermark (0 to 1).")
+    coordinator_parser.add_argument("--watermark-dpi", type=int, default=DEFAULT_WATERMARK_DPI, help="Resolution the watermark image is downsampled to; 0 keeps the source resolution. Default is 150.")
+    coordinator_parser.add_argument("--save-profile", choices=SAVE_PROFILES, default="fast", help="Output save options: fast, balanced or smallest. Default is fast.")
+    coordinator_parser.add_argument("--no-share-image", action='store_true', help="Embed the watermark image separately on every page.")
+    coordinator_parser.add_argument("--force", action='store_true', help="Watermark documents even if they are already watermarked.")
+    coordinator_parser.add_argument("--strict", action='store_true', help="Fail documents with pages that cannot be watermarked.")
+    coordinator_parser.add_argument("--range-pages", type=int, default=DEFAULT_RANGE_PAGES, help="Split documents with more pages than this into page ranges of this size. Default is 2000.")
+    coordinator_parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="Attempts per task before its document fails. Default is 3.")
+    coordinator_parser.add_argument("--worker-timeout", type=float, default=DEFAULT_WORKER_TIMEOUT, help="Seconds without a leased or finished task after which the queued tasks fail, so the run ends if every worker is gone; 0 waits indefinitely. Default is 600.")
+    coordinator_parser.add_argument("--local-workers", type=int, default=0, help="Also start this many worker processes on this host.")
+    worker_parser = subparsers.add_parser("worker", help="Run queued tasks until the coordinator's queue is drained.")
+    worker_parser.add_argument("--worker-id", help="Name recorded with claimed tasks. Default is host:pid.")
+    worker_parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL, help="Seconds to wait when no task is available. Default is 0.5.")
+    for role_parser in (coordinator_parser, worker_parser):
+        role_parser.add_argument("--work-dir", required=True, help="Work directory shared by the coordinator and all workers.")
+        role_parser.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS, help="Seconds a task stays leased to a worker that stopped renewing it. Default is 60.")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    if args.role == "worker":
+        run_worker(args.work_dir, args.worker_id, args.lease, args.poll_interval)
+        return
+
+    coordinator = Coordinator(args.work_dir, args.range_pages, args.max_attempts)
+    if not args.resume:
+        if not args.batch:
+            parser.error("--batch is required unless --resume is given")
+        if not args.watermark_image and not args.text:
+            parser.error("a watermark image or --text is required")
+        try:
+            jobs = collect_batch_jobs(args.batch, args.output_dir)
+            coordinator.submit(
+                jobs, args.watermark_image, args.opacity, args.watermark_dpi, {'text': args.text, 'rotation': args.rotation},
+                not args.no_share_image, args.save_profile, args.force, args.strict
+            )
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    workers = start_local_workers(coordinator.work_dir, args.local_workers, args.lease)
+    results_file = open(args.results, "w") if args.results else None
+    try:
+        def on_record(record):
+            print(json.dumps(record), flush=True)
+            if results_file:
+                results_file.write(json.dumps(record) + "\n")
+                results_file.flush()
+        records = coordinator.run(on_record=on_record, worker_timeout=args.worker_timeout or None)
+    finally:
+        if results_file:
+            results_file.close()
+        for worker in workers:
+            worker.wait()
+    if any(record['status'] != 'ok' for record in records):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import signal
+import socketserver
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+try:
+    # The legacy "fitz" name prints a deprecation notice to stdout
+    import pymupdf as fitz
+except ImportError:
+    import fitz
+from watermark_cache import DEFAULT_CACHE_DIR, WatermarkCache, set_default_cache
+from watermark_client import DEFAULT_ADDRESS, STREAM_CHUNK_SIZE, parse_address
+from watermark_pdf import (
+    AUTO_ENGINE, DEFAULT_WATERMARK_DPI, load_watermark, plan_watermarking, preflight, setup_logging,
+    watermark_document, watermark_target_size
+)
+
+def parse_bool(value):
+    """
+    Accepts JSON booleans as well as query-string spellings of them.
+    """
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+# Options a job may set, with the conversion applied to their values
+JOB_OPTIONS = {
+    'watermark': str,
+    'opacity': float,
+    'engine': str,
+    'share_image': parse_bool,
+    'watermark_dpi': int,
+    'chunk_size': int,
+    'incremental': parse_bool,
+    'save_profile': str,
+    'text': str,
+    'rotation': float,
+    'font': str,
+    'font_size': float,
+    'color': str,
+    'overwrite': parse_bool,
+}
+
+# Options passed to prepare_vector_watermark rather than watermark_document
+VECTOR_OPTIONS = ("text", "rotation", "font", "font_size", "color")
+
+# Job options naming files the daemon reads or writes
+PATH_OPTIONS = ("input", "output", "watermark", "font")
+
+# Uploads bring their own input and get a private output
+UPLOAD_PATH_OPTIONS = ("watermark", "font")
+
+# Jobs already run inside a pool worker, so engines that start their own
+# process pool are excluded; "auto" plans for a single worker
+DAEMON_ENGINES = ("serial", "thread", "stream", AUTO_ENGINE)
+
+def parse_job(fields):
+    """
+    Validates and converts the fields of a job request.
+
+    Args:
+        fields (dict): Input and output paths plus any of JOB_OPTIONS.
+
+    Returns:
+        dict: The job with converted option values.
+
+    Raises:
+        ValueError: If a field is unknown, missing or malformed.
+    """
+    unknown = set(fields) - set(JOB_OPTIONS) - {'input', 'output'}
+    if unknown:
+        raise ValueError(f"Unknown job options: {', '.join(sorted(unknown))}")
+    if not fields.get('input') or not fields.get('output'):
+        raise ValueError("A job needs an input and an output path")
+    if not fields.get('watermark') and not fields.get('text'):
+        raise ValueError("A job needs a watermark file or a text")
+    job = {'input': str(fields['input']), 'output': str(fields['output'])}
+    for name, convert in JOB_OPTIONS.items():
+        if fields.get(name) is not None:
+            job[name] = convert(fields[name])
+    if job.get('engine', 'serial') not in DAEMON_ENGINES:
+        raise ValueError(f"Unsupported engine {job['engine']!r}; expected one of {', '.join(DAEMON_ENGINES)}")
+    return job
+
+def check_job_paths(job, roots=(), names=PATH_OPTIONS):
+    """
+    Checks that a job may read its input, watermark and font file and write
+    its output. Other local users can reach the daemon, so with roots
+    configured all of them must lie inside one of them, and an existing
+    output is only replaced if the job sets "overwrite".
+
+    Args:
+        job (dict): A job returned by parse_job.
+        roots (tuple): Directories jobs are confined to; empty allows any path.
+        names (tuple): The path options to check (see PATH_OPTIONS).
+
+    Raises:
+        ValueError: If the job may not use its paths.
+    """
+    if roots:
+        for name in names:
+            if job.get(name) is None:
+                continue
+            # A font that is not a file is a base-14 font name
+            if name == 'font' and not os.path.isfile(job[name]):
+                continue
+            path = os.path.realpath(job[name])
+            if not any(os.path.commonpath((path, root)) == root for root in roots):
+                raise ValueError(f"The {name} path {job[name]} is outside the daemon's root directories")
+    if 'output' in names and os.path.lexists(job['output']) and not job.get('overwrite'):
+        raise ValueError(f"The output {job['output']} exists; set overwrite to replace it")
+
+def run_job(job):
+    """
+    Worker entry point: prepares the watermark through the worker's warm cache
+    and watermarks one document, reporting the outcome instead of raising.
+
+    Args:
+        job (dict): A job returned by parse_job.
+
+    Returns:
+        dict: Result record with the status, timing data and any error.
+    """
+    start_time = time.time()
+    record = {'input': job['input'], 'output': job['output']}
+    try:
+        with fitz.open(job['input']) as pdf:
+            max_side = watermark_target_size(pdf, job.get('watermark_dpi', DEFAULT_WATERMARK_DPI))
+        vector_options = {name: job[name] for name in VECTOR_OPTIONS if name in job}
+        processed_watermark = load_watermark(job.get('watermark'), job.get('opacity', 0.2), max_side, **vector_options)
+        record['watermark_preparation'] = time.time() - start_time
+        engine = job.get('engine', 'serial')
+        options = {name: job[name] for name in ('chunk_size', 'incremental', 'save_profile') if name in job}
+        if engine == AUTO_ENGINE:
+            # With a single worker the plan never chooses the process engine
+            plan = plan_watermarking(
+                preflight(job['input']), max_workers=1, chunk_size=job.get('chunk_size'),
+                save_profile=job.get('save_profile'), incremental=job.get('incremental', False)
+            )
+            engine = plan['engine']
+            options.update(chunk_size=plan['chunk_size'], save_profile=plan['save_profile'])
+        record.update(watermark_document(
+            job['input'], job['output'], processed_watermark,
+            share_image=job.get('share_image', True),
+            engine=engine,
+            **options
+        ))
+        record['status'] = 'ok'
+    except Exception as e:
+        logging.error("Failed to watermark %s: %s", job['input'], e)
+        record['status'] = 'error'
+        record['error'] = str(e)
+    record['total_time'] = time.time() - start_time
+    return record
+
+class WatermarkRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP API of the daemon:
+
+    GET  /health     Daemon status as JSON.
+    POST /jobs       JSON job with input and output paths; replies with the result record.
+                     Paths are checked by check_job_paths.
+    POST /watermark  PDF upload, job options in the query string; replies with
+                     the watermarked PDF and the result record in the
+                     X-Watermark-Result header. The watermark and font
+                     paths are checked by check_job_paths.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/health":
+            self.send_json(404, {'error': f"Unknown endpoint {self.path}"})
+            return
+        self.send_json(200, self.server.status())
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.send_json(411, {'error': "Content-Length is required"}, {"Connection": "close"})
+            return
+        if url.path == "/jobs":
+            self.handle_job(length)
+        elif url.path == "/watermark":
+            self.handle_upload(length, dict(parse_qsl(url.query)))
+        else:
+            # The unread body would otherwise be taken for the next request
+            self.send_json(404, {'error': f"Unknown endpoint {url.path}"}, {"Connection": "close"})
+
+    def handle_job(self, length):
+        try:
+            job = parse_job(json.loads(self.rfile.read(length)))
+            check_job_paths(job, self.server.roots)
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        record = self.server.run(job)
+        self.send_json(200 if record['status'] == 'ok' else 500, record)
+
+    def handle_upload(self, length, options):
+        with tempfile.TemporaryDirectory(prefix="watermark_daemon_") as temp_dir:
+            input_pdf = os.path.join(temp_dir, "input.pdf")
+            output_pdf = os.path.join(temp_dir, "output.pdf")
+            with open(input_pdf, "wb") as f:
+                remaining = length
+                while remaining:
+                    chunk = self.rfile.read(min(STREAM_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if remaining:
+                # The client went away; a truncated document must not be watermarked
+                self.send_json(400, {'error': f"Upload ended {remaining} bytes short of its Content-Length"}, {"Connection": "close"})
+                return
+            try:
+                job = parse_job(dict(options, input=input_pdf, output=output_pdf))
+                check_job_paths(job, self.server.roots, UPLOAD_PATH_OPTIONS)
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            record = self.server.run(job)
+            # The paths are private to this request
+            del record['input'], record['output']
+            if record['status'] != 'ok':
+                self.send_json(500, record)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            self.send_header("Content-Length", str(os.path.getsize(output_pdf)))
+            self.send_header("X-Watermark-Result", json.dumps(record))
+            self.end_headers()
+            with open(output_pdf, "rb") as f:
+                shutil.copyfileobj(f, self.wfile, STREAM_CHUNK_SIZE)
+
+class WatermarkServerMixin:
+    """
+    State shared by the TCP and Unix-socket servers: the warm worker pool and
+    job counters.
+    """
+    daemon_threads = True
+
+    def setup_state(self, executor, max_workers, roots=()):
+        self.executor = executor
+        self.max_workers = max_workers
+        self.roots = tuple(os.path.realpath(root) for root in roots)
+        self.started = time.time()
+        self.jobs_served = 0
+        self.jobs_failed = 0
+        self._counter_lock = threading.Lock()
+
+    def run(self, job):
+        """
+        Runs a job on the worker pool and waits for its record.
+        """
+        record = self.executor.submit(run_job, job).result()
+        with self._counter_lock:
+            self.jobs_served += 1
+            if record['status'] != 'ok':
+                self.jobs_failed += 1
+        logging.info("Job %s finished (%s) in %.3f seconds.", job['input'], record['status'], record['total_time'])
+        return record
+
+    def status(self):
+        with self._counter_lock:
+            return {
+                'status': 'ok',
+                'pid': os.getpid(),
+                'workers': self.max_workers,
+                'uptime': time.time() - self.started,
+                'jobs_served': self.jobs_served,
+                'jobs_failed': self.jobs_failed,
+            }
+
+class WatermarkHTTPServer(WatermarkServerMixin, ThreadingHTTPServer):
+    pass
+
+class WatermarkUnixServer(WatermarkServerMixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    pass
+
+def create_server(address, executor, max_workers, roots=()):
+    """
+    Binds the daemon to a TCP or Unix-socket address.
+
+    Args:
+        address (str): "host:port" or "unix:/path/to/socket".
+        executor (ProcessPoolExecutor): Warm pool the jobs run on.
+        max_workers (int): Size of the pool, reported by /health.
+        roots (tuple): Directories path jobs are confined to (see check_job_paths).
+
+    Returns:
+        socketserver.BaseServer: The bound server, not yet serving.
+    """
+    location = parse_address(address)
+    if location[0] == "unix":
+        # A socket file left by a previous daemon would make bind fail
+        if os.path.exists(location[1]):
+            os.remove(location[1])
+        server = WatermarkUnixServer(location[1], WatermarkRequestHandler)
+    else:
+        server = WatermarkHTTPServer((location[1], location[2]), WatermarkRequestHandler)
+    server.setup_state(executor, max_workers, roots)
+    return server
+
+def start_workers(max_workers):
+    """
+    Starts the job pool and makes every worker process start right away, so
+    the first jobs do not pay for it.
+    """
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    for future in [executor.submit(os.getpid) for _ in range(max_workers)]:
+        future.result()
+    return executor
+
+def serve(address=DEFAULT_ADDRESS, max_workers=4, roots=()):
+    """
+    Runs the daemon until it is interrupted or receives SIGTERM.
+
+    Args:
+        address (str): "host:port" or "unix:/path/to/socket".
+        max_workers (int): Number of worker processes running jobs.
+        roots (tuple): Directories path jobs are confined to (see check_job_paths).
+    """
+    executor = start_workers(max_workers)
+    server = create_server(address, executor, max_workers, roots)
+    # SIGTERM shuts down like Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logging.info("Watermark daemon listening on %s with %s workers (pid %s).", address, max_workers, os.getpid())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        executor.shutdown()
+        location = parse_address(address)
+        if location[0] == "unix" and os.path.exists(location[1]):
+            os.remove(location[1])
+        logging.info("Watermark daemon stopped.")
+
+def main(argv=None):
+    """
+    Main function to run the watermark daemon.
+    """
+    parser = argparse.ArgumentParser(description="Resident watermarking service with a local HTTP API.")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="host:port or unix:/path/to/socket to listen on. Default is 127.0.0.1:8765.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of worker processes running jobs.")
+    parser.add_argument("--cache-dir", help="Directory of the shared prepared-watermark cache.")
+    parser.add_argument("--cache-size", type=int, default=256, help="Size budget of the watermark cache directory in MB.")
+    parser.add_argument("--root", action="append", default=[], metavar="DIR", help="Confine the inputs, outputs and watermarks of path jobs to this directory; may be repeated. Default: any path the daemon user can access.")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    # Set before the pool starts, so forked workers inherit it
+    set_default_cache(WatermarkCache(args.cache_dir or DEFAULT_CACHE_DIR, max_disk_bytes=args.cache_size * 1024 * 1024))
+    serve(args.address, args.workers, args.root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import contextlib
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+DEFAULT_INDEX_PATH = os.path.join(tempfile.gettempdir(), "watermark_index.sqlite3")
+DEFAULT_MAX_ENTRIES = 10000
+
+# Block size for hashing input files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    output_path TEXT NOT NULL,
+    output_size INTEGER NOT NULL,
+    output_mtime_ns INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+CREATE TABLE IF NOT EXISTS file_digests (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS file_digests_last_used ON file_digests (last_used);
+"""
+
+class ResultIndex:
+    """
+    SQLite index of finished watermarking runs, so that a run repeated with
+    the same input and settings can reuse the earlier output instead of
+    watermarking again.
+
+    Results are keyed by the SHA-256 of the input file and a digest of the
+    watermark settings. The index does not own the outputs: a result is only
+    reused while its output still exists with the size and modification time
+    recorded, and results whose output changed or disappeared are dropped on
+    lookup. Input digests are remembered by path, size and modification time,
+    so an unchanged input is not read again. Both tables keep at most
+    max_entries rows, dropping the least recently used ones. Every call opens
+    its own connection, so an index can be shared by threads and processes.
+
+    Args:
+        path (str): Path of the SQLite database.
+        max_entries (int): Largest number of results (and of input digests) kept.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # One transaction per call; WAL lets readers in other processes proceed during writes
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def make_key(input_digest, settings_digest):
+        """
+        Returns the key of a run from the digest of its input and of its settings.
+        """
+        return hashlib.sha256(f"{input_digest}:{settings_digest}".encode()).hexdigest()
+
+    def file_digest(self, path):
+        """
+        Returns the SHA-256 of a file, hashing it only if it changed since the
+        index last saw it.
+        """
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT digest FROM file_digests WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+            if row:
+                connection.execute("UPDATE file_digests SET last_used = ? WHERE path = ?", (time.time(), path))
+                return row[0]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, digest.hexdigest(), time.time())
+            )
+            self._trim(connection, "file_digests")
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        """
+        Returns the output recorded for a key if it is still unchanged.
+
+        Returns:
+            str: Path of the earlier output, or None.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT output_path, output_size, output_mtime_ns FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            output_path, size, mtime_ns = row
+            try:
+                stat = os.stat(output_path)
+                unchanged = (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns)
+            except OSError:
+                unchanged = False
+            if not unchanged:
+                logging.debug("Dropping indexed result %s: the output changed or is gone", output_path)
+                connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            return output_path
+
+    def record(self, key, output_path):
+        """
+        Records the output of a finished run.
+        """
+        output_path = os.path.abspath(output_path)
+        stat = os.stat(output_path)
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (key, output_path, stat.st_size, stat.st_mtime_ns, now, now)
+            )
+            self._trim(connection, "results")
+
+    def _trim(self, connection, table):
+        # Table names are constants of this module, never user input
+        connection.execute(
+            f"DELETE FROM {table} WHERE rowid IN "
+            f"(SELECT rowid FROM {table} ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
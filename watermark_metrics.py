@@ -0,0 +1,280 @@
+import bisect
+import collections
+import contextlib
+import json
+import math
+import os
+import sys
+import threading
+
+# Histogram buckets grow geometrically from 1 microsecond, four per doubling
+# (about 19% wide) up to several minutes, so percentiles stay within a few
+# percent without keeping every sample
+HISTOGRAM_MIN_SECONDS = 1e-6
+HISTOGRAM_BUCKETS_PER_DOUBLING = 4
+HISTOGRAM_DOUBLINGS = 28
+HISTOGRAM_BOUNDS = tuple(
+    HISTOGRAM_MIN_SECONDS * 2 ** (index / HISTOGRAM_BUCKETS_PER_DOUBLING)
+    for index in range(HISTOGRAM_DOUBLINGS * HISTOGRAM_BUCKETS_PER_DOUBLING + 1)
+)
+
+# Quantiles reported for every stage
+SUMMARY_QUANTILES = (0.5, 0.9, 0.99)
+
+# Seconds between two stack samples of StackSampler
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram. Recording a value is a bisect and an
+    increment, and histograms from several processes add up bucket by bucket.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, quantile):
+        """
+        Estimates a quantile (0 to 1) by interpolating within its bucket.
+
+        Returns:
+            float: The estimate in seconds, or 0 for an empty histogram.
+        """
+        if not self.count:
+            return 0.0
+        target = quantile * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= target:
+                lower = HISTOGRAM_BOUNDS[index - 1] if index else 0.0
+                upper = HISTOGRAM_BOUNDS[index] if index < len(HISTOGRAM_BOUNDS) else self.max
+                value = lower + (upper - lower) * (target - seen) / count
+                return min(max(value, self.min), self.max)
+            seen += count
+        return self.max
+
+    def summary(self):
+        """
+        Returns the count, total, maximum and SUMMARY_QUANTILES in seconds.
+        """
+        summary = {'count': self.count, 'total': round(self.total, 6), 'max': round(self.max, 6)}
+        for quantile in SUMMARY_QUANTILES:
+            summary[f"p{quantile * 100:g}"] = round(self.percentile(quantile), 6)
+        return summary
+
+class StageMetrics:
+    """
+    Per-stage latency histograms and peak memory of a watermarking run.
+    Stages are named by the code that records them: "open", "prepare",
+    "page" (one observation per watermarked page), "merge" and "save".
+
+    Recording takes a lock, so the thread engine can record pages
+    concurrently. Instances pickle without the lock, so process-engine
+    workers can send theirs back to be merged.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.peak_rss_mb = 0.0
+        self.worker_peak_rss_mb = 0.0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def merge(self, other):
+        """
+        Adds the observations of a worker's metrics; its peak memory counts
+        towards worker_peak_rss_mb.
+        """
+        with self._lock:
+            for stage, histogram in other.histograms.items():
+                self.histograms.setdefault(stage, Histogram()).merge(histogram)
+            self.worker_peak_rss_mb = max(self.worker_peak_rss_mb, other.peak_rss_mb, other.worker_peak_rss_mb)
+
+    def summary(self):
+        """
+        Returns the summary of every stage and the peak memory, as included
+        in the timing data.
+        """
+        summary = {
+            'stages': {stage: histogram.summary() for stage, histogram in self.histograms.items()},
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+        }
+        if self.worker_peak_rss_mb:
+            summary['worker_peak_rss_mb'] = round(self.worker_peak_rss_mb, 1)
+        return summary
+
+    def to_dict(self):
+        """
+        Returns the summary together with the non-empty buckets of every
+        stage as [upper bound, count] pairs; the last bound may be Infinity.
+        """
+        data = self.summary()
+        for stage, histogram in self.histograms.items():
+            data['stages'][stage]['buckets'] = [
+                [HISTOGRAM_BOUNDS[index] if index < len(HISTOGRAM_BOUNDS) else math.inf, count]
+                for index, count in enumerate(histogram.counts) if count
+            ]
+        return data
+
+    def to_prometheus(self, prefix="watermark"):
+        """
+        Returns the metrics in the Prometheus text exposition format: one
+        histogram with a bucket per doubling, the quantiles of every stage
+        and the peak memory in bytes.
+        """
+        lines = [
+            f"# HELP {prefix}_stage_seconds Duration of watermarking stages.",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for index, count in enumerate(histogram.counts[:-1]):
+                cumulative += count
+                if index % HISTOGRAM_BUCKETS_PER_DOUBLING == 0:
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{HISTOGRAM_BOUNDS[index]:.6g}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram.total:.9g}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        lines += [
+            f"# HELP {prefix}_stage_quantile_seconds Estimated quantiles of stage durations.",
+            f"# TYPE {prefix}_stage_quantile_seconds gauge",
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            for quantile in SUMMARY_QUANTILES:
+                lines.append(f'{prefix}_stage_quantile_seconds{{stage="{stage}",quantile="{quantile:g}"}} {histogram.percentile(quantile):.9g}')
+        lines += [
+            f"# HELP {prefix}_peak_rss_bytes Peak resident set size.",
+            f"# TYPE {prefix}_peak_rss_bytes gauge",
+            f'{prefix}_peak_rss_bytes{{process="main"}} {int(self.peak_rss_mb * 1024 * 1024)}',
+        ]
+        if self.worker_peak_rss_mb:
+            lines.append(f'{prefix}_peak_rss_bytes{{process="worker"}} {int(self.worker_peak_rss_mb * 1024 * 1024)}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Writes the metrics to a file: Prometheus text for a .prom file, JSON
+        (see to_dict) otherwise.
+        """
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+
+# Metrics of the run in progress in this process, if any
+_current_metrics = None
+
+def current_metrics():
+    """
+    Returns the StageMetrics receiving observations, or None.
+    """
+    return _current_metrics
+
+@contextlib.contextmanager
+def collect_metrics(metrics):
+    """
+    Makes observe_stage record into metrics for the duration of the block.
+    Like the event stream, collection is per process, so runs that should
+    be measured separately must not overlap in one process.
+
+    Yields:
+        StageMetrics: The metrics passed in.
+    """
+    global _current_metrics
+    previous = _current_metrics
+    _current_metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _current_metrics = previous
+
+def observe_stage(stage, seconds):
+    """
+    Records the duration of a stage in the current metrics, if any.
+    """
+    metrics = _current_metrics
+    if metrics is not None:
+        metrics.observe(stage, seconds)
+
+class StackSampler:
+    """
+    Sampling profiler: a background thread records the stacks of the other
+    threads of this process at a fixed interval. Unlike cProfile, the
+    profiled code runs at full speed between samples. Stacks are written in
+    the collapsed format of flame graph tools ("frame;frame;... count").
+    Worker processes of the process engine are not sampled.
+
+    Args:
+        interval (float): Seconds between samples.
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        """
+        Writes the collapsed stacks, most frequent first.
+        """
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
@@ -1,19 +1,171 @@
-import fitz  # PyMuPDF for PDF processing
-from PIL import Image
-from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    # Importing the legacy "fitz" name prints a deprecation notice to stdout in
+    # recent PyMuPDF releases, which would corrupt a PDF written to stdout
+    import pymupdf as fitz  # PyMuPDF for PDF processing
+except ImportError:
+    import fitz
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import asyncio
+import contextlib
+import mmap
+import stat
+import heapq
+import itertools
 import tempfile
+import shutil
+import io
+import threading
 import os
+import re
 import logging
+import logging.handlers
+import multiprocessing
+import atexit
 import time
 import argparse
+import math
+import glob
+import hashlib
 import json
 import sys
-import psutil
-import cProfile
-import pstats
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+from watermark_cache import DEFAULT_CACHE_DIR, WatermarkCache, get_default_cache, set_default_cache
+from watermark_index import DEFAULT_INDEX_PATH, DEFAULT_MAX_ENTRIES, ResultIndex
+from watermark_metrics import DEFAULT_SAMPLE_INTERVAL, StackSampler, StageMetrics, collect_metrics, current_metrics, observe_stage
+# PIL, psutil and cProfile are imported where they are used, which keeps
+# startup short for callers that do not reach those paths
+
+# Page-processing engines selectable with --engine; "auto" lets plan_watermarking choose
+ENGINES = ("process", "thread", "serial", "stream")
+AUTO_ENGINE = "auto"
+
+# Resolution the watermark is prepared for; --watermark-dpi 0 keeps the source resolution
+DEFAULT_WATERMARK_DPI = 150
+
+# Longest page side, in points, batch mode prepares the watermark for (17in, tabloid)
+BATCH_REFERENCE_PAGE_SIDE = 1224
+
+# Watermark files drawn as vector content instead of raster images
+VECTOR_EXTENSIONS = (".pdf", ".svg")
+
+# Defaults for text watermarks
+DEFAULT_FONT = "helv"
+DEFAULT_FONT_SIZE = 48
+DEFAULT_TEXT_COLOR = "#808080"
+
+# Pages per chunk of the stream engine
+DEFAULT_CHUNK_SIZE = 500
+
+# pdf.save options of the profiles selectable with --save-profile
+SAVE_PROFILES = {
+    "fast": {},
+    "balanced": {"garbage": 1, "deflate": True, "use_objstms": 1},
+    "smallest": {"garbage": 4, "deflate": True, "clean": True, "use_objstms": 1},
+}
+
+# Priorities of jobs run by JobScheduler; lower values run first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Defaults of JobScheduler: pages in flight across all jobs, pages per chunk, queued jobs
+DEFAULT_PAGE_BUDGET = 1000
+DEFAULT_SCHEDULER_CHUNK_SIZE = 200
+DEFAULT_MAX_QUEUED_JOBS = 100
+
+# Event stream (--events): buffer size, longest delay before progress events are flushed, resource sample interval
+EVENT_BUFFER_SIZE = 64 * 1024
+EVENT_FLUSH_INTERVAL = 0.1
+RESOURCE_SAMPLE_INTERVAL = 1.0
+
+# Page ranges per worker process, giving the adaptive scheduler work to hold back
+RANGES_PER_WORKER = 4
+
+# Bumped whenever watermark placement changes, so outputs of earlier versions are not taken for current ones
+PLACEMENT_VERSION = 2
+
+# Key of the document information dictionary recording which watermark a PDF carries
+WATERMARK_MARKER_KEY = "WatermarkDigest"
+
+# Extra attempts strict mode gives a page that failed to be watermarked
+PAGE_RETRIES = 1
+
+# Manifest of finished page ranges in a checkpoint directory (see Checkpoint)
+CHECKPOINT_MANIFEST = "manifest.json"
+CHECKPOINT_VERSION = 1
+
+# Cost model of plan_watermarking, fitted to tests/benchmark.py runs of the
+# quick suite: seconds per page watermarked serially, start-up of the process
+# engine and of each of its workers, seconds per page merging the parts, and
+# the stream engine's time relative to the serial engine
+PLAN_PAGE_SECONDS = 0.0007
+PLAN_PROCESS_STARTUP_SECONDS = 0.2
+PLAN_WORKER_STARTUP_SECONDS = 0.05
+PLAN_MERGE_PAGE_SECONDS = 0.00035
+PLAN_STREAM_FACTOR = 1.2
+
+# Resident memory each worker process adds, in MB, and the share of the
+# available memory the workers may take
+PLAN_WORKER_RSS_MB = 50
+PLAN_WORKER_MEMORY_SHARE = 0.5
+
+# Fewest pages worth a worker process of their own
+PLAN_MIN_PAGES_PER_WORKER = 500
+
+# Share of the file taken by images above which the process engine is not
+# chosen: merging its parts made scanned documents 4-6 times larger
+PLAN_IMAGE_HEAVY_SHARE = 0.5
+
+# Documents watermarked in bounded memory by the stream engine: from this
+# many pages, or from this share of the available memory by file size
+PLAN_STREAM_MIN_PAGES = 20000
+PLAN_STREAM_MEMORY_SHARE = 0.25
+
+# Input bytes per chunk of the stream engine, and the bounds of its chunk size
+PLAN_CHUNK_BYTES = 32 * 1024 * 1024
+PLAN_MIN_CHUNK_SIZE = 100
+PLAN_MAX_CHUNK_SIZE = 2000
+
+# Entries of PDF objects read by preflight
+PDF_LENGTH_PATTERN = re.compile(r"/Length\s*(\d+)(\s+0\s+R)?")
+PDF_CONTENTS_PATTERN = re.compile(r"/Contents\s*(\[[^\]]*\]|\d+\s+0\s+R)")
+PDF_REFERENCE_PATTERN = re.compile(r"(\d+)\s+0\s+R")
+PDF_PAGE_TYPE_PATTERN = re.compile(r"/Type\s*/Page(?![\w])")
+
+# Progress log lines: one every PROGRESS_LOG_PAGES pages or PROGRESS_LOG_INTERVAL seconds, and one at the end
+PROGRESS_LOG_PAGES = 100
+PROGRESS_LOG_INTERVAL = 5.0
+
+# Fan-out: threads writing variant outputs, and serialised outputs waiting
+# for them before the next variant is saved, which bounds memory
+FANOUT_WRITERS = 4
+FANOUT_PENDING_WRITES = 4
+
+# Keys a fan-out variant may set, on top of "output"
+FANOUT_VARIANT_KEYS = ("watermark", "opacity", "text", "rotation", "font", "font_size", "color")
+
+# Listener writing the queued log records, started by the first setup_logging call
+_log_listener = None
 
-# Configuring logging to write to both stderr and a log file
 def setup_logging(log_file='watermark_log.log'):
+    """
+    Configures logging to write to both stderr and a log file. Records are
+    put on a queue and written by a listener thread, so the watermarking
+    loops never wait on the terminal or the disk. The queue is a
+    multiprocessing queue, so records of forked worker processes reach the
+    same handlers. Later calls in the same process are no-ops.
+
+    Args:
+        log_file (str): Path of the log file.
+
+    Returns:
+        logging.handlers.QueueListener: The listener writing the records.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return _log_listener
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
@@ -24,215 +176,2909 @@ def setup_logging(log_file='watermark_log.log'):
     sh = logging.StreamHandler(sys.stderr)
     sh.setLevel(logging.INFO)
     sh.setFormatter(formatter)
-    logger.addHandler(sh)
 
     # FileHandler for logging to a file
     fh = logging.FileHandler(log_file)
     fh.setLevel(logging.INFO)
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
 
-def prepare_watermark(watermark_image_path, opacity=0.2):
+    log_queue = multiprocessing.Queue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _log_listener = logging.handlers.QueueListener(log_queue, sh, fh, respect_handler_level=True)
+    _log_listener.start()
+    # Writes the records still queued before the interpreter exits
+    atexit.register(stop_logging)
+    return _log_listener
+
+def flush_logging():
+    """
+    Writes the log records queued so far, for output that has to follow them
+    on the same stream.
+    """
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener.start()
+
+def stop_logging():
+    """
+    Writes the queued log records and stops the listener started by
+    setup_logging. Records logged afterwards stay on the queue.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+def watermark_pixel_size(page_side, dpi=DEFAULT_WATERMARK_DPI):
+    """
+    Returns the largest edge, in pixels, a watermark needs to be sharp on a page.
+
+    The watermark is drawn into a box a third of the page's size, so the page's
+    longest side (in points) bounds both edges of that box whatever the
+    orientation of the page.
+
+    Args:
+        page_side (float): Longest page side in points.
+        dpi (int): Target resolution; 0 keeps the image at full resolution.
+
+    Returns:
+        int: Edge length in pixels, or None when dpi is 0.
+    """
+    if not dpi:
+        return None
+    return max(1, math.ceil(page_side / 3 * dpi / 72))
+
+def watermark_target_size(pdf, dpi=DEFAULT_WATERMARK_DPI):
+    """
+    Returns the largest watermark edge, in pixels, needed for any page of a PDF.
+
+    Args:
+        pdf (fitz.Document): The open PDF document.
+        dpi (int): Target resolution; 0 keeps the image at full resolution.
+
+    Returns:
+        int: Edge length in pixels, or None when dpi is 0 or the PDF has no pages.
     """
-    Reduces the opacity of the watermark image and saves it as a temporary file.
+    if not dpi or not pdf.page_count:
+        return None
+    # page_cropbox reads the page dictionary without loading the page
+    longest = max(
+        max(box.width, box.height)
+        for box in (pdf.page_cropbox(page_number) for page_number in range(pdf.page_count))
+    )
+    return watermark_pixel_size(longest, dpi)
+
+def prepare_watermark(watermark_image_path, opacity=0.2, cache=None, max_side=None):
+    """
+    Reduces the opacity of the watermark image and returns it as in-memory PNG
+    data, ready to be embedded without a round trip through the filesystem.
+    The image is first downsampled so neither edge exceeds max_side, which is
+    the most any page can display at the target resolution. Results are kept
+    in the prepared-watermark cache, so repeated runs with the same image
+    content, opacity and size skip preparation.
 
     Args:
         watermark_image_path (str): Path to the watermark image file.
         opacity (float): Opacity level (0 to 1).
+        cache (WatermarkCache): Cache to use; defaults to the process-wide cache.
+        max_side (int): Largest edge of the prepared image in pixels; None keeps
+            the full resolution.
+
+    Returns:
+        bytes: The processed watermark image as PNG data.
+    """
+    cache = cache or get_default_cache()
+    try:
+        with open(watermark_image_path, "rb") as f:
+            image_bytes = f.read()
+        key = cache.make_key(image_bytes, opacity, max_side)
+        data = cache.get(key)
+        if data is not None:
+            logging.info("Processed watermark loaded from cache")
+            return data
+
+        from PIL import Image
+
+        with Image.open(io.BytesIO(image_bytes)) as source:
+            if max_side and max(source.size) > max_side:
+                # draft() lets JPEG sources decode straight at a reduced scale
+                source.draft("RGB", (max_side, max_side))
+            img = source.convert("RGBA")
+        if max_side and max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+        # One lookup table applied in C instead of a Python callback per value
+        alpha_table = [int(value * opacity) for value in range(256)]
+        img.putalpha(img.getchannel("A").point(alpha_table))
+
+        # The PNG is only an intermediate that PyMuPDF decodes again, so encoding speed beats size
+        buffer = io.BytesIO()
+        img.save(buffer, "PNG", compress_level=1)
+        data = buffer.getvalue()
+        cache.put(key, data)
+        logging.info("Processed watermark prepared at %sx%s (%s bytes)", img.width, img.height, len(data))
+        return data
+    except Exception as e:
+        logging.error("Error processing watermark image: %s", e)
+        raise
+
+def compress_image_stream(pdf, xref):
+    """
+    Deflate-compresses an embedded image and its soft mask. PyMuPDF stores
+    inserted images as raw samples, which are several times larger than the
+    source PNG.
+
+    Args:
+        pdf (fitz.Document): Document holding the image.
+        xref (int): Xref of the image.
+    """
+    smask = pdf.xref_get_key(xref, "SMask")
+    xrefs = [xref]
+    if smask[0] == "xref":
+        xrefs.append(int(smask[1].split()[0]))
+    for image_xref in xrefs:
+        if pdf.xref_get_key(image_xref, "Filter")[0] == "null":
+            pdf.update_stream(image_xref, pdf.xref_stream(image_xref), compress=True)
+
+def parse_color(color):
+    """
+    Converts a "#RRGGBB" string to a PyMuPDF RGB tuple.
+    """
+    value = color.lstrip("#")
+    if len(value) != 6:
+        raise ValueError(f"Invalid color {color!r}; expected #RRGGBB")
+    return tuple(int(value[index:index + 2], 16) / 255 for index in (0, 2, 4))
+
+def is_vector_source(watermark_path):
+    """
+    Returns True for watermark files drawn as vector content (PDF and SVG logos).
+    """
+    return os.path.splitext(watermark_path)[1].lower() in VECTOR_EXTENSIONS
+
+def is_vector_watermark(processed_watermark):
+    """
+    Returns True when a prepared watermark is a vector template (PDF data)
+    rather than a raster image (PNG data).
+    """
+    return processed_watermark[:5] == b"%PDF-"
+
+def set_page_opacity(doc, page, opacity):
+    """
+    Wraps the content of a page in a graphics state with the given fill and
+    stroke opacity.
+    """
+    page.clean_contents()
+    doc.xref_set_key(page.xref, "Resources/ExtGState/fzWmOpacity", f"<</ca {opacity:g}/CA {opacity:g}>>")
+    contents = page.get_contents()
+    doc.update_stream(contents[0], b"q /fzWmOpacity gs\n" + doc.xref_stream(contents[0]))
+    doc.update_stream(contents[-1], doc.xref_stream(contents[-1]) + b"\nQ")
+
+def prepare_vector_watermark(source_path=None, text=None, opacity=0.2, rotation=0, font=DEFAULT_FONT, font_size=DEFAULT_FONT_SIZE, color=DEFAULT_TEXT_COLOR, cache=None):
+    """
+    Builds a one-page PDF template holding the watermark as vector content:
+    either a line of text or the first page of a PDF or SVG logo. Opacity and
+    rotation are baked into the template, so every page only has to reference
+    it. Templates are cached like raster watermarks.
+
+    Args:
+        source_path (str): Path to a PDF or SVG logo; ignored when text is given.
+        text (str): Text to draw.
+        opacity (float): Opacity level (0 to 1).
+        rotation (float): Counter-clockwise rotation in degrees.
+        font (str): Base-14 font name (e.g. "helv", "tiro", "cour") or path to a font file.
+        font_size (float): Font size in points.
+        color (str): Text color as "#RRGGBB".
+        cache (WatermarkCache): Cache to use; defaults to the process-wide cache.
 
     Returns:
-        str: Path to the processed temporary watermark image.
+        bytes: The template as PDF data.
     """
+    cache = cache or get_default_cache()
     try:
-        with Image.open(watermark_image_path).convert("RGBA") as img:
-            alpha = img.split()[3]
-            alpha = alpha.point(lambda p: int(p * opacity))
-            img.putalpha(alpha)
-
-            temp_dir = tempfile.gettempdir()
-            processed_image_path = os.path.join(temp_dir, "processed_watermark.png")
-            img.save(processed_image_path, "PNG")
-            logging.info(f"Processed watermark saved at {processed_image_path}")
-            return processed_image_path
+        if text:
+            font_bytes = b""
+            if os.path.isfile(font):
+                with open(font, "rb") as f:
+                    font_bytes = f.read()
+            source_bytes = text.encode("utf-8") + font_bytes
+            params = ("text", font if not font_bytes else "", font_size, color, rotation)
+        else:
+            with open(source_path, "rb") as f:
+                source_bytes = f.read()
+            params = (os.path.splitext(source_path)[1].lower(), rotation)
+        key = cache.make_key(source_bytes, opacity, *params)
+        data = cache.get(key, ".pdf")
+        if data is not None:
+            logging.info("Vector watermark loaded from cache")
+            return data
+
+        if text:
+            if font_bytes:
+                font_object = fitz.Font(fontbuffer=font_bytes)
+                font_args = {"fontname": "wmfont", "fontfile": font}
+            else:
+                font_object = fitz.Font(font)
+                font_args = {"fontname": font}
+            width = font_object.text_length(text, fontsize=font_size)
+            height = font_size * (font_object.ascender - font_object.descender)
+            content = fitz.open()
+            page = content.new_page(width=width, height=height)
+            page.insert_text((0, font_size * font_object.ascender), text, fontsize=font_size, color=parse_color(color), **font_args)
+        elif source_path.lower().endswith(".svg"):
+            with fitz.open(source_path) as svg:
+                content = fitz.open("pdf", svg.convert_to_pdf())
+        else:
+            content = fitz.open(source_path)
+            content.select([0])
+
+        with content, fitz.open() as template:
+            rect = content[0].rect
+            angle = math.radians(rotation)
+            width = abs(rect.width * math.cos(angle)) + abs(rect.height * math.sin(angle))
+            height = abs(rect.width * math.sin(angle)) + abs(rect.height * math.cos(angle))
+            page = template.new_page(width=width, height=height)
+            page.show_pdf_page(page.rect, content, 0, rotate=rotation)
+            set_page_opacity(template, page, opacity)
+            data = template.tobytes(garbage=3, deflate=True)
+        cache.put(key, data, ".pdf")
+        logging.info("Vector watermark prepared (%s bytes)", len(data))
+        return data
     except Exception as e:
-        logging.error(f"Error processing watermark image: {e}")
+        logging.error("Error preparing vector watermark: %s", e)
         raise
 
-def watermark_page_under(pdf_page, watermark_image_path):
+def load_watermark(watermark_path=None, opacity=0.2, max_side=None, cache=None, text=None, **vector_options):
+    """
+    Prepares a raster or vector watermark, depending on the source: text and
+    PDF or SVG files become vector templates, anything else is treated as an
+    image.
+
+    Args:
+        watermark_path (str): Path to the watermark image, PDF or SVG file.
+        opacity (float): Opacity level (0 to 1).
+        max_side (int): Largest edge of a raster watermark in pixels.
+        cache (WatermarkCache): Cache to use; defaults to the process-wide cache.
+        text (str): Text watermark; takes precedence over watermark_path.
+        **vector_options: rotation, font, font_size and color for vector watermarks.
+
+    Returns:
+        bytes: PNG data for raster watermarks, PDF data for vector watermarks.
+    """
+    if text or (watermark_path and is_vector_source(watermark_path)):
+        return prepare_vector_watermark(watermark_path, text, opacity, cache=cache, **vector_options)
+    if not watermark_path:
+        raise ValueError("A watermark image or text is required")
+    return prepare_watermark(watermark_path, opacity, cache, max_side)
+
+def open_watermark(processed_watermark):
+    """
+    Returns what watermark_page_under needs for a prepared watermark: the PNG
+    data itself, or the vector template opened as a document. Open the
+    template once per output document so its content is imported only once.
+    """
+    if is_vector_watermark(processed_watermark):
+        return fitz.open("pdf", processed_watermark)
+    return processed_watermark
+
+def vector_watermark_template(pdf, xref):
+    """
+    Returns the xref of the vector watermark template drawn by a page's Form
+    XObject, or 0 if the XObject does not draw one. show_pdf_page gives every
+    page a small Form XObject of its own, placing the template it imported
+    once per document under the resource name "fullpage"; the template is
+    told apart from other imported pages by the opacity state of
+    set_page_opacity.
+    """
+    value_type, value = pdf.xref_get_key(xref, "Resources/XObject/fullpage")
+    if value_type != "xref":
+        return 0
+    template_xref = int(value.split()[0])
+    if pdf.xref_get_key(template_xref, "Resources/ExtGState/fzWmOpacity")[0] == "null":
+        return 0
+    return template_xref
+
+# Page attributes that decide where the watermark goes; pages inherit them from their parent nodes
+PAGE_GEOMETRY_KEYS = ("MediaBox", "CropBox", "Rotate")
+PAGE_GEOMETRY_PATTERNS = {
+    key: re.compile(rf"/{key}\s*(\[[^\]]*\]|-?[\d.]+(?:\s+0\s+R)?)") for key in PAGE_GEOMETRY_KEYS
+}
+PAGE_PARENT_PATTERN = re.compile(r"/Parent\s*(\d+)\s+0\s+R")
+
+def page_geometry(pdf, xref, inherited, source=None):
+    """
+    Returns the MediaBox, CropBox and Rotate entries of a page or page tree
+    node as written in the file, with missing entries taken from its parents.
+    Reading the object's source is much cheaper than loading the page.
+
+    Args:
+        pdf (fitz.Document): The open PDF document.
+        xref (int): Xref of the page or page tree node.
+        inherited (dict): Cache of the geometry of page tree nodes, by xref.
+        source (str): The object's source, if the caller has already read it.
+
+    Returns:
+        tuple: The raw value of each of PAGE_GEOMETRY_KEYS, or None where unset.
+    """
+    source = source or pdf.xref_object(xref, compressed=True)
+    geometry = []
+    for key, pattern in PAGE_GEOMETRY_PATTERNS.items():
+        values = pattern.findall(source)
+        if len(values) > 1:
+            # The key also occurs in a nested dictionary, such as a direct annotation
+            value_type, value = pdf.xref_get_key(xref, key)
+            values = [] if value_type == "null" else [value]
+        geometry.append(values[0] if values else None)
+    if None in geometry:
+        parent = PAGE_PARENT_PATTERN.search(source)
+        if parent:
+            parent_xref = int(parent.group(1))
+            if parent_xref not in inherited:
+                inherited[parent_xref] = None  # Guards against cycles in damaged files
+                inherited[parent_xref] = page_geometry(pdf, parent_xref, inherited)
+            if inherited[parent_xref]:
+                geometry = [own if own is not None else parent_value for own, parent_value in zip(geometry, inherited[parent_xref])]
+    return tuple(geometry)
+
+def watermark_placement(pdf_page):
+    """
+    Computes where the watermark goes on a page: a box a third of the visible
+    page's size, centred on it, and the rotation that keeps the watermark
+    upright on rotated pages.
+
+    Args:
+        pdf_page (fitz.Page): The PDF page object.
+
+    Returns:
+        tuple: The box in the unrotated page coordinates insert_image and
+        show_pdf_page take, and the rotation to draw the watermark with.
+    """
+    # The crop box is stored top-down from the top of the media box; flipping
+    # it gives PDF space, which the transformation matrix maps to page coordinates
+    cropbox = pdf_page.cropbox * fitz.Matrix(1, 0, 0, -1, 0, pdf_page.mediabox.y1)
+    visible = cropbox * pdf_page.transformation_matrix
+    watermark_rect = fitz.Rect(
+        visible.x0 + visible.width / 3,
+        visible.y0 + visible.height / 3,
+        visible.x0 + visible.width * 2 / 3,
+        visible.y0 + visible.height * 2 / 3
+    )
+    return watermark_rect, pdf_page.rotation
+
+def plan_watermark_placements(pdf, start=0, stop=None):
+    """
+    Groups pages start..stop-1 by their geometry (media box, crop box and
+    rotation) in one pass over the page tree, and computes the watermark
+    placement of each group once, from its first page.
+
+    Args:
+        pdf (fitz.Document): The open PDF document.
+        start (int): First page to plan (0-based).
+        stop (int): Page after the last page to plan; defaults to the page count.
+
+    Returns:
+        list: (placement, page numbers) for each group, in order of first
+        appearance; placements are as returned by watermark_placement.
+    """
+    stop = pdf.page_count if stop is None else stop
+    groups = {}
+    inherited = {}
+    for page_number in range(start, stop):
+        groups.setdefault(page_geometry(pdf, pdf.page_xref(page_number), inherited), []).append(page_number)
+    return [(watermark_placement(pdf[page_numbers[0]]), page_numbers) for page_numbers in groups.values()]
+
+def planned_pages(pdf, start=0, stop=None):
+    """
+    Returns (page number, placement) for pages start..stop-1, group by group
+    (see plan_watermark_placements).
+    """
+    return [
+        (page_number, placement)
+        for placement, page_numbers in plan_watermark_placements(pdf, start, stop)
+        for page_number in page_numbers
+    ]
+
+def watermark_page_under(pdf_page, watermark_image, xref=0, placement=None):
     """
     Applies a watermark image under the content of a single PDF page.
 
     Args:
         pdf_page (fitz.Page): The PDF page object.
-        watermark_image_path (str): Path to the processed watermark image.
+        watermark_image (bytes or fitz.Document): Processed watermark image (PNG
+            data), or a vector template opened with open_watermark.
+        xref (int): Xref of a watermark image already embedded in the document.
+            When given, the page references that image object instead of
+            decoding and embedding the image again.
+        placement (tuple): Placement from plan_watermark_placements, for
+            pages that share their geometry; computed from the page if omitted.
+
+    Returns:
+        int: Xref of the watermark image used on the page, or 0 for vector
+        watermarks, whose template PyMuPDF imports once per document on its own.
     """
+    start = time.perf_counter()
     try:
-        rect = pdf_page.rect
-        watermark_width = rect.width / 3
-        watermark_height = rect.height / 3
-        x_center = (rect.width - watermark_width) / 2
-        y_center = (rect.height - watermark_height) / 2
-        watermark_rect = fitz.Rect(
-            x_center, 
-            y_center, 
-            x_center + watermark_width, 
-            y_center + watermark_height
-        )
-        pdf_page.insert_image(watermark_rect, filename=watermark_image_path, overlay=False)
-        logging.debug(f"Watermark applied to page {pdf_page.number + 1}")
+        watermark_rect, rotation = placement or watermark_placement(pdf_page)
+        if isinstance(watermark_image, fitz.Document):
+            pdf_page.show_pdf_page(watermark_rect, watermark_image, 0, overlay=False, rotate=rotation)
+            xref = 0
+        elif xref:
+            xref = pdf_page.insert_image(watermark_rect, xref=xref, overlay=False, rotate=rotation)
+        else:
+            xref = pdf_page.insert_image(watermark_rect, stream=watermark_image, overlay=False, rotate=rotation)
+            compress_image_stream(pdf_page.parent, xref)
+        logging.debug("Watermark applied to page %d", pdf_page.number + 1)
+        observe_stage("page", time.perf_counter() - start)
+        return xref
     except Exception as e:
-        logging.error(f"Error watermarking page {pdf_page.number + 1}: {e}")
+        logging.error("Error watermarking page %d: %s", pdf_page.number + 1, e)
         raise
 
+class WatermarkPageError(RuntimeError):
+    """
+    Raised in strict mode when pages still fail after PAGE_RETRIES retries.
+
+    Attributes:
+        pages (list): 1-based numbers of the pages left without a watermark.
+    """
+
+    def __init__(self, pages):
+        super().__init__(pages)
+        self.pages = pages
+
+    def __str__(self):
+        return f"{len(self.pages)} pages could not be watermarked: {', '.join(map(str, self.pages[:20]))}{' ...' if len(self.pages) > 20 else ''}"
+
+def watermark_planned_pages(pdf, watermark, pages, watermark_xref=0, share_image=True, strict=False, progress=None, offset=0):
+    """
+    Watermarks pages one after another. A page that fails does not stop the
+    others; failed pages are handled by settle_failed_pages at the end.
+
+    Args:
+        pdf (fitz.Document): The open PDF document.
+        watermark (bytes or fitz.Document): Watermark from open_watermark.
+        pages (list): (page_number, placement) pairs from planned_pages.
+        watermark_xref (int): Xref of a watermark image already embedded in the document.
+        share_image (bool): Reuse a single embedded watermark image for all pages.
+        strict (bool): Retry failed pages and raise WatermarkPageError for those that still fail.
+        progress (ProgressReporter): Updated after every page.
+        offset (int): Added to page numbers in reports, for documents holding a page range.
+
+    Returns:
+        tuple: Xref of the shared watermark image and the 1-based numbers of
+        pages left without a watermark.
+    """
+    failed = []
+    for done, (page_number, placement) in enumerate(pages, 1):
+        try:
+            xref = watermark_page_under(pdf[page_number], watermark, watermark_xref, placement)
+            if share_image:
+                watermark_xref = xref
+        except Exception:
+            failed.append((page_number, placement))
+        if progress:
+            progress.update(done, offset + page_number + 1, offset + page_number + 1)
+    return watermark_xref, settle_failed_pages(pdf, watermark, failed, watermark_xref, strict, offset)
+
+def settle_failed_pages(pdf, watermark, failed, watermark_xref=0, strict=False, offset=0):
+    """
+    Deals with pages that could not be watermarked. In strict mode each is
+    retried up to PAGE_RETRIES times and WatermarkPageError is raised for
+    those that still fail; otherwise they are only reported, so the output
+    is not silently incomplete.
+
+    Args:
+        failed (list): (page_number, placement) pairs of the failed pages.
+
+    Returns:
+        list: 1-based numbers of the pages left without a watermark.
+    """
+    for attempt in range(PAGE_RETRIES if strict else 0):
+        if not failed:
+            break
+        logging.info("Retrying %s failed pages (attempt %s of %s)", len(failed), attempt + 1, PAGE_RETRIES)
+        retried, failed = failed, []
+        for page_number, placement in retried:
+            try:
+                watermark_page_under(pdf[page_number], watermark, watermark_xref, placement)
+            except Exception:
+                failed.append((page_number, placement))
+    pages = sorted(offset + page_number + 1 for page_number, _ in failed)
+    if pages and strict:
+        raise WatermarkPageError(pages)
+    if pages:
+        logging.warning("%s pages were left without a watermark: %s", len(pages), pages)
+    return pages
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the current process in MB.
+    """
+    # Linux keeps ru_maxrss across exec, so a process started from a large
+    # parent would report the parent's peak; VmHWM starts afresh with the new image
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
 def get_system_resources():
     """
-    Retrieves current system CPU and memory usage.
+    Retrieves current system CPU and memory usage without blocking.
+
+    The CPU figure is the utilisation since the previous call, so callers
+    should sample at a regular interval (see ResourceSampler).
     """
-    cpu_percent = psutil.cpu_percent(interval=1)
+    import psutil
+
+    cpu_percent = psutil.cpu_percent(interval=None)
     memory = psutil.virtual_memory()
     memory_percent = memory.percent
     return cpu_percent, memory_percent
 
-def adjust_workers(desired_workers, cpu_threshold=80, memory_threshold=80):
+class EventStream:
+    """
+    Writes newline-delimited JSON events to a dedicated file descriptor or
+    file, so that progress bars and monitoring do not have to scrape the logs.
+    Every event carries "event" and "time" fields. Lines are buffered and
+    flushed at most every EVENT_FLUSH_INTERVAL seconds, and at once for
+    anything other than progress, so per-page events stay cheap; a
+    "resources" event is added every RESOURCE_SAMPLE_INTERVAL seconds.
+
+    Args:
+        target (str or int): File descriptor number, or path of a file or FIFO.
+    """
+
+    def __init__(self, target):
+        if isinstance(target, int) or str(target).isdigit():
+            self._file = os.fdopen(int(target), "w", buffering=EVENT_BUFFER_SIZE)
+        else:
+            self._file = open(target, "w", buffering=EVENT_BUFFER_SIZE)
+        self._lock = threading.Lock()
+        self._last_flush = 0
+        self._last_sample = 0
+        import psutil
+        self._process = psutil.Process()
+        self.progress_started = time.time()
+
+    def emit(self, event, **fields):
+        """
+        Writes one event.
+        """
+        now = time.time()
+        line = json.dumps({'event': event, 'time': now, **fields}, separators=(",", ":"))
+        with self._lock:
+            if event == "start":
+                # Throughput is measured per document
+                self.progress_started = now
+            self._file.write(line + "\n")
+            if now - self._last_sample >= RESOURCE_SAMPLE_INTERVAL:
+                self._last_sample = now
+                cpu_percent, memory_percent = get_system_resources()
+                resources = {
+                    'event': 'resources',
+                    'time': now,
+                    'cpu_percent': cpu_percent,
+                    'memory_percent': memory_percent,
+                    'rss_mb': self._process.memory_info().rss / (1024 * 1024),
+                }
+                self._file.write(json.dumps(resources, separators=(",", ":")) + "\n")
+            if event != "progress" or now - self._last_flush >= EVENT_FLUSH_INTERVAL:
+                self._last_flush = now
+                try:
+                    self._file.flush()
+                except BrokenPipeError:
+                    # The reader went away; watermarking carries on without it
+                    pass
+
+    def close(self):
+        with self._lock:
+            try:
+                self._file.close()
+            except BrokenPipeError:
+                pass
+
+_event_stream = None
+
+def set_event_stream(stream):
+    """
+    Replaces the process-wide event stream; None disables events.
+    """
+    global _event_stream
+    _event_stream = stream
+
+def emit_event(event, **fields):
+    """
+    Writes an event to the process-wide event stream, if there is one.
+    """
+    if _event_stream is not None:
+        _event_stream.emit(event, **fields)
+
+def emit_progress(done, total, first_page, last_page, **fields):
+    """
+    Reports that pages first_page..last_page (1-based) are watermarked and
+    done of total pages are finished, with the throughput so far.
+    """
+    if _event_stream is not None:
+        elapsed = time.time() - _event_stream.progress_started
+        _event_stream.emit(
+            'progress', done=done, total=total, first_page=first_page, last_page=last_page,
+            pages_per_sec=done / elapsed if elapsed > 0 else None, **fields
+        )
+
+class ProgressReporter:
+    """
+    Reports the progress of one document: every update goes to the event
+    stream, but a log line is only written every PROGRESS_LOG_PAGES pages or
+    PROGRESS_LOG_INTERVAL seconds and for the last page, so logging costs
+    nothing per page.
+
+    Args:
+        total (int): Number of pages of the document.
+        label (str): Text appended to the log lines, such as the document's path.
+        **fields: Extra fields of the progress events.
+    """
+
+    def __init__(self, total, label="", **fields):
+        self.total = total
+        self.label = label
+        self.fields = fields
+        self.logged_pages = 0
+        self.logged_at = time.monotonic()
+
+    def update(self, done, first_page, last_page):
+        """
+        Records that pages first_page..last_page (1-based) are watermarked and
+        done of the total pages are finished.
+        """
+        emit_progress(done, self.total, first_page, last_page, **self.fields)
+        now = time.monotonic()
+        if done >= self.total or done - self.logged_pages >= PROGRESS_LOG_PAGES or now - self.logged_at >= PROGRESS_LOG_INTERVAL:
+            self.logged_pages = done
+            self.logged_at = now
+            logging.info("Watermarked %d/%d pages%s", done, self.total, self.label)
+
+class ResourceSampler:
+    """
+    Samples CPU and memory usage on a background thread so that readers never
+    wait for a measurement.
+
+    Use as a context manager; `latest()` returns the most recent sample.
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.sequence = 0
+        self._sample = (0.0, 0.0)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+
+    def __enter__(self):
+        import psutil
+
+        # Priming cpu_percent so the first real sample covers a full interval
+        psutil.cpu_percent(interval=None)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample = get_system_resources()
+            self.sequence += 1
+
+    def latest(self):
+        """
+        Returns:
+            tuple: (sequence, cpu_percent, memory_percent) of the latest sample.
+        """
+        cpu_percent, memory_percent = self._sample
+        return self.sequence, cpu_percent, memory_percent
+
+class AdaptiveScheduler:
     """
-    Adjusts the number of worker threads based on system resource usage.
+    Submits tasks to an executor through a bounded window whose size follows
+    system load: it shrinks by one while CPU or memory usage is above its
+    threshold and grows by one, up to max_workers, while both are below.
 
     Args:
-        desired_workers (int): Current number of worker threads.
+        max_workers (int): Upper bound for tasks in flight (the executor's pool size).
+        sampler (ResourceSampler): Source of resource samples.
         cpu_threshold (int): CPU usage percentage threshold.
         memory_threshold (int): Memory usage percentage threshold.
-
-    Returns:
-        int: Adjusted number of worker threads.
     """
-    cpu, memory = get_system_resources()
-    if cpu > cpu_threshold or memory > memory_threshold:
-        # Reducing the number of workers to prevent system overload
-        return max(1, desired_workers - 1)
-    else:
-        # Increasing the number of workers if resources are available
-        return desired_workers + 1
 
-def watermark_pdf(input_pdf_path, output_pdf_path, watermark_image_path, opacity=0.2, max_workers=4, cpu_threshold=80, memory_threshold=80):
+    def __init__(self, max_workers, sampler, cpu_threshold=80, memory_threshold=80):
+        self.max_workers = max(1, max_workers)
+        self.limit = self.max_workers
+        self.sampler = sampler
+        self.cpu_threshold = cpu_threshold
+        self.memory_threshold = memory_threshold
+        self.scaling_events = []
+        self._last_sequence = 0
+
+    def adjust(self):
+        """
+        Re-evaluates the window size against the latest resource sample.
+        Each sample is acted on at most once.
+        """
+        sequence, cpu, memory = self.sampler.latest()
+        if sequence == self._last_sequence:
+            return
+        self._last_sequence = sequence
+        if cpu > self.cpu_threshold or memory > self.memory_threshold:
+            # Reducing concurrency to prevent system overload
+            limit = max(1, self.limit - 1)
+        else:
+            # Increasing concurrency if resources are available
+            limit = min(self.max_workers, self.limit + 1)
+        if limit != self.limit:
+            event = {'timestamp': time.time(), 'from': self.limit, 'to': limit, 'cpu_percent': cpu, 'memory_percent': memory}
+            self.scaling_events.append(event)
+            logging.info("Adjusting concurrency from %s to %s based on system resources (CPU %s%%, memory %s%%).", self.limit, limit, cpu, memory)
+            self.limit = limit
+
+    def run(self, executor, fn, items):
+        """
+        Runs fn(*item) for every item, keeping at most `limit` tasks in flight.
+
+        Args:
+            executor (concurrent.futures.Executor): Executor to submit to.
+            fn (callable): Task function.
+            items (iterable): Argument tuples, one per task.
+
+        Yields:
+            tuple: (item, future) for every finished task, in completion order.
+        """
+        items = iter(items)
+        pending = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.limit:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                pending[executor.submit(fn, *item)] = item
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+            self.adjust()
+
+def watermark_pages_threaded(pdf, processed_watermark, max_workers=4, cpu_threshold=80, memory_threshold=80, share_image=True, strict=False):
     """
-    Watermarks all pages of a PDF with a transparent image under the content in parallel.
-    Includes resource monitoring to adjust worker threads dynamically.
+    Watermarks the pages of an open PDF with a thread pool.
+
+    PyMuPDF is not thread-safe, so this engine is kept for comparison only; the
+    process engine is the one that scales across cores.
 
     Args:
-        input_pdf_path (str): Path to the input PDF file.
-        output_pdf_path (str): Path to save the watermarked PDF.
-        watermark_image_path (str): Path to the watermark image file.
-        opacity (float): Opacity level for the watermark.
+        pdf (fitz.Document): The open PDF document.
+        processed_watermark (bytes): Processed watermark image (PNG data).
         max_workers (int): Maximum number of threads for parallel processing.
         cpu_threshold (int): CPU usage percentage threshold to adjust workers.
         memory_threshold (int): Memory usage percentage threshold to adjust workers.
+        share_image (bool): Reuse a single embedded watermark image for all pages.
+        strict (bool): Retry failed pages and raise WatermarkPageError for
+            those that still fail (see settle_failed_pages).
+
+    Returns:
+        tuple: Concurrency changes made by the scheduler and the 1-based
+        numbers of pages left without a watermark.
     """
-    logging.info("Starting the watermarking process...")
-    start_time = time.time()
-    timing_data = {}
-    try:
-        # Preparing the watermark image
-        processed_watermark = prepare_watermark(watermark_image_path, opacity)
-        watermark_preparation_time = time.time()
-        preparation_duration = watermark_preparation_time - start_time
-        logging.info(f"Watermark preparation took {preparation_duration:.2f} seconds.")
-        timing_data['watermark_preparation'] = preparation_duration
-
-        with fitz.open(input_pdf_path) as pdf:
-            total_pages = pdf.page_count
-            logging.info(f"PDF opened. Total pages: {total_pages}")
-
-            # Initializing ThreadPoolExecutor for parallel processing
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                # Submitting watermarking tasks for each page
-                future_to_page = {
-                    executor.submit(watermark_page_under, page, processed_watermark): page.number
-                    for page in pdf
-                }
+    total_pages = pdf.page_count
+    watermark = open_watermark(processed_watermark)
+    pages = planned_pages(pdf)
+    first_page = 0
+    watermark_xref = 0
+    failed = []
+    progress = ProgressReporter(total_pages)
+    if (share_image or watermark is not processed_watermark) and total_pages:
+        # Embedding the watermark once so the remaining pages can reuse it
+        page_number, placement = pages[0]
+        try:
+            watermark_xref = watermark_page_under(pdf[page_number], watermark, 0, placement)
+        except Exception:
+            failed.append((page_number, placement))
+        first_page = 1
+        progress.update(1, page_number + 1, page_number + 1)
 
-                watermarked_pages = 0
-                watermarking_start_time = time.time()
-                for future in as_completed(future_to_page):
-                    page_number = future_to_page[future]
-                    try:
-                        future.result()
-                        watermarked_pages += 1
-                        logging.info(f"Watermarked page {page_number + 1}/{total_pages}")
-                        
-                        # Periodically checking system resources and adjust workers
-                        if watermarked_pages % 50 == 0:  # Adjust every 50 pages
-                            current_workers = executor._max_workers
-                            adjusted_workers = adjust_workers(current_workers, cpu_threshold, memory_threshold)
-                            if adjusted_workers != current_workers:
-                                logging.info(f"Adjusting workers from {current_workers} to {adjusted_workers} based on system resources.")
-                                executor._max_workers = adjusted_workers
-                    except Exception as exc:
-                        logging.error(f"Page {page_number + 1} generated an exception: {exc}")
-
-                watermarking_end_time = time.time()
-                watermarking_duration = watermarking_end_time - watermarking_start_time
-                timing_data['watermarking'] = watermarking_duration
-
-            # Saving the watermarked PDF
-            pdf.save(output_pdf_path)
-            logging.info(f"Watermarked PDF saved as {output_pdf_path}")
-
-        # Calculating and log saving duration
-        watermark_post_process_time = time.time()
-        saving_duration = watermark_post_process_time - watermark_preparation_time
-        logging.info(f"Watermarking and saving took {saving_duration:.2f} seconds.")
-        timing_data['watermarking_and_saving'] = saving_duration
-
-        # Total process time
-        total_time = watermark_post_process_time - start_time
-        logging.info(f"Total watermarking process took {total_time:.2f} seconds.")
-        timing_data['total_time'] = total_time
-
-        # Output timing data as JSON to stdout
-        print(json.dumps(timing_data))
-
-        # Cleaning up the temporary watermark image
-        if os.path.exists(processed_watermark):
-            os.remove(processed_watermark)
-            logging.debug(f"Temporary watermark image {processed_watermark} deleted.")
+    # Initializing ThreadPoolExecutor for parallel processing
+    with ResourceSampler() as sampler, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        scheduler = AdaptiveScheduler(max_workers, sampler, cpu_threshold, memory_threshold)
+        tasks = ((pdf[page_number], watermark, watermark_xref, placement) for page_number, placement in pages[first_page:])
+        done = first_page
+        for (page, _, _, placement), future in scheduler.run(executor, watermark_page_under, tasks):
+            if future.exception() is not None:
+                failed.append((page.number, placement))
+            done += 1
+            progress.update(done, page.number + 1, page.number + 1)
+    return scheduler.scaling_events, settle_failed_pages(pdf, watermark, failed, watermark_xref, strict)
 
-    except Exception as e:
-        logging.error(f"Failed to watermark PDF: {e}")
-        raise
+def watermark_pages_serial(pdf, processed_watermark, share_image=True, strict=False):
+    """
+    Watermarks the pages of an open PDF one after another.
 
-def main():
+    Args:
+        pdf (fitz.Document): The open PDF document.
+        processed_watermark (bytes): Processed watermark image (PNG data).
+        share_image (bool): Reuse a single embedded watermark image for all pages.
+        strict (bool): Retry failed pages and raise WatermarkPageError for
+            those that still fail (see settle_failed_pages).
+
+    Returns:
+        list: 1-based numbers of pages left without a watermark.
     """
-    Main function to execute the watermarking script.
+    progress = ProgressReporter(pdf.page_count)
+    watermark = open_watermark(processed_watermark)
+    return watermark_planned_pages(pdf, watermark, planned_pages(pdf), share_image=share_image, strict=strict, progress=progress)[1]
+
+def save_document(pdf, output_pdf_path, save_profile="fast", incremental=False, min_garbage=0, keep_xrefs=False):
     """
-    parser = argparse.ArgumentParser(description="Watermark all pages of a PDF with a transparent image.")
-    parser.add_argument("input_pdf", help="Path to the input PDF file.")
-    parser.add_argument("output_pdf", help="Path to save the watermarked PDF.")
-    parser.add_argument("watermark_image", help="Path to the watermark image file.")
-    parser.add_argument("--opacity", type=float, default=0.2, help="Opacity level for the watermark (0 to 1).")
-    parser.add_argument("--workers", type=int, default=4, help="Number of parallel threads.")
-    parser.add_argument("--profile", action='store_true', help="Enable profiling.")
-    parser.add_argument("--profile_output", type=str, default="profile_output.prof", help="Path to save profiling data.")
-    args = parser.parse_args()
+    Saves a document with the options of a save profile. Incremental updates
+    only take the profile's deflate option: garbage collection cannot be
+    combined with them, and cleaning would rewrite every page.
 
-    # Setup logging
-    setup_logging()
+    Args:
+        pdf (fitz.Document): The document to save.
+        output_pdf_path (str): Path to save to; the document's own file for
+            incremental updates. A binary file object is also accepted for
+            full saves.
+        save_profile (str): One of the SAVE_PROFILES names.
+        incremental (bool): Append an incremental update instead of rewriting the file.
+        min_garbage (int): Lowest garbage collection level the caller needs, for
+            example to drop objects it has orphaned.
+        keep_xrefs (bool): Stay at a garbage collection level that keeps object
+            numbers, for documents that are updated later by known xrefs.
 
-    if args.profile:
-        pr = cProfile.Profile()
-        pr.enable()
+    Returns:
+        float: Time spent saving in seconds.
+    """
+    options = dict(SAVE_PROFILES[save_profile])
+    saving_start_time = time.perf_counter()
+    if incremental:
+        pdf.save(output_pdf_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP, deflate=options.get("deflate", False))
+    else:
+        options["garbage"] = max(options.get("garbage", 0), min_garbage)
+        if keep_xrefs:
+            # Levels above 1 compact and renumber the objects
+            options["garbage"] = min(options["garbage"], 1)
+        if is_pdf_path(output_pdf_path) or isinstance(output_pdf_path, io.BytesIO):
+            pdf.save(output_pdf_path, **options)
+        else:
+            # PyMuPDF takes other file objects for the path named by their name
+            # attribute, so the document is rendered into memory and written from there
+            buffer = io.BytesIO()
+            pdf.save(buffer, **options)
+            output_pdf_path.write(buffer.getbuffer())
+            if hasattr(output_pdf_path, "flush"):
+                output_pdf_path.flush()
+    saving_duration = time.perf_counter() - saving_start_time
+    observe_stage("save", saving_duration)
+    return saving_duration
 
-    watermark_pdf(
-        input_pdf_path=args.input_pdf,
-        output_pdf_path=args.output_pdf,
-        watermark_image_path=args.watermark_image,
-        opacity=args.opacity,
-        max_workers=args.workers
-    )
+def split_page_ranges(total_pages, parts):
+    """
+    Splits the pages of a document into contiguous, nearly equal ranges.
 
-    if args.profile:
-        pr.disable()
-        pr.dump_stats(args.profile_output)
-        logging.info(f"Profiling data saved to {args.profile_output}")
+    Args:
+        total_pages (int): Number of pages in the document.
+        parts (int): Desired number of ranges.
+
+    Returns:
+        list: (start, stop) tuples covering range(total_pages) in order.
+    """
+    parts = max(1, min(parts, total_pages))
+    size, remainder = divmod(total_pages, parts)
+    ranges = []
+    start = 0
+    for index in range(parts):
+        stop = start + size + (1 if index < remainder else 0)
+        if stop > start:
+            ranges.append((start, stop))
+        start = stop
+    return ranges
+
+def watermark_page_range(input_pdf_path, part_pdf_path, processed_watermark, start, stop, share_image=True, strict=False):
+    """
+    Worker entry point of the process engine: opens the input PDF, watermarks
+    pages start..stop-1 and saves them as a standalone part file.
+
+    Args:
+        input_pdf_path (str): Path to the input PDF file.
+        part_pdf_path (str): Path to save the watermarked page range.
+        processed_watermark (bytes): Processed watermark image (PNG data).
+        start (int): First page of the range (0-based).
+        stop (int): Page after the last page of the range.
+        share_image (bool): Reuse a single embedded watermark image for all pages.
+        strict (bool): Retry failed pages and raise WatermarkPageError for
+            those that still fail (see settle_failed_pages).
+
+    Returns:
+        tuple: Resource name of the watermark image, or of the Form XObject
+        drawing a vector watermark, on the first page of the part (None if
+        that page has none), the 1-based numbers of pages left without a
+        watermark, and the StageMetrics of the worker.
+    """
+    with collect_metrics(StageMetrics()) as metrics, open_document(input_pdf_path) as pdf:
+        pdf.select(range(start, stop))
+        watermark = open_watermark(processed_watermark)
+        watermark_xref, failed = watermark_planned_pages(pdf, watermark, planned_pages(pdf), share_image=share_image, strict=strict, offset=start)
+        image_name = None
+        # Every page shares the image, so the first page has it too
+        if watermark_xref:
+            image_name = next((image[7] for image in pdf[0].get_images(full=True) if image[0] == watermark_xref), None)
+        elif isinstance(watermark, fitz.Document) and share_image:
+            image_name = next((name for xref, name, *_ in pdf[0].get_xobjects() if vector_watermark_template(pdf, xref)), None)
+        # Dropping the objects of pages outside the range
+        saving_start_time = time.perf_counter()
+        pdf.save(part_pdf_path, garbage=1)
+        observe_stage("save", time.perf_counter() - saving_start_time)
+    metrics.peak_rss_mb = peak_rss_mb()
+    return image_name, failed, metrics
+
+def reuse_part_watermark(merged, first_page, first_xref, image_name, shared_xref):
+    """
+    Points the pages of a merged part at the watermark image embedded by an
+    earlier part, leaving the part's own copy unreferenced. For a vector
+    watermark, the per-page Form XObjects of the part are pointed at the
+    template imported by the earlier part instead.
+
+    Args:
+        merged (fitz.Document): Document the part was inserted into.
+        first_page (int): Index of the first page of the part in merged.
+        first_xref (int): First xref added to merged by the part.
+        image_name (str): Resource name of the watermark on the part's first page.
+        shared_xref (int): Xref of the watermark image or template to keep, or
+            0 for the first part.
+
+    Returns:
+        int: Xref of the shared watermark image or template.
+    """
+    page_xref = merged.page_xref(first_page)
+    part_xref = int(merged.xref_get_key(page_xref, f"Resources/XObject/{image_name}")[1].split()[0])
+    holder_key, holder_type = "Type", ("name", "/Page")
+    template_xref = vector_watermark_template(merged, part_xref)
+    if template_xref:
+        part_xref = template_xref
+        holder_key, holder_type = "Subtype", ("name", "/Form")
+    if not shared_xref:
+        return part_xref
+    # Scanning only the objects the part added; looking pages up one by one walks the page tree every time
+    reference = re.compile(rf"/([^\s/<>\[\]()]+)\s+{part_xref}\s+0\s+R")
+    for xref in range(first_xref, merged.xref_length()):
+        if merged.xref_get_key(xref, holder_key) != holder_type:
+            continue
+        _, xobjects = merged.xref_get_key(xref, "Resources/XObject")
+        for name in reference.findall(xobjects):
+            # xref_set_key cannot write through indirect objects, so the
+            # dictionary holding the name is resolved first
+            holder, key = xref, "Resources"
+            for child in ("XObject", name):
+                value_type, value = merged.xref_get_key(holder, key)
+                if value_type == "xref":
+                    holder, key = int(value.split()[0]), child
+                else:
+                    key = f"{key}/{child}"
+            merged.xref_set_key(holder, key, f"{shared_xref} 0 R")
+    return shared_xref
+
+class Checkpoint:
+    """
+    Work directory of a resumable process-engine run. Every finished page
+    range is kept there as a part file and recorded in a JSON manifest,
+    which is replaced atomically after each part, so a run that dies keeps
+    all parts finished before it. A resumed run only reuses the manifest if
+    it was written for the same input file (path, size and modification
+    time), watermark and page ranges, and only parts whose file still has
+    the recorded size. Only files the manifests name are ever deleted, and a
+    directory that is not empty and has no manifest is refused, since its
+    files are not the checkpoint's.
+
+    Args:
+        directory (str): Work directory; created if needed.
+        state (dict): Identity of the run, see checkpoint_state.
+        resume (bool): Reuse the parts of an earlier run; otherwise any
+            earlier parts are discarded.
+
+    Raises:
+        ValueError: If the directory holds files but no checkpoint manifest.
+    """
+
+    def __init__(self, directory, state, resume=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, CHECKPOINT_MANIFEST)
+        self.state = state
+        self.parts = {}
+        manifest = self._read()
+        if manifest is None and any(name != f"{CHECKPOINT_MANIFEST}.tmp" for name in os.listdir(directory)):
+            raise ValueError(f"The checkpoint directory {directory} is not empty and holds no checkpoint; use a new or empty directory")
+        if resume:
+            self.parts = self._load(manifest)
+        self._write()
+        # Parts of an earlier run that are not reused
+        kept = {part['part'] for part in self.parts.values()}
+        for part in (manifest or {}).get('parts', {}).values():
+            if part['part'] not in kept:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(directory, os.path.basename(part['part'])))
+
+    def _read(self):
+        """
+        Returns the manifest in the directory, an empty one if it cannot be
+        read, or None if there is none.
+        """
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable checkpoint manifest %s: %s", self.path, e)
+            return {}
+        return manifest if isinstance(manifest, dict) else {}
+
+    def _load(self, manifest):
+        if manifest is None:
+            logging.info("No checkpoint in %s; starting from the first page", self.directory)
+            return {}
+        if not manifest:
+            return {}
+        if manifest.get('version') != CHECKPOINT_VERSION or manifest.get('state') != self.state:
+            logging.warning("The checkpoint in %s belongs to another input, watermark or chunk size; starting over", self.directory)
+            return {}
+        parts = {}
+        for index, part in manifest.get('parts', {}).items():
+            part_path = os.path.join(self.directory, part['part'])
+            if os.path.isfile(part_path) and os.path.getsize(part_path) == part['size']:
+                parts[int(index)] = part
+        logging.info("Resuming from %s: %s of %s page ranges already done", self.directory, len(parts), len(self.state['ranges']))
+        return parts
+
+    def _write(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({'version': CHECKPOINT_VERSION, 'state': self.state, 'parts': self.parts}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def part_path(self, index):
+        return os.path.join(self.directory, f"part_{index:05d}.pdf")
+
+    def done(self, index):
+        """
+        Returns the manifest entry of a finished page range, or None.
+        """
+        return self.parts.get(index)
+
+    def record(self, index, image_name, failed_pages):
+        """
+        Records a page range whose part file has been written.
+        """
+        part_path = self.part_path(index)
+        with open(part_path, "rb") as f:
+            os.fsync(f.fileno())
+        self.parts[index] = {
+            'part': os.path.basename(part_path),
+            'size': os.path.getsize(part_path),
+            'image_name': image_name,
+            'failed_pages': failed_pages,
+        }
+        self._write()
+
+    def remove(self):
+        """
+        Deletes the manifest and part files after the output has been saved,
+        including parts whose save was interrupted before they were recorded.
+        """
+        for index in range(len(self.state['ranges'])):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.part_path(index))
+        os.remove(self.path)
+        with contextlib.suppress(OSError):
+            os.rmdir(self.directory)
+
+def checkpoint_state(input_pdf_path, processed_watermark, page_ranges, share_image=True):
+    """
+    Returns what identifies a checkpointed run: the input file, the watermark
+    and the page ranges the parts cover.
+    """
+    stat_result = os.stat(input_pdf_path)
+    return {
+        'input': os.path.abspath(input_pdf_path),
+        'input_size': stat_result.st_size,
+        'input_mtime_ns': stat_result.st_mtime_ns,
+        'watermark': watermark_digest(processed_watermark),
+        'share_image': share_image,
+        'ranges': [list(page_range) for page_range in page_ranges],
+    }
+
+def watermark_pdf_sharded(input_pdf_path, output_pdf_path, processed_watermark, total_pages, max_workers=4, cpu_threshold=80, memory_threshold=80, share_image=True, save_profile="fast", strict=False, checkpoint_dir=None, resume=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Watermarks a PDF with a process pool. Each worker opens the input file and
+    watermarks its own page range; the parts are then merged in page order.
+    The document is split into several ranges per worker so the adaptive
+    scheduler has room to raise or lower the number of ranges in flight.
+    With a checkpoint directory, the ranges are chunk_size pages long and
+    the parts are kept there (see Checkpoint) until the output is saved.
+
+    Args:
+        input_pdf_path (str): Path to the input PDF file.
+        output_pdf_path (str): Path to save the watermarked PDF.
+        processed_watermark (bytes): Processed watermark image (PNG data).
+        total_pages (int): Number of pages in the input PDF.
+        max_workers (int): Number of worker processes.
+        cpu_threshold (int): CPU usage percentage threshold to adjust workers.
+        memory_threshold (int): Memory usage percentage threshold to adjust workers.
+        share_image (bool): Reuse a single embedded watermark image for all pages.
+        save_profile (str): Save profile of the merged document.
+        strict (bool): Retry failed pages and raise WatermarkPageError for
+            those that still fail (see settle_failed_pages).
+        checkpoint_dir (str): Work directory keeping finished page ranges.
+        resume (bool): Continue from the ranges finished in checkpoint_dir.
+        chunk_size (int): Pages per range when checkpointing.
+
+    Returns:
+        tuple: Time spent merging the parts and time spent saving the result
+        in seconds, the concurrency changes made by the scheduler, the
+        1-based numbers of pages left without a watermark and the number of
+        page ranges taken from the checkpoint.
+    """
+    if checkpoint_dir:
+        page_ranges = [(start, min(start + chunk_size, total_pages)) for start in range(0, total_pages, chunk_size)]
+        parts_context = contextlib.nullcontext(checkpoint_dir)
+    else:
+        page_ranges = split_page_ranges(total_pages, max_workers * RANGES_PER_WORKER)
+        parts_context = tempfile.TemporaryDirectory(prefix="watermark_parts_")
+    with parts_context as parts_dir:
+        checkpoint = None
+        if checkpoint_dir:
+            checkpoint = Checkpoint(parts_dir, checkpoint_state(input_pdf_path, processed_watermark, page_ranges, share_image), resume)
+        part_paths = [os.path.join(parts_dir, f"part_{index:05d}.pdf") for index in range(len(page_ranges))]
+        image_names = [None] * len(page_ranges)
+        failed = []
+        done = 0
+        pending = []
+        for index, (start, stop) in enumerate(page_ranges):
+            part = checkpoint.done(index) if checkpoint else None
+            if part:
+                image_names[index] = part['image_name']
+                failed += part['failed_pages']
+                done += stop - start
+            else:
+                pending.append(index)
+        resumed = len(page_ranges) - len(pending)
+        with ResourceSampler() as sampler, ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(pending)))) as executor:
+            scheduler = AdaptiveScheduler(max_workers, sampler, cpu_threshold, memory_threshold)
+            tasks = (
+                (input_pdf_path, part_paths[index], processed_watermark, *page_ranges[index], share_image, strict)
+                for index in pending
+            )
+            progress = ProgressReporter(total_pages)
+            for (_, part_path, _, start, stop, _, _), future in scheduler.run(executor, watermark_page_range, tasks):
+                index = part_paths.index(part_path)
+                image_names[index], part_failed, part_metrics = future.result()
+                failed += part_failed
+                metrics = current_metrics()
+                if metrics:
+                    metrics.merge(part_metrics)
+                if checkpoint:
+                    checkpoint.record(index, image_names[index], part_failed)
+                done += stop - start
+                progress.update(done, start + 1, stop)
+
+        merging_duration, saving_duration = merge_page_ranges(input_pdf_path, output_pdf_path, part_paths, image_names, share_image, save_profile)
+        if checkpoint:
+            checkpoint.remove()
+        return merging_duration, saving_duration, scheduler.scaling_events, sorted(failed), resumed
+
+def merge_page_ranges(input_pdf_path, output_pdf_path, part_paths, image_names, share_image=True, save_profile="fast"):
+    """
+    Builds the output from the input document, taking the content and
+    resources of every page from the part files of watermark_page_range.
+    Everything outside the page contents (form fields, annotations, page
+    labels, embedded files, outline and metadata) is the input's own, so
+    the parts only need to carry the watermarked pages.
+
+    Args:
+        input_pdf_path (str): Path to the input PDF file.
+        output_pdf_path (str): Path to save the merged PDF.
+        part_paths (list): Part files covering the input's pages in order.
+        image_names (list): Watermark image resource name of every part, as
+            returned by watermark_page_range.
+        share_image (bool): Point every part at the watermark image of the first.
+        save_profile (str): Save profile of the merged document.
+
+    Returns:
+        tuple: Time spent merging and time spent saving in seconds.
+    """
+    merge_start_time = time.time()
+    with fitz.open(input_pdf_path) as merged:
+        total_pages = merged.page_count
+        page = 0
+        shared_xref = 0
+        for part_path, image_name in zip(part_paths, image_names):
+            first_page = merged.page_count
+            first_xref = merged.xref_length()
+            # Annotations and form fields stay on the input's pages
+            with fitz.open(part_path) as part:
+                merged.insert_pdf(part, links=0, annots=0, widgets=0)
+                part_pages = part.page_count
+            if share_image and image_name:
+                shared_xref = reuse_part_watermark(merged, first_page, first_xref, image_name, shared_xref)
+            for offset in range(part_pages):
+                part_page_xref = merged.page_xref(first_page + offset)
+                page_xref = merged.page_xref(page + offset)
+                for key in ("Contents", "Resources"):
+                    merged.xref_set_key(page_xref, key, merged.xref_get_key(part_page_xref, key)[1])
+            page += part_pages
+        # The part pages are empty shells now; their old contents are dropped on save
+        merged.delete_pages(from_page=total_pages, to_page=merged.page_count - 1)
+        merging_duration = time.time() - merge_start_time
+        observe_stage("merge", merging_duration)
+        # Dropping the replaced page contents and the watermark copies of later parts
+        saving_duration = save_document(merged, output_pdf_path, save_profile, min_garbage=1)
+    return merging_duration, saving_duration
+
+def watermark_pdf_streamed(input_pdf_path, output_pdf_path, processed_watermark, total_pages, chunk_size=DEFAULT_CHUNK_SIZE, share_image=True, incremental=False, save_profile="fast", strict=False):
+    """
+    Watermarks a PDF in fixed-size chunks with bounded memory. Each chunk is
+    copied from a freshly opened input into the output, watermarked, and
+    appended to the output file as an incremental update. Both documents are
+    closed between chunks, so the objects loaded for one chunk are released
+    before the next, and peak memory follows the chunk size rather than the
+    page count. With incremental set, the output already holds a copy of the
+    input and each chunk is watermarked in place, so no page is copied.
+
+    Args:
+        input_pdf_path (str): Path to the input PDF file.
+        output_pdf_path (str): Path to save the watermarked PDF.
+        processed_watermark (bytes): Processed watermark image (PNG data).
+        total_pages (int): Number of pages in the input PDF.
+        chunk_size (int): Pages per chunk.
+        share_image (bool): Reuse a single embedded watermark image for all pages.
+        incremental (bool): Watermark an existing copy of the input in place.
+        save_profile (str): Save profile of the first chunk, short of object
+            renumbering; later chunks are appended as incremental updates
+            (see save_document).
+        strict (bool): Retry failed pages and raise WatermarkPageError for
+            those that still fail (see settle_failed_pages).
+
+    Returns:
+        tuple: Number of chunks written, time spent saving in seconds and
+        the 1-based numbers of pages left without a watermark.
+    """
+    watermark_xref = 0
+    chunks = 0
+    saving_duration = 0
+    failed = []
+    progress = ProgressReporter(total_pages)
+    for start in range(0, total_pages, chunk_size):
+        stop = min(start + chunk_size, total_pages)
+        watermark_xref, chunk_saving_duration, chunk_failed = watermark_stream_chunk(
+            input_pdf_path, output_pdf_path, processed_watermark, start, stop,
+            watermark_xref, share_image, incremental, save_profile, strict
+        )
+        saving_duration += chunk_saving_duration
+        failed += chunk_failed
+        chunks += 1
+        progress.update(stop, start + 1, stop)
+
+    if not incremental:
+        saving_duration += copy_document_extras(input_pdf_path, output_pdf_path, save_profile)
+    return chunks, saving_duration, failed
+
+def watermark_stream_chunk(input_pdf_path, output_pdf_path, processed_watermark, start, stop, watermark_xref=0, share_image=True, incremental=False, save_profile="fast", strict=False):
+    """
+    Watermarks one chunk of the stream engine and writes it out. A chunk
+    starting at page 0 of a non-incremental run creates the output file;
+    every other chunk is appended to it as an incremental update.
+
+    Args:
+        input_pdf_path (str): Path to the input PDF file.
+        output_pdf_path (str): Path of the output PDF file.
+        processed_watermark (bytes): Processed watermark image (PNG data).
+        start (int): First page of the chunk.
+        stop (int): Page after the last page of the chunk.
+        watermark_xref (int): Xref of the watermark image embedded by an
+            earlier chunk, or 0 to embed it.
+        share_image (bool): Reuse a single embedded watermark image for all pages.
+        incremental (bool): The output is a copy of the input to watermark in place.
+        save_profile (str): Save profile of the output (see save_document).
+        strict (bool): Retry failed pages and raise WatermarkPageError for
+            those that still fail (see settle_failed_pages).
+
+    Returns:
+        tuple: Xref of the shared watermark image (0 for vector watermarks or
+        without share_image), the time spent saving in seconds and the
+        1-based numbers of pages left without a watermark.
+    """
+    append = start > 0 or incremental
+    watermark = open_watermark(processed_watermark)
+    output = open_document(output_pdf_path) if append else fitz.open()
+    try:
+        if not incremental:
+            with open_document(input_pdf_path) as source:
+                output.insert_pdf(source, from_page=start, to_page=stop - 1)
+                if not append:
+                    output.set_metadata(source.metadata)
+        # Xrefs survive incremental saves, so later chunks keep reusing the first image
+        watermark_xref, failed = watermark_planned_pages(output, watermark, planned_pages(output, start, stop), watermark_xref, share_image, strict)
+        return watermark_xref, save_document(output, output_pdf_path, save_profile, incremental=append, keep_xrefs=True), failed
+    finally:
+        output.close()
+
+def copy_document_extras(input_pdf_path, output_pdf_path, save_profile="fast"):
+    """
+    Copies what insert_pdf leaves behind to a stream engine output, as a
+    final incremental update: the outline, the page labels and the embedded
+    files of the input. Form fields travel with their pages.
+
+    Returns:
+        float: Time spent saving in seconds.
+    """
+    with fitz.open(input_pdf_path) as source:
+        toc = source.get_toc(simple=False)
+        labels = source.get_page_labels()
+        attachments = source.embfile_names()
+        if not (toc or labels or attachments):
+            return 0
+        with fitz.open(output_pdf_path) as output:
+            if toc:
+                output.set_toc(toc)
+            if labels:
+                output.set_page_labels(labels)
+            # One attachment in memory at a time
+            for name in attachments:
+                info = source.embfile_info(name)
+                output.embfile_add(name, source.embfile_get(name), filename=info['filename'], ufilename=info['ufilename'], desc=info['description'])
+            return save_document(output, output_pdf_path, save_profile, incremental=True)
+
+def is_pdf_path(target):
+    """
+    Returns True for file system paths, as opposed to in-memory documents and file objects.
+    """
+    return isinstance(target, (str, os.PathLike))
+
+def open_document(path):
+    """
+    Opens a PDF file, recording the time taken as the "open" stage.
+
+    Returns:
+        fitz.Document: The open document.
+    """
+    start = time.perf_counter()
+    pdf = fitz.open(path)
+    observe_stage("open", time.perf_counter() - start)
+    return pdf
+
+@contextlib.contextmanager
+def open_pdf_source(source):
+    """
+    Opens a PDF from a path, a bytes-like object (bytes, bytearray,
+    memoryview, mmap) or a readable binary file object, without copying the
+    data where possible: bytes-like objects and io.BytesIO buffers are read
+    in place, and regular files are memory-mapped. Pipes and other streams
+    are read into memory once.
+
+    Args:
+        source: Where to read the PDF from.
+
+    Yields:
+        fitz.Document: The open document, closed on exit.
+    """
+    if is_pdf_path(source):
+        with open_document(source) as pdf:
+            yield pdf
+        return
+    mapped = None
+    if isinstance(source, io.BytesIO):
+        buffer = source.getbuffer()
+    elif hasattr(source, "read"):
+        try:
+            regular = stat.S_ISREG(os.fstat(source.fileno()).st_mode)
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            regular = False
+        if regular:
+            mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            buffer = memoryview(mapped)
+        else:
+            buffer = source.read()
+    else:
+        buffer = source if isinstance(source, bytes) else memoryview(source)
+    start = time.perf_counter()
+    pdf = fitz.open(stream=buffer, filetype="pdf")
+    observe_stage("open", time.perf_counter() - start)
+    try:
+        yield pdf
+    finally:
+        pdf.close()
+        if isinstance(buffer, memoryview):
+            buffer.release()
+        if mapped is not None:
+            mapped.close()
+
+def watermark_digest(processed_watermark):
+    """
+    Returns the digest identifying a watermark as applied by this version:
+    the prepared watermark, which carries the source, opacity, resolution and
+    vector options, and the placement.
+    """
+    digest = hashlib.sha256(processed_watermark)
+    digest.update(f":placement-{PLACEMENT_VERSION}".encode())
+    return digest.hexdigest()
+
+def read_watermark_marker(pdf):
+    """
+    Returns the watermark digest recorded in a PDF by mark_watermarked, or None.
+    """
+    value_type, value = pdf.xref_get_key(-1, f"Info/{WATERMARK_MARKER_KEY}")
+    return value if value_type == "string" else None
+
+def set_watermark_marker(pdf, marker):
+    """
+    Records a watermark digest in the document information dictionary of an
+    open document.
+    """
+    if pdf.xref_get_key(-1, "Info")[0] != "xref":
+        # Creates the information dictionary
+        pdf.set_metadata(pdf.metadata)
+    info_xref = int(pdf.xref_get_key(-1, "Info")[1].split()[0])
+    pdf.xref_set_key(info_xref, WATERMARK_MARKER_KEY, f"({marker})")
+
+def mark_watermarked(output_pdf_path, marker):
+    """
+    Records a watermark digest in an output file as a small incremental update.
+
+    Returns:
+        float: Time spent saving in seconds.
+    """
+    with fitz.open(output_pdf_path) as pdf:
+        if not pdf.can_save_incrementally():
+            logging.debug("Cannot mark %s as watermarked", output_pdf_path)
+            return 0
+        set_watermark_marker(pdf, marker)
+        return save_document(pdf, output_pdf_path, incremental=True)
+
+def temp_output_path(output_pdf_path):
+    """
+    Returns the path an output is written to before it replaces
+    output_pdf_path: in the same directory, so os.replace stays a rename.
+    """
+    return f"{output_pdf_path}.{os.getpid()}.tmp"
+
+def copy_output(source_path, output_pdf_path):
+    """
+    Makes output_pdf_path a copy of an earlier result, replacing any existing
+    file once the copy is complete. A copy rather than a hard link, so that
+    neither file changes when the other is written in place.
+
+    Returns:
+        str: "existing" or "copied".
+    """
+    if os.path.exists(output_pdf_path) and os.path.samefile(source_path, output_pdf_path):
+        return "existing"
+    temp_path = temp_output_path(output_pdf_path)
+    try:
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, output_pdf_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+    return "copied"
+
+def skip_watermarked(input_pdf_path, output_pdf_path, processed_watermark, share_image=True, save_profile="fast", incremental=False, index=None, force=False):
+    """
+    Looks for a result a run would only reproduce: an input that already
+    carries this watermark, or an output of the same input and settings
+    recorded in the index. A result found is copied to output_pdf_path.
+
+    Args:
+        input_pdf_path (str): Path to the input PDF file.
+        output_pdf_path (str): Path to save the watermarked PDF.
+        processed_watermark (bytes): Prepared watermark.
+        share_image (bool): Reuse a single embedded watermark image for all pages.
+        save_profile (str): Save profile of the output.
+        incremental (bool): The output is saved as an incremental update.
+        index (ResultIndex): Index of earlier results, if any.
+        force (bool): Never skip; only compute the index key.
+
+    Returns:
+        tuple: Timing data of the skipped run, or None if the document has to
+        be watermarked, and the key to record the result under in the index
+        (None without an index).
+    """
+    marker = watermark_digest(processed_watermark)
+    run_key = None
+    if index is not None:
+        run_key = index.make_key(index.file_digest(input_pdf_path), repr((marker, bool(share_image), save_profile, bool(incremental))))
+    if force:
+        return None, run_key
+    with fitz.open(input_pdf_path) as pdf:
+        total_pages = pdf.page_count
+        watermarked = read_watermark_marker(pdf) == marker
+    if watermarked:
+        previous, reason = input_pdf_path, "already_watermarked"
+    else:
+        previous, reason = (index.lookup(run_key) if run_key else None), "indexed"
+    if previous is None:
+        return None, run_key
+    reuse = copy_output(previous, output_pdf_path)
+    logging.info("Skipping %s (%s); output %s from %s", input_pdf_path, reason.replace('_', ' '), reuse, previous)
+    return {
+        'skipped': reason,
+        'reused_output': previous,
+        'reuse': reuse,
+        'pages': total_pages,
+        'output_size': os.path.getsize(output_pdf_path),
+    }, run_key
+
+def preflight(input_pdf_path):
+    """
+    Analyses a PDF without loading its pages, for plan_watermarking. Object
+    sources are read once and parsed, which takes a fraction of the time
+    watermarking does.
+
+    Args:
+        input_pdf_path (str): Path to the PDF file.
+
+    Returns:
+        dict: Page count, file size, number of distinct page geometries,
+        bytes of image and page content streams, whether the file needs a
+        password, is encrypted, linearized, uses object streams or had to be
+        repaired when opened, and whether its catalog holds form fields,
+        page labels or embedded files.
+    """
+    start_time = time.time()
+    with fitz.open(input_pdf_path) as pdf:
+        analysis = {
+            'pages': pdf.page_count,
+            'file_size': os.path.getsize(input_pdf_path),
+            'needs_password': bool(pdf.needs_pass),
+            'encrypted': bool(pdf.is_encrypted or pdf.metadata.get('encryption')),
+            'linearized': bool(pdf.is_fast_webaccess),
+            'object_streams': pdf.xref_get_key(-1, "Type") == ("name", "/XRef"),
+            'repaired': bool(pdf.is_repaired),
+        }
+        if pdf.needs_pass:
+            analysis.update(page_geometries=0, image_bytes=0, content_bytes=0, forms=False, page_labels=False, attachments=False, preflight_time=time.time() - start_time)
+            return analysis
+        catalog = pdf.pdf_catalog()
+        analysis.update(
+            forms=pdf.xref_get_key(catalog, "AcroForm")[0] != "null",
+            page_labels=pdf.xref_get_key(catalog, "PageLabels")[0] != "null",
+            attachments=pdf.xref_get_key(catalog, "Names/EmbeddedFiles")[0] != "null",
+        )
+        inherited = {}
+        geometries = set()
+        content_xrefs = set()
+        stream_sizes = {}
+        image_bytes = 0
+        # One pass over the objects: pages, then streams; content streams are told apart at the end
+        for xref in range(1, pdf.xref_length()):
+            source = pdf.xref_object(xref, compressed=True)
+            if PDF_PAGE_TYPE_PATTERN.search(source):
+                geometries.add(page_geometry(pdf, xref, inherited, source))
+                contents = PDF_CONTENTS_PATTERN.search(source)
+                if contents:
+                    content_xrefs.update(int(reference) for reference in PDF_REFERENCE_PATTERN.findall(contents.group(1)))
+                continue
+            length = PDF_LENGTH_PATTERN.search(source)
+            if not length:
+                continue
+            size = int(length.group(1))
+            if length.group(2):
+                # The length is an indirect object of its own
+                size = int(pdf.xref_object(size).strip() or 0)
+            if "/Subtype/Image" in source:
+                image_bytes += size
+            else:
+                stream_sizes[xref] = size
+        content_bytes = sum(stream_sizes.get(xref, 0) for xref in content_xrefs)
+        analysis.update(page_geometries=len(geometries), image_bytes=image_bytes, content_bytes=content_bytes)
+    analysis['preflight_time'] = time.time() - start_time
+    return analysis
+
+def plan_watermarking(analysis, engine=AUTO_ENGINE, max_workers=None, chunk_size=None, save_profile=None, incremental=False, checkpoint=False, cpu_count=None, available_memory_mb=None):
+    """
+    Chooses the engine, worker count, chunk size and save profile for a
+    document from its preflight analysis, with the cost model of the PLAN_*
+    constants. Options that are given are kept and only the others chosen.
+
+    Args:
+        analysis (dict): Result of preflight.
+        engine (str): An engine name, or "auto" to choose one. The thread
+            engine is never chosen, since PyMuPDF is not thread-safe, and
+            documents with form fields, page labels or attachments run
+            serially.
+        max_workers (int): Most worker processes to use; defaults to the CPU count.
+        chunk_size (int): Pages per chunk, or None to size chunks by PLAN_CHUNK_BYTES.
+        save_profile (str): Save profile, or None for "balanced" when the
+            input uses object streams (a plain save would expand them) and
+            "fast" otherwise.
+        incremental (bool): The run saves incrementally, which the process engine cannot.
+        checkpoint (bool): The run keeps a checkpoint, which only the process engine can.
+        cpu_count (int): CPUs to plan for; defaults to os.cpu_count().
+        available_memory_mb (float): Memory to plan for; defaults to what psutil reports.
+
+    Returns:
+        dict: engine, workers, chunk_size, save_profile, estimated_seconds,
+        and the reasons and warnings behind the plan.
+    """
+    if available_memory_mb is None:
+        import psutil
+        available_memory_mb = psutil.virtual_memory().available / (1024 * 1024)
+    cpus = cpu_count or os.cpu_count() or 1
+    pages = analysis['pages']
+    file_size = analysis['file_size']
+    reasons = []
+    warnings = []
+
+    workers = max(1, min(max_workers or cpus, cpus, pages // PLAN_MIN_PAGES_PER_WORKER))
+    memory_workers = int(available_memory_mb * PLAN_WORKER_MEMORY_SHARE // PLAN_WORKER_RSS_MB)
+    if workers > max(1, memory_workers):
+        workers = max(1, memory_workers)
+        reasons.append(f"{workers} workers fit in {available_memory_mb:.0f} MB of available memory")
+    serial_seconds = pages * PLAN_PAGE_SECONDS
+    process_seconds = (
+        PLAN_PROCESS_STARTUP_SECONDS + workers * PLAN_WORKER_STARTUP_SECONDS
+        + pages * PLAN_PAGE_SECONDS / workers + pages * PLAN_MERGE_PAGE_SECONDS
+    )
+    large = pages >= PLAN_STREAM_MIN_PAGES or file_size > available_memory_mb * 1024 * 1024 * PLAN_STREAM_MEMORY_SHARE
+    image_heavy = analysis['image_bytes'] > file_size * PLAN_IMAGE_HEAVY_SHARE
+    structure = [name for key, name in (('forms', "form fields"), ('page_labels', "page labels"), ('attachments', "attachments")) if analysis.get(key)]
+
+    if engine != AUTO_ENGINE:
+        reasons.append(f"{engine} engine chosen by the caller")
+        if engine not in ("process", "thread"):
+            workers = 1
+        elif max_workers:
+            workers = max_workers
+    elif checkpoint:
+        engine = "process"
+        reasons.append("checkpoints are kept by the process engine")
+    elif structure:
+        # Engines that rebuild the document have to carry these over; the serial engine never touches them
+        engine = "serial"
+        workers = 1
+        reasons.append(f"the document has {', '.join(structure)}, which only the serial engine leaves untouched")
+        if large:
+            warnings.append("large document watermarked serially: memory grows with the page count")
+    elif workers > 1 and not incremental and not image_heavy and process_seconds < serial_seconds:
+        engine = "process"
+        reasons.append(f"{pages} pages over {workers} workers: about {process_seconds:.1f}s against {serial_seconds:.1f}s serially")
+    else:
+        if incremental:
+            reasons.append("incremental saves are not supported by the process engine")
+        elif image_heavy:
+            reasons.append("image-heavy document: merging process-engine parts would grow the output")
+        elif workers == 1:
+            reasons.append(f"one worker ({cpus} CPUs, {pages} pages)")
+        else:
+            reasons.append(f"process start-up and merging outweigh parallelism for {pages} pages")
+        engine = "stream" if large else "serial"
+        if large:
+            reasons.append("large document: the stream engine bounds memory by the chunk size")
+        workers = 1
+
+    if chunk_size is None:
+        page_bytes = max(1, file_size // max(1, pages))
+        chunk_size = int(min(PLAN_MAX_CHUNK_SIZE, max(PLAN_MIN_CHUNK_SIZE, PLAN_CHUNK_BYTES // page_bytes)))
+    if save_profile is None:
+        save_profile = "balanced" if analysis['object_streams'] else "fast"
+        if analysis['object_streams']:
+            reasons.append("the input uses object streams, which the balanced profile keeps")
+
+    if analysis['needs_password']:
+        warnings.append("the document needs a password and cannot be watermarked")
+    if analysis['linearized']:
+        warnings.append("the document is linearized; a rewritten output loses fast web view")
+    if analysis['repaired']:
+        warnings.append("the document is damaged and was repaired when opened")
+    if analysis['encrypted'] and incremental:
+        warnings.append("encrypted documents are rewritten instead of updated incrementally")
+
+    if engine == "process":
+        estimated_seconds = process_seconds
+    elif engine == "stream":
+        estimated_seconds = serial_seconds * PLAN_STREAM_FACTOR
+    else:
+        estimated_seconds = serial_seconds
+    return {
+        'engine': engine,
+        'workers': workers,
+        'chunk_size': chunk_size,
+        'save_profile': save_profile,
+        'estimated_seconds': round(estimated_seconds, 3),
+        'reasons': reasons,
+        'warnings': warnings,
+    }
+
+def watermark_document(input_pdf_path, output_pdf_path, processed_watermark, max_workers=4, cpu_threshold=80, memory_threshold=80, share_image=True, engine="process", chunk_size=DEFAULT_CHUNK_SIZE, incremental=False, save_profile="fast", strict=False, checkpoint_dir=None, resume=False):
+    """
+    Watermarks all pages of a PDF with an already prepared watermark image.
+
+    Args:
+        input_pdf_path (str): Path to the input PDF file.
+        output_pdf_path (str): Path to save the watermarked PDF.
+        processed_watermark (bytes): Processed watermark image (PNG data).
+        max_workers (int): Maximum number of processes or threads for parallel processing.
+        cpu_threshold (int): CPU usage percentage threshold to adjust workers.
+        memory_threshold (int): Memory usage percentage threshold to adjust workers.
+        share_image (bool): Reuse a single embedded watermark image for all pages.
+        engine (str): One of "process", "thread", "serial" or "stream".
+        chunk_size (int): Pages per chunk of the stream engine, and per
+            checkpointed page range of the process engine.
+        incremental (bool): Copy the input and append the watermark as an
+            incremental update instead of rewriting the whole file. Not
+            supported by the process engine.
+        save_profile (str): One of the SAVE_PROFILES names.
+        strict (bool): Retry pages that fail and fail the document with
+            WatermarkPageError if they still do; otherwise they are listed
+            as "failed_pages" in the timing data.
+        checkpoint_dir (str): Work directory where the process engine keeps
+            finished page ranges until the output is saved (see Checkpoint).
+        resume (bool): Continue from the page ranges finished in checkpoint_dir.
+
+    Returns:
+        dict: Page count and timing data for the document.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine!r}; expected one of {', '.join(ENGINES)}")
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be at least 1, got {chunk_size}")
+    if incremental and engine == "process":
+        raise ValueError("Incremental saving is not supported by the process engine")
+    if checkpoint_dir and engine != "process":
+        raise ValueError("Checkpoints are only supported by the process engine")
+    if save_profile not in SAVE_PROFILES:
+        raise ValueError(f"Unknown save profile {save_profile!r}; expected one of {', '.join(SAVE_PROFILES)}")
+
+    timing_data = {'engine': engine, 'save_profile': save_profile}
+    failed_pages = []
+    with open_document(input_pdf_path) as pdf:
+        total_pages = pdf.page_count
+        if incremental and not pdf.can_save_incrementally():
+            logging.warning("%s cannot be updated incrementally (damaged or encrypted); rewriting it instead", input_pdf_path)
+            incremental = False
+    timing_data['pages'] = total_pages
+    timing_data['save_mode'] = 'incremental' if incremental else 'full'
+    logging.info("PDF opened. Total pages: %s", total_pages)
+    emit_event('start', input=input_pdf_path, output=output_pdf_path, engine=engine, pages=total_pages)
+
+    input_size = os.path.getsize(input_pdf_path)
+    # An existing output is only replaced once the new one is complete, so a
+    # failed run leaves it as it was. Updating the input incrementally in
+    # place is the exception: it only appends to the file.
+    in_place = incremental and os.path.exists(output_pdf_path) and os.path.samefile(input_pdf_path, output_pdf_path)
+    work_path = output_pdf_path if in_place else temp_output_path(output_pdf_path)
+    try:
+        if incremental and not in_place:
+            copying_start_time = time.time()
+            shutil.copyfile(input_pdf_path, work_path)
+            timing_data['copying'] = time.time() - copying_start_time
+
+        if engine in ("thread", "serial") or total_pages == 0:
+            with open_document(work_path if incremental else input_pdf_path) as pdf:
+                watermarking_start_time = time.time()
+                if engine == "thread":
+                    timing_data['scaling_events'], failed_pages = watermark_pages_threaded(pdf, processed_watermark, max_workers, cpu_threshold, memory_threshold, share_image, strict)
+                else:
+                    failed_pages = watermark_pages_serial(pdf, processed_watermark, share_image, strict)
+                timing_data['watermarking'] = time.time() - watermarking_start_time
+
+                # Saving the watermarked PDF
+                timing_data['saving'] = save_document(pdf, work_path, save_profile, incremental)
+
+        if engine == "process" and total_pages:
+            watermarking_start_time = time.time()
+            merging_duration, saving_duration, timing_data['scaling_events'], failed_pages, resumed = watermark_pdf_sharded(
+                input_pdf_path, work_path, processed_watermark, total_pages,
+                max_workers, cpu_threshold, memory_threshold, share_image, save_profile,
+                strict, checkpoint_dir, resume, chunk_size
+            )
+            if checkpoint_dir:
+                timing_data['resumed_chunks'] = resumed
+            timing_data['watermarking'] = time.time() - watermarking_start_time - merging_duration - saving_duration
+            timing_data['merging'] = merging_duration
+            timing_data['saving'] = saving_duration
+        elif engine == "stream" and total_pages:
+            watermarking_start_time = time.time()
+            timing_data['chunks'], saving_duration, failed_pages = watermark_pdf_streamed(
+                input_pdf_path, work_path, processed_watermark, total_pages,
+                chunk_size, share_image, incremental, save_profile, strict
+            )
+            timing_data['watermarking'] = time.time() - watermarking_start_time - saving_duration
+            timing_data['saving'] = saving_duration
+
+        if failed_pages:
+            timing_data['failed_pages'] = failed_pages
+        else:
+            # Lets later runs recognise the output as watermarked (see skip_watermarked)
+            timing_data['saving'] += mark_watermarked(work_path, watermark_digest(processed_watermark))
+        if work_path != output_pdf_path:
+            os.replace(work_path, output_pdf_path)
+    except BaseException:
+        if work_path != output_pdf_path:
+            with contextlib.suppress(OSError):
+                os.remove(work_path)
+        raise
+
+    # An incremental update only writes what follows the copied input
+    output_size = os.path.getsize(output_pdf_path)
+    timing_data['output_size'] = output_size
+    timing_data['bytes_written'] = output_size - (input_size if incremental else 0)
+    for stage in ('copying', 'watermarking', 'merging', 'saving'):
+        if stage in timing_data:
+            emit_event('stage', stage=stage, duration=timing_data[stage])
+    logging.info("Watermarked PDF saved as %s", output_pdf_path)
+    return timing_data
+
+def watermark_open_document(pdf, output_pdf, processed_watermark, max_workers=4, cpu_threshold=80, memory_threshold=80, share_image=True, engine="serial", save_profile="fast", force=False, strict=False):
+    """
+    Watermarks a document that is already open, such as one read from memory
+    or a pipe, and saves it to a path or a binary file object without
+    temporary files. The process and stream engines work on files, so they
+    are replaced by the serial engine here; incremental updates need the
+    input file and are not available either.
+
+    Args:
+        pdf (fitz.Document): The open PDF document, see open_pdf_source.
+        output_pdf: Path or writable binary file object receiving the watermarked PDF.
+        processed_watermark (bytes): Prepared watermark.
+        max_workers (int): Maximum number of threads of the thread engine.
+        cpu_threshold (int): CPU usage percentage threshold to adjust workers.
+        memory_threshold (int): Memory usage percentage threshold to adjust workers.
+        share_image (bool): Reuse a single embedded watermark image for all pages.
+        engine (str): "thread" or "serial"; other engines run as "serial".
+        save_profile (str): Save profile of the output (see save_document).
+        force (bool): Watermark even if the document already carries this watermark.
+        strict (bool): Retry pages that fail and raise WatermarkPageError if
+            they still do (see watermark_document).
+
+    Returns:
+        dict: Timing data of the run.
+    """
+    if engine not in ("thread", "serial"):
+        logging.info("The %s engine needs files; using the serial engine for this in-memory document", engine)
+        engine = "serial"
+    if save_profile not in SAVE_PROFILES:
+        raise ValueError(f"Unknown save profile {save_profile!r}; expected one of {', '.join(SAVE_PROFILES)}")
+    total_pages = pdf.page_count
+    timing_data = {'engine': engine, 'save_profile': save_profile, 'pages': total_pages, 'save_mode': 'full'}
+    emit_event('start', input=pdf.name or "<stream>", output=output_pdf if is_pdf_path(output_pdf) else "<stream>", engine=engine, pages=total_pages)
+    marker = watermark_digest(processed_watermark)
+    if not force and read_watermark_marker(pdf) == marker:
+        logging.info("Skipping the document (already watermarked); writing it unchanged")
+        timing_data['skipped'] = 'already_watermarked'
+        timing_data['saving'] = save_document(pdf, output_pdf, "fast")
+    else:
+        watermarking_start_time = time.time()
+        if engine == "thread":
+            timing_data['scaling_events'], failed_pages = watermark_pages_threaded(pdf, processed_watermark, max_workers, cpu_threshold, memory_threshold, share_image, strict)
+        else:
+            failed_pages = watermark_pages_serial(pdf, processed_watermark, share_image, strict)
+        timing_data['watermarking'] = time.time() - watermarking_start_time
+        if failed_pages:
+            timing_data['failed_pages'] = failed_pages
+        else:
+            set_watermark_marker(pdf, marker)
+        timing_data['saving'] = save_document(pdf, output_pdf, save_profile)
+    if is_pdf_path(output_pdf):
+        timing_data['output_size'] = os.path.getsize(output_pdf)
+    for stage in ('watermarking', 'saving'):
+        if stage in timing_data:
+            emit_event('stage', stage=stage, duration=timing_data[stage])
+    return timing_data
+
+def watermark_pdf(input_pdf_path, output_pdf_path, watermark_image_path, opacity=0.2, max_workers=4, cpu_threshold=80, memory_threshold=80, share_image=True, engine="process", watermark_dpi=DEFAULT_WATERMARK_DPI, vector_options=None, chunk_size=DEFAULT_CHUNK_SIZE, incremental=False, save_profile="fast", index=None, force=False, cache=None, strict=False, checkpoint_dir=None, resume=False, metrics=None):
+    """
+    Watermarks all pages of a PDF with a transparent image under the content in parallel.
+    The process engine shards page ranges across worker processes; both
+    parallel engines submit work through an adaptive window that follows CPU
+    and memory usage.
+
+    Args:
+        input_pdf_path: Path to the input PDF file, or the PDF itself as a
+            bytes-like object or readable binary file object (see open_pdf_source).
+        output_pdf_path: Path to save the watermarked PDF, or a writable binary
+            file object. In-memory runs use watermark_open_document.
+        watermark_image_path (str): Path to the watermark image, or to a PDF or
+            SVG logo drawn as vector content.
+        opacity (float): Opacity level for the watermark.
+        max_workers (int): Maximum number of processes or threads for parallel processing.
+        cpu_threshold (int): CPU usage percentage threshold to adjust workers.
+        memory_threshold (int): Memory usage percentage threshold to adjust workers.
+        share_image (bool): Embed the watermark image once and make every page
+            reference the same image object (xref).
+        engine (str): One of "process", "thread", "serial" or "stream", or
+            "auto" to choose the engine, worker count (up to max_workers, or
+            the CPU count if None), chunk size and save profile from a
+            preflight analysis of the input (see plan_watermarking).
+        watermark_dpi (int): Resolution the watermark is downsampled to for the
+            largest page; 0 keeps the source resolution.
+        vector_options (dict): Options for vector watermarks: text, rotation,
+            font, font_size and color (see prepare_vector_watermark). A "text"
+            entry replaces the watermark image with a text watermark.
+        chunk_size (int): Pages per chunk of the stream engine; None lets the
+            auto engine choose, and is DEFAULT_CHUNK_SIZE otherwise.
+        incremental (bool): Append the watermark to a copy of the input as an
+            incremental update instead of rewriting the whole file.
+        save_profile (str): "fast" (plain save), "balanced" (drop unused
+            objects, compress streams, use object streams) or "smallest" (also
+            deduplicate objects and clean content streams, which is slow for
+            documents with many distinct images). None lets the auto engine
+            choose, and is "fast" otherwise.
+        index (ResultIndex): Index of earlier results; a run repeating one
+            whose output is unchanged links that output instead.
+        force (bool): Watermark even if the input already carries this
+            watermark or the index holds a result for the run.
+        cache (WatermarkCache): Prepared-watermark cache; defaults to the
+            process-wide cache.
+        strict (bool): Retry pages that fail and raise WatermarkPageError if
+            they still do; otherwise they are reported as "failed_pages".
+        checkpoint_dir (str): Work directory where the process engine keeps
+            finished page ranges of chunk_size pages, so that an interrupted
+            run can be resumed.
+        resume (bool): Continue from the page ranges finished in checkpoint_dir.
+        metrics (StageMetrics): Receives the stage histograms of the run, for
+            export; their summary is always included in the timing data.
+
+    Returns:
+        dict: Timing data.
+    """
+    if engine not in ENGINES + (AUTO_ENGINE,):
+        raise ValueError(f"Unknown engine {engine!r}; expected one of {', '.join(ENGINES + (AUTO_ENGINE,))}")
+
+    logging.info("Starting the watermarking process...")
+    start_time = time.time()
+    timing_data = {}
+    in_memory = not (is_pdf_path(input_pdf_path) and is_pdf_path(output_pdf_path))
+    metrics = StageMetrics() if metrics is None else metrics
+    try:
+        with collect_metrics(metrics):
+            if engine == AUTO_ENGINE and in_memory:
+                # In-memory documents are watermarked serially (see watermark_open_document)
+                engine = "serial"
+            elif engine == AUTO_ENGINE:
+                analysis = preflight(input_pdf_path)
+                plan = plan_watermarking(analysis, engine, max_workers, chunk_size, save_profile, incremental, bool(checkpoint_dir))
+                logging.info(
+                    "Plan for %s pages: %s engine, %s workers, %s save profile (%s)",
+                    analysis['pages'], plan['engine'], plan['workers'], plan['save_profile'], '; '.join(plan['reasons'])
+                )
+                for warning in plan['warnings']:
+                    logging.warning("%s: %s", input_pdf_path, warning)
+                engine, max_workers, chunk_size, save_profile = plan['engine'], plan['workers'], plan['chunk_size'], plan['save_profile']
+                timing_data['preflight'] = analysis['preflight_time']
+                timing_data['workers'] = max_workers
+                emit_event('stage', stage='preflight', duration=analysis['preflight_time'])
+            max_workers = max_workers or 4
+            chunk_size = DEFAULT_CHUNK_SIZE if chunk_size is None else chunk_size
+            save_profile = save_profile or "fast"
+            preparation_start_time = time.time()
+
+            if in_memory:
+                with open_pdf_source(input_pdf_path) as pdf:
+                    # Preparing the watermark image
+                    processed_watermark = load_watermark(watermark_image_path, opacity, watermark_target_size(pdf, watermark_dpi), cache, **(vector_options or {}))
+                    watermark_preparation_time = time.time()
+                    timing_data['watermark_preparation'] = watermark_preparation_time - preparation_start_time
+                    if incremental:
+                        logging.warning("Incremental updates need an input file; saving the whole document instead")
+                    if checkpoint_dir:
+                        raise ValueError("Checkpoints need an input and output file")
+                    timing_data.update(watermark_open_document(
+                        pdf, output_pdf_path, processed_watermark,
+                        max_workers, cpu_threshold, memory_threshold, share_image, engine, save_profile, force, strict
+                    ))
+                return report_timing(timing_data, start_time, watermark_preparation_time, metrics)
+
+            # Preparing the watermark image
+            with open_document(input_pdf_path) as pdf:
+                max_side = watermark_target_size(pdf, watermark_dpi)
+            processed_watermark = load_watermark(watermark_image_path, opacity, max_side, cache, **(vector_options or {}))
+            watermark_preparation_time = time.time()
+            timing_data['watermark_preparation'] = watermark_preparation_time - preparation_start_time
+
+            skipped, run_key = skip_watermarked(
+                input_pdf_path, output_pdf_path, processed_watermark, share_image, save_profile, incremental, index, force
+            )
+            if skipped:
+                timing_data.update(skipped)
+            else:
+                timing_data.update(watermark_document(
+                    input_pdf_path, output_pdf_path, processed_watermark,
+                    max_workers, cpu_threshold, memory_threshold, share_image, engine, chunk_size, incremental, save_profile,
+                    strict, checkpoint_dir, resume
+                ))
+                if run_key and not timing_data.get('failed_pages'):
+                    index.record(run_key, output_pdf_path)
+            return report_timing(timing_data, start_time, watermark_preparation_time, metrics)
+
+    except Exception as e:
+        logging.error("Failed to watermark PDF: %s", e)
+        emit_event('error', error=str(e))
+        raise
+
+def report_timing(timing_data, start_time, watermark_preparation_time, metrics):
+    """
+    Completes and logs the timing data of a watermark_pdf run, with the
+    summary of its stage metrics under "metrics".
+
+    Returns:
+        dict: The timing data.
+    """
+    preparation_duration = timing_data['watermark_preparation']
+    logging.info("Watermark preparation took %.2f seconds.", preparation_duration)
+    emit_event('stage', stage='watermark_preparation', duration=preparation_duration)
+    metrics.observe("prepare", preparation_duration)
+
+    # Calculating and log saving duration
+    watermark_post_process_time = time.time()
+    saving_duration = watermark_post_process_time - watermark_preparation_time
+    logging.info("Watermarking and saving took %.2f seconds.", saving_duration)
+    timing_data['watermarking_and_saving'] = saving_duration
+
+    # Total process time
+    total_time = watermark_post_process_time - start_time
+    logging.info("Total watermarking process took %.2f seconds.", total_time)
+    timing_data['total_time'] = total_time
+    timing_data['peak_rss_mb'] = metrics.peak_rss_mb = peak_rss_mb()
+    timing_data['metrics'] = metrics.summary()
+    page_latency = timing_data['metrics']['stages'].get('page')
+    if page_latency:
+        logging.info("Page latency: p50 %.2f ms, p99 %.2f ms, max %.2f ms", page_latency['p50'] * 1000, page_latency['p99'] * 1000, page_latency['max'] * 1000)
+
+    emit_event('result', **timing_data)
+    return timing_data
+
+def collect_fanout_variants(manifest):
+    """
+    Reads the variants of a fan-out run from a JSONL manifest. Every line
+    holds an "output" and any of FANOUT_VARIANT_KEYS; relative paths are
+    resolved against the manifest's directory.
+
+    Returns:
+        list: One dict per variant.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    variants = []
+    with open(manifest) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            unknown = set(entry) - {"output", *FANOUT_VARIANT_KEYS}
+            if "output" not in entry or unknown:
+                raise ValueError(f"{manifest}:{line_number}: variants need an 'output' and may only set {', '.join(FANOUT_VARIANT_KEYS)}")
+            entry["output"] = os.path.join(base_dir, entry["output"])
+            if entry.get("watermark"):
+                entry["watermark"] = os.path.join(base_dir, entry["watermark"])
+            variants.append(entry)
+    return variants
+
+def watermark_aspect_ratio(processed_watermark):
+    """
+    Returns the width-to-height ratio of a raster watermark from its PNG
+    header, or None for vector watermarks.
+    """
+    if is_vector_watermark(processed_watermark):
+        return None
+    # The IHDR chunk follows the 8-byte signature and its own 8-byte header
+    width, height = int.from_bytes(processed_watermark[16:20], "big"), int.from_bytes(processed_watermark[20:24], "big")
+    return round(width / height, 3)
+
+def replace_watermark_image(pdf, xref, processed_watermark):
+    """
+    Replaces the shared watermark image of a watermarked document with
+    another raster watermark of the same aspect ratio. The pages keep
+    referencing the same image object, so neither their content nor their
+    resources change. The new image is embedded on a scratch page that is
+    removed again; the replaced image's soft mask is left unreferenced, so
+    the document must be saved with garbage collection.
+    """
+    scratch = pdf.new_page()
+    new_xref = scratch.insert_image(scratch.rect, stream=processed_watermark)
+    compress_image_stream(pdf, new_xref)
+    pdf.xref_copy(new_xref, xref)
+    pdf.delete_page(-1)
+
+def write_output(output, data):
+    """
+    Writes serialised PDF data to a path or a binary file object.
+
+    Returns:
+        int: Number of bytes written.
+    """
+    if is_pdf_path(output):
+        output_dir = os.path.dirname(output)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with open(output, "wb") as f:
+            f.write(data)
+    else:
+        output.write(data)
+    return len(data)
+
+def watermark_fanout_pass(pdf, watermarks, save_profile="fast", strict=False):
+    """
+    Applies the first of several raster watermarks of one aspect ratio (or a
+    single vector watermark) to every page, then serialises the document
+    once per watermark, replacing the shared image in between. If every
+    page failed, there is no image to replace, and the next watermark is
+    applied to the pages instead.
+
+    Args:
+        pdf (fitz.Document): The open input document; it is modified.
+        watermarks (list): Prepared watermarks.
+        save_profile (str): Save profile of the outputs.
+        strict (bool): Retry failed pages and raise WatermarkPageError for
+            those that still fail (see settle_failed_pages).
+
+    Yields:
+        tuple: The prepared watermark, the serialised PDF as an io.BytesIO,
+        the time spent watermarking and saving in seconds, and the 1-based
+        numbers of pages left without a watermark.
+    """
+    watermarking_start_time = time.time()
+    watermark_xref, failed_pages = watermark_planned_pages(pdf, open_watermark(watermarks[0]), planned_pages(pdf), strict=strict)
+    for position, processed_watermark in enumerate(watermarks):
+        replacing = False
+        if position:
+            watermarking_start_time = time.time()
+            if watermark_xref and pdf.xref_get_key(watermark_xref, "Subtype") == ("name", "/Image"):
+                replace_watermark_image(pdf, watermark_xref, processed_watermark)
+                replacing = True
+            else:
+                # No page took the image of an earlier variant, so there is
+                # none to replace; this variant watermarks the pages itself
+                watermark_xref, failed_pages = watermark_planned_pages(pdf, open_watermark(processed_watermark), planned_pages(pdf), strict=strict)
+        if not failed_pages:
+            set_watermark_marker(pdf, watermark_digest(processed_watermark))
+        watermarking_duration = time.time() - watermarking_start_time
+        buffer = io.BytesIO()
+        saving_duration = save_document(pdf, buffer, save_profile, min_garbage=1 if replacing else 0)
+        yield processed_watermark, buffer, watermarking_duration, saving_duration, failed_pages
+
+def watermark_fanout(input_pdf_path, variants, watermark_image_path=None, opacity=0.2, watermark_dpi=DEFAULT_WATERMARK_DPI, vector_options=None, save_profile="fast", cache=None, strict=False, metrics=None):
+    """
+    Watermarks one document with several watermarks, one output per variant,
+    parsing the input once. Raster variants of the same aspect ratio share
+    one pass over the pages: the first variant is applied to every page and
+    each later one only replaces the shared image object (see
+    replace_watermark_image) before the document is saved again. Vector
+    variants and other aspect ratios take a pass of their own over a
+    reopened document. Variants with the same prepared watermark are saved
+    once. Saves run one after another, since PyMuPDF documents are not
+    thread-safe, but the outputs are written by FANOUT_WRITERS threads while
+    the next variant is prepared and saved.
+
+    Args:
+        input_pdf_path: Path to the input PDF, or the PDF as a bytes-like or
+            readable binary file object (see open_pdf_source).
+        variants (list): Dicts with an "output" path or binary file object
+            and any of FANOUT_VARIANT_KEYS; missing keys take the values of
+            the arguments below.
+        watermark_image_path (str): Watermark of variants that set neither
+            "watermark" nor "text".
+        opacity (float): Opacity of variants that do not set one.
+        watermark_dpi (int): Resolution raster watermarks are downsampled to
+            for the largest page; 0 keeps the source resolution.
+        vector_options (dict): Vector options of variants that do not set
+            them; a "text" entry is the watermark of variants that set
+            neither "watermark" nor "text".
+        save_profile (str): Save profile of every output (see save_document).
+        cache (WatermarkCache): Prepared-watermark cache; defaults to the
+            process-wide cache.
+        strict (bool): Retry pages that fail and raise WatermarkPageError if
+            they still do; otherwise they are reported in every affected variant.
+        metrics (StageMetrics): Receives the stage histograms of the run.
+
+    Returns:
+        dict: Timing data of the run, with one record per variant under "variants".
+    """
+    if save_profile not in SAVE_PROFILES:
+        raise ValueError(f"Unknown save profile {save_profile!r}; expected one of {', '.join(SAVE_PROFILES)}")
+    logging.info("Starting fan-out watermarking of %s variants...", len(variants))
+    start_time = time.time()
+    if not is_pdf_path(input_pdf_path) and hasattr(input_pdf_path, "read") and not isinstance(input_pdf_path, io.BytesIO):
+        # A pipe cannot be read twice, and later passes reopen the input
+        input_pdf_path = input_pdf_path.read()
+    timing_data = {'engine': 'fanout', 'save_profile': save_profile}
+    records = [{'output': variant['output'] if is_pdf_path(variant['output']) else "<stream>"} for variant in variants]
+    metrics = StageMetrics() if metrics is None else metrics
+    pending = {}
+
+    def write(index, buffer):
+        # Bounds the serialised outputs held in memory
+        while len(pending) >= FANOUT_PENDING_WRITES:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                records[pending.pop(future)]['output_size'] = future.result()
+        pending[writers.submit(write_output, variants[index]['output'], buffer.getbuffer())] = index
+
+    def run_pass(pdf, pass_number, watermarks):
+        for processed_watermark, buffer, watermarking_duration, saving_duration, failed_pages in watermark_fanout_pass(pdf, watermarks, save_profile, strict):
+            for index in outputs[processed_watermark]:
+                records[index].update(pass_number=pass_number, watermarking=watermarking_duration, saving=saving_duration)
+                if failed_pages:
+                    records[index]['failed_pages'] = failed_pages
+                write(index, buffer)
+
+    with collect_metrics(metrics), ThreadPoolExecutor(max_workers=FANOUT_WRITERS) as writers:
+        with open_pdf_source(input_pdf_path) as pdf:
+            timing_data['pages'] = pdf.page_count
+            preparation_start_time = time.time()
+            max_side = watermark_target_size(pdf, watermark_dpi)
+            prepared = []
+            for variant in variants:
+                options = dict(vector_options or {})
+                options.update((key, variant[key]) for key in FANOUT_VARIANT_KEYS[3:] if key in variant)
+                text = options.pop('text', None)
+                watermark = watermark_image_path
+                if 'watermark' in variant or 'text' in variant:
+                    watermark = variant.get('watermark')
+                    text = variant.get('text')
+                prepared.append(load_watermark(watermark, variant.get('opacity', opacity), max_side, cache, text, **options))
+            timing_data['watermark_preparation'] = time.time() - preparation_start_time
+            observe_stage("prepare", timing_data['watermark_preparation'])
+
+            # Variants with the same prepared watermark share an output, and
+            # raster watermarks of one aspect ratio share a pass
+            outputs = {}
+            passes = {}
+            for index, processed_watermark in enumerate(prepared):
+                if processed_watermark not in outputs:
+                    outputs[processed_watermark] = []
+                    aspect_ratio = watermark_aspect_ratio(processed_watermark)
+                    passes.setdefault(f"vector-{index}" if aspect_ratio is None else aspect_ratio, []).append(processed_watermark)
+                outputs[processed_watermark].append(index)
+            passes = list(passes.values())
+            timing_data['passes'] = len(passes)
+            run_pass(pdf, 0, passes[0])
+        for pass_number, watermarks in enumerate(passes[1:], 1):
+            with open_pdf_source(input_pdf_path) as pdf:
+                run_pass(pdf, pass_number, watermarks)
+        for future, index in pending.items():
+            records[index]['output_size'] = future.result()
+
+    total_time = time.time() - start_time
+    logging.info("Fan-out of %s variants in %s passes took %.2f seconds.", len(variants), timing_data['passes'], total_time)
+    timing_data['variants'] = records
+    timing_data['total_time'] = total_time
+    timing_data['peak_rss_mb'] = metrics.peak_rss_mb = peak_rss_mb()
+    timing_data['metrics'] = metrics.summary()
+    emit_event('result', **timing_data)
+    return timing_data
+
+def collect_batch_jobs(source, output_dir=None):
+    """
+    Expands a batch source into (input, output) pairs.
+
+    Args:
+        source (str): A directory of PDFs, a glob pattern, or a JSONL manifest
+            whose lines hold "input" and "output" keys. Relative manifest paths
+            are resolved against the manifest's directory.
+        output_dir (str): Directory for the outputs of directory and glob
+            sources. Outputs keep the input file name.
+
+    Returns:
+        list: (input_pdf_path, output_pdf_path) tuples.
+    """
+    if source.endswith(".jsonl") and os.path.isfile(source):
+        base_dir = os.path.dirname(os.path.abspath(source))
+        jobs = []
+        with open(source) as manifest:
+            for line_number, line in enumerate(manifest, 1):
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if "input" not in entry or "output" not in entry:
+                    raise ValueError(f"{source}:{line_number}: manifest entries need 'input' and 'output'")
+                jobs.append((os.path.join(base_dir, entry["input"]), os.path.join(base_dir, entry["output"])))
+        return jobs
+
+    if os.path.isdir(source):
+        inputs = sorted(
+            os.path.join(source, name) for name in os.listdir(source)
+            if name.lower().endswith(".pdf") and os.path.isfile(os.path.join(source, name))
+        )
+    else:
+        inputs = sorted(path for path in glob.glob(source, recursive=True) if os.path.isfile(path))
+
+    if not output_dir:
+        raise ValueError("An output directory is required for directory and glob batch sources")
+    outputs = [os.path.join(output_dir, os.path.basename(path)) for path in inputs]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError(f"Batch source {source!r} contains several files with the same name")
+    return list(zip(inputs, outputs))
+
+def watermark_batch_file(input_pdf_path, output_pdf_path, processed_watermark, share_image=True, save_profile="fast", index=None, force=False, strict=False):
+    """
+    Worker entry point of batch mode: watermarks one document serially and
+    reports the outcome instead of raising. Documents skip_watermarked finds
+    a result for are not watermarked again.
+
+    Returns:
+        dict: Result record for the document, with the summary of its stage
+        metrics under "metrics".
+    """
+    start_time = time.time()
+    record = {'input': input_pdf_path, 'output': output_pdf_path}
+    with collect_metrics(StageMetrics()) as metrics:
+        try:
+            output_dir = os.path.dirname(output_pdf_path)
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+            skipped, run_key = skip_watermarked(input_pdf_path, output_pdf_path, processed_watermark, share_image, save_profile, index=index, force=force)
+            if skipped:
+                record.update(skipped)
+            else:
+                record.update(watermark_document(input_pdf_path, output_pdf_path, processed_watermark, share_image=share_image, engine="serial", save_profile=save_profile, strict=strict))
+                if run_key and not record.get('failed_pages'):
+                    index.record(run_key, output_pdf_path)
+            record['status'] = 'ok'
+        except Exception as e:
+            logging.error("Failed to watermark %s: %s", input_pdf_path, e)
+            record['status'] = 'error'
+            record['error'] = str(e)
+    record['total_time'] = time.time() - start_time
+    # Batch workers live for many documents, so the peak is that of the worker so far
+    metrics.peak_rss_mb = peak_rss_mb()
+    record['metrics'] = metrics.summary()
+    return record
+
+def watermark_batch(jobs, watermark_image_path, opacity=0.2, max_workers=4, cpu_threshold=80, memory_threshold=80, share_image=True, results_path=None, watermark_dpi=DEFAULT_WATERMARK_DPI, vector_options=None, save_profile="fast", index=None, force=False, on_record=None, strict=False):
+    """
+    Watermarks many PDFs in one process. The watermark is prepared once and the
+    documents are spread over a pool of worker processes, one document per task.
+
+    Args:
+        jobs (list): (input_pdf_path, output_pdf_path) tuples.
+        watermark_image_path (str): Path to the watermark image file.
+        opacity (float): Opacity level for the watermark.
+        max_workers (int): Number of worker processes.
+        cpu_threshold (int): CPU usage percentage threshold to adjust workers.
+        memory_threshold (int): Memory usage percentage threshold to adjust workers.
+        share_image (bool): Reuse a single embedded watermark image within each document.
+        results_path (str): Optional JSONL file receiving one record per document.
+        watermark_dpi (int): Resolution the watermark is downsampled to for a
+            page of BATCH_REFERENCE_PAGE_SIDE points; 0 keeps the source resolution.
+        vector_options (dict): Options for vector watermarks (see watermark_pdf).
+        save_profile (str): Save profile of every output (see watermark_pdf).
+        index (ResultIndex): Index of earlier results (see watermark_pdf).
+        force (bool): Watermark documents even if they could be skipped.
+        on_record (callable): Called with each result record as its document finishes.
+        strict (bool): Fail documents with pages that cannot be watermarked
+            (see watermark_document).
+
+    Returns:
+        list: Result records in completion order.
+    """
+    logging.info("Starting batch watermarking of %s documents...", len(jobs))
+    start_time = time.time()
+    max_side = watermark_pixel_size(BATCH_REFERENCE_PAGE_SIDE, watermark_dpi)
+    processed_watermark = load_watermark(watermark_image_path, opacity, max_side, **(vector_options or {}))
+    records = []
+    results_file = open(results_path, "w") if results_path else None
+    try:
+        with ResourceSampler() as sampler, ProcessPoolExecutor(max_workers=max_workers) as executor:
+            scheduler = AdaptiveScheduler(max_workers, sampler, cpu_threshold, memory_threshold)
+            tasks = ((input_pdf, output_pdf, processed_watermark, share_image, save_profile, index, force, strict) for input_pdf, output_pdf in jobs)
+            for _, future in scheduler.run(executor, watermark_batch_file, tasks):
+                record = future.result()
+                records.append(record)
+                if on_record:
+                    on_record(record)
+                if results_file:
+                    results_file.write(json.dumps(record) + "\n")
+                    results_file.flush()
+                logging.info("Watermarked document %s/%s: %s (%s)", len(records), len(jobs), record['input'], record['status'])
+                emit_event('document', done=len(records), total=len(jobs), **record)
+    finally:
+        if results_file:
+            results_file.close()
+
+    failed = sum(1 for record in records if record['status'] != 'ok')
+    logging.info("Batch finished in %.2f seconds: %s succeeded, %s failed.", time.time() - start_time, len(records) - failed, failed)
+    return records
+
+def prepare_scheduled_job(input_pdf_path, watermark_image_path=None, opacity=0.2, watermark_dpi=DEFAULT_WATERMARK_DPI, vector_options=None):
+    """
+    Worker entry point of the job scheduler: counts the pages of a document
+    and prepares its watermark.
+
+    Returns:
+        tuple: Page count and processed watermark.
+    """
+    with fitz.open(input_pdf_path) as pdf:
+        total_pages = pdf.page_count
+        max_side = watermark_target_size(pdf, watermark_dpi)
+    return total_pages, load_watermark(watermark_image_path, opacity, max_side, **(vector_options or {}))
+
+class PageBudget:
+    """
+    Pool of page slots shared by all jobs of a JobScheduler. Waiters are
+    served strictly by priority and then arrival, so a bulk job cannot take
+    the slots an interactive job is waiting for.
+
+    Args:
+        pages (int): Pages that may be in flight at once.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.available = pages
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    async def acquire(self, pages, priority=PRIORITY_BULK):
+        """
+        Waits for page slots. Requests larger than the budget are capped at it.
+
+        Returns:
+            int: Number of slots granted, to be passed to release.
+        """
+        pages = min(pages, self.pages)
+        entry = (priority, next(self._sequence), pages, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, entry)
+        self._grant()
+        try:
+            return await entry[3]
+        except asyncio.CancelledError:
+            if entry[3].done() and not entry[3].cancelled():
+                # Granted just before the waiter was cancelled
+                self.release(pages)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._grant()
+            raise
+
+    def release(self, pages):
+        """
+        Returns page slots to the budget.
+        """
+        self.available += pages
+        self._grant()
+
+    def _grant(self):
+        while self._waiters and self._waiters[0][2] <= self.available:
+            _, _, pages, future = heapq.heappop(self._waiters)
+            if future.cancelled():
+                continue
+            self.available -= pages
+            future.set_result(pages)
+
+class ScheduledJob:
+    """
+    Handle of a job submitted to a JobScheduler.
+
+    Attributes:
+        input_pdf_path (str): Path to the input PDF file.
+        output_pdf_path (str): Path to save the watermarked PDF.
+        priority (int): Lower values run first.
+        total_pages (int): Page count, once the job has started.
+        pages_done (int): Pages watermarked so far.
+    """
+
+    def __init__(self, input_pdf_path, output_pdf_path, priority, options):
+        self.input_pdf_path = input_pdf_path
+        self.output_pdf_path = output_pdf_path
+        self.priority = priority
+        self.options = options
+        self.total_pages = None
+        self.pages_done = 0
+        self.cancelled = False
+        self._task = None
+        self._result = asyncio.get_running_loop().create_future()
+
+    def cancel(self):
+        """
+        Cancels the job. A queued job never starts; a running job stops after
+        the chunk in progress and its partial output is removed.
+        """
+        self.cancelled = True
+        if self._task is not None:
+            self._task.cancel()
+
+    def done(self):
+        return self._result.done()
+
+    async def wait(self):
+        """
+        Waits for the job to finish.
+
+        Returns:
+            dict: Result record with the status ("ok", "error" or "cancelled"),
+            page count, timing data and any error.
+        """
+        return await asyncio.shield(self._result)
+
+class JobScheduler:
+    """
+    asyncio scheduler running watermarking jobs concurrently with bounded
+    resources. Jobs wait in a bounded priority queue, so submit waits while
+    it is full; up to max_active_jobs run at once. Every job is cut into
+    chunks of the stream engine, and each chunk takes its pages from a budget
+    shared by all jobs before it runs on the worker pool. An interactive job
+    therefore waits for at most one chunk of a large bulk job.
+
+    Use it as an async context manager; leaving the block waits for the
+    submitted jobs.
+
+    Args:
+        max_workers (int): Worker processes the chunks run on.
+        page_budget (int): Pages being watermarked at once across all jobs.
+        chunk_size (int): Pages per chunk; capped at page_budget.
+        max_queued (int): Jobs waiting to start before submit blocks.
+        max_active_jobs (int): Jobs running at once.
+        executor (concurrent.futures.Executor): Pool to run on instead of a
+            private process pool.
+    """
+
+    def __init__(self, max_workers=4, page_budget=DEFAULT_PAGE_BUDGET, chunk_size=DEFAULT_SCHEDULER_CHUNK_SIZE, max_queued=DEFAULT_MAX_QUEUED_JOBS, max_active_jobs=None, executor=None):
+        if page_budget < 1 or chunk_size < 1:
+            raise ValueError("page_budget and chunk_size must be at least 1")
+        self.max_workers = max_workers
+        self.chunk_size = min(chunk_size, page_budget)
+        self.max_active_jobs = max_active_jobs or 2 * max_workers
+        self.budget = PageBudget(page_budget)
+        self._queue = asyncio.PriorityQueue(max_queued)
+        self._sequence = itertools.count()
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._runners = []
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def start(self):
+        """
+        Starts the worker pool and the job runners.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self._runners = [asyncio.create_task(self._runner()) for _ in range(self.max_active_jobs)]
+
+    async def close(self):
+        """
+        Waits for every submitted job, then stops the runners and the pool.
+        """
+        await self._queue.join()
+        for runner in self._runners:
+            runner.cancel()
+        await asyncio.gather(*self._runners, return_exceptions=True)
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _make_job(self, input_pdf_path, output_pdf_path, watermark_image_path, priority, opacity, watermark_dpi, vector_options, share_image, save_profile):
+        if save_profile not in SAVE_PROFILES:
+            raise ValueError(f"Unknown save profile {save_profile!r}; expected one of {', '.join(SAVE_PROFILES)}")
+        options = {
+            'watermark_image_path': watermark_image_path,
+            'opacity': opacity,
+            'watermark_dpi': watermark_dpi,
+            'vector_options': vector_options,
+            'share_image': share_image,
+            'save_profile': save_profile,
+        }
+        return ScheduledJob(input_pdf_path, output_pdf_path, priority, options)
+
+    async def submit(self, input_pdf_path, output_pdf_path, watermark_image_path=None, priority=PRIORITY_BULK, opacity=0.2, watermark_dpi=DEFAULT_WATERMARK_DPI, vector_options=None, share_image=True, save_profile="fast"):
+        """
+        Queues a job, waiting while the queue is full.
+
+        Args:
+            input_pdf_path (str): Path to the input PDF file.
+            output_pdf_path (str): Path to save the watermarked PDF.
+            watermark_image_path (str): Path to the watermark image file.
+            priority (int): PRIORITY_INTERACTIVE, PRIORITY_BULK or any
+                other integer; lower values run first.
+            opacity (float): Opacity level for the watermark.
+            watermark_dpi (int): Resolution the watermark is prepared for.
+            vector_options (dict): Options for vector watermarks (see watermark_pdf).
+            share_image (bool): Reuse a single embedded watermark image for all pages.
+            save_profile (str): One of the SAVE_PROFILES names.
+
+        Returns:
+            ScheduledJob: Handle to wait for or cancel the job.
+        """
+        job = self._make_job(input_pdf_path, output_pdf_path, watermark_image_path, priority, opacity, watermark_dpi, vector_options, share_image, save_profile)
+        await self._queue.put((priority, next(self._sequence), job))
+        return job
+
+    def submit_nowait(self, input_pdf_path, output_pdf_path, watermark_image_path=None, priority=PRIORITY_BULK, opacity=0.2, watermark_dpi=DEFAULT_WATERMARK_DPI, vector_options=None, share_image=True, save_profile="fast"):
+        """
+        Queues a job like submit, but raises asyncio.QueueFull instead of
+        waiting when the queue is full.
+        """
+        job = self._make_job(input_pdf_path, output_pdf_path, watermark_image_path, priority, opacity, watermark_dpi, vector_options, share_image, save_profile)
+        self._queue.put_nowait((priority, next(self._sequence), job))
+        return job
+
+    async def _runner(self):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.cancelled:
+                    job._result.set_result({'input': job.input_pdf_path, 'output': job.output_pdf_path, 'status': 'cancelled'})
+                    continue
+                job._task = asyncio.create_task(self._run(job))
+                # Waiting without propagating the job's own cancellation to the runner
+                await asyncio.wait([job._task])
+            finally:
+                self._queue.task_done()
+
+    async def _call(self, fn, *args):
+        future = asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # A worker cannot be interrupted; let it finish before the output is removed
+            await asyncio.wait([future])
+            raise
+
+    async def _run(self, job):
+        start_time = time.time()
+        options = job.options
+        record = {'input': job.input_pdf_path, 'output': job.output_pdf_path, 'priority': job.priority}
+        try:
+            job.total_pages, processed_watermark = await self._call(
+                prepare_scheduled_job, job.input_pdf_path, options['watermark_image_path'],
+                options['opacity'], options['watermark_dpi'], options['vector_options']
+            )
+            record['pages'] = job.total_pages
+            record['watermark_preparation'] = time.time() - start_time
+            if job.total_pages == 0:
+                shutil.copyfile(job.input_pdf_path, job.output_pdf_path)
+            watermark_xref = 0
+            progress = ProgressReporter(job.total_pages, f" of {job.input_pdf_path}", input=job.input_pdf_path)
+            for start in range(0, job.total_pages, self.chunk_size):
+                stop = min(start + self.chunk_size, job.total_pages)
+                pages = await self.budget.acquire(stop - start, job.priority)
+                try:
+                    watermark_xref, _, failed = await self._call(
+                        watermark_stream_chunk, job.input_pdf_path, job.output_pdf_path, processed_watermark,
+                        start, stop, watermark_xref, options['share_image'], False, options['save_profile']
+                    )
+                    if failed:
+                        record.setdefault('failed_pages', []).extend(failed)
+                finally:
+                    self.budget.release(pages)
+                job.pages_done = stop
+                progress.update(stop, start + 1, stop)
+            if job.total_pages:
+                await self._call(copy_document_extras, job.input_pdf_path, job.output_pdf_path, options['save_profile'])
+            record['status'] = 'ok'
+        except asyncio.CancelledError:
+            logging.info("Cancelled watermarking of %s", job.input_pdf_path)
+            record['status'] = 'cancelled'
+            if job.total_pages is not None and os.path.exists(job.output_pdf_path):
+                os.remove(job.output_pdf_path)
+        except Exception as e:
+            logging.error("Failed to watermark %s: %s", job.input_pdf_path, e)
+            record['status'] = 'error'
+            record['error'] = str(e)
+        record['total_time'] = time.time() - start_time
+        job._result.set_result(record)
+
+def build_parser(batch=False, fanout=False):
+    """
+    Builds the command-line parser. Batch mode replaces the input and output
+    positionals with --batch and --output-dir; fan-out mode replaces the
+    output positional with --fanout.
+    """
+    parser = argparse.ArgumentParser(description="Watermark all pages of a PDF with a transparent image.")
+    if batch:
+        parser.add_argument("--batch", required=True, help="Directory of PDFs, glob pattern, or JSONL manifest of input/output pairs.")
+        parser.add_argument("--output-dir", help="Directory for watermarked PDFs (directory and glob sources).")
+        parser.add_argument("--results", help="Path of a JSONL file receiving one result record per document.")
+    elif fanout:
+        parser.add_argument("--fanout", required=True, metavar="MANIFEST", help="JSONL manifest of output variants, each an output path and any of watermark, opacity, text, rotation, font, font_size and color.")
+        parser.add_argument("input_pdf", help="Path to the input PDF file, or - to read it from stdin.")
+    else:
+        parser.add_argument("--batch", help="Watermark many PDFs: a directory, glob pattern, or JSONL manifest.")
+        parser.add_argument("--fanout", metavar="MANIFEST", help="Watermark one PDF with many watermarks: a JSONL manifest of output variants.")
+        parser.add_argument("input_pdf", help="Path to the input PDF file, or - to read it from stdin.")
+        parser.add_argument("output_pdf", help="Path to save the watermarked PDF, or - to write it to stdout.")
+    parser.add_argument("watermark_image", nargs="?", help="Path to the watermark image file, or a PDF/SVG logo drawn as vector content.")
+    parser.add_argument("--text", help="Draw this text as a vector watermark instead of an image.")
+    parser.add_argument("--font", default=DEFAULT_FONT, help="Base-14 font name (helv, tiro, cour, ...) or font file for --text. Default is helv.")
+    parser.add_argument("--font-size", type=float, default=DEFAULT_FONT_SIZE, help="Font size for --text. Default is 48.")
+    parser.add_argument("--text-color", default=DEFAULT_TEXT_COLOR, help="Color for --text as #RRGGBB. Default is #808080.")
+    parser.add_argument("--rotation", type=float, default=0, help="Counter-clockwise rotation of vector watermarks in degrees.")
+    parser.add_argument("--opacity", type=float, default=0.2, help="Opacity level for the watermark (0 to 1).")
+    parser.add_argument("--workers", type=int, help="Number of parallel worker processes or threads. Default: chosen by --engine auto (at most the CPU count), otherwise 4.")
+    parser.add_argument("--engine", choices=ENGINES + (AUTO_ENGINE,), default=AUTO_ENGINE, help="Page-processing engine; auto chooses one from a preflight analysis of the input. Default is auto.")
+    parser.add_argument("--chunk-size", type=int, help="Pages per chunk of the stream engine and per checkpointed range of the process engine. Default: chosen by --engine auto, otherwise 500.")
+    parser.add_argument("--incremental", action='store_true', help="Append the watermark to a copy of the input as an incremental update instead of rewriting the file (serial, thread and stream engines).")
+    parser.add_argument("--save-profile", choices=SAVE_PROFILES, help="Output save options: fast, balanced or smallest. Default: chosen by --engine auto, otherwise fast.")
+    parser.add_argument("--events", metavar="FD_OR_PATH", help="Write newline-delimited JSON progress, stage, throughput and resource events to this file descriptor number or file.")
+    parser.add_argument("--cpu-threshold", type=int, default=80, help="CPU usage percentage above which concurrency is reduced.")
+    parser.add_argument("--memory-threshold", type=int, default=80, help="Memory usage percentage above which concurrency is reduced.")
+    parser.add_argument("--no-share-image", action='store_true', help="Embed the watermark image separately on every page.")
+    parser.add_argument("--watermark-dpi", type=int, default=DEFAULT_WATERMARK_DPI, help="Resolution the watermark image is downsampled to; 0 keeps the source resolution. Default is 150.")
+    parser.add_argument("--cache-dir", help="Directory of the prepared-watermark cache.")
+    parser.add_argument("--cache-size", type=int, default=256, help="Size limit of the prepared-watermark cache in MB. Default is 256.")
+    parser.add_argument("--index", nargs="?", const=DEFAULT_INDEX_PATH, metavar="PATH", help="Reuse unchanged outputs of earlier runs with the same input and settings, recorded in this SQLite index (default location if no path is given).")
+    parser.add_argument("--index-size", type=int, default=DEFAULT_MAX_ENTRIES, help="Largest number of results the index keeps. Default is 10000.")
+    parser.add_argument("--force", action='store_true', help="Watermark even if the input is already watermarked or an indexed result exists.")
+    parser.add_argument("--strict", action='store_true', help="Retry pages that fail to be watermarked and fail the document if they still do, instead of reporting them as failed_pages.")
+    if not batch and not fanout:
+        parser.add_argument("--checkpoint-dir", metavar="DIR", help="Keep the finished page ranges of the process engine in this directory until the output is saved, so an interrupted run can be resumed.")
+        parser.add_argument("--resume", action='store_true', help="Continue an interrupted run from the page ranges finished in --checkpoint-dir.")
+        parser.add_argument("--dry-run", action='store_true', help="Print the preflight analysis of the input and the plan (engine, workers, chunk size, save profile) as JSON without watermarking.")
+    if not batch:
+        parser.add_argument("--metrics", metavar="PATH", help="Write the stage latency histograms and peak memory of the run to this file: Prometheus text for a .prom file, JSON otherwise.")
+    parser.add_argument("--profile", action='store_true', help="Enable profiling.")
+    parser.add_argument("--profile_output", type=str, default="profile_output.prof", help="Path to save profiling data.")
+    parser.add_argument("--sample-profile", metavar="PATH", help="Sample the stacks of this process while it runs and write them to this file in the collapsed format of flame graph tools. Much cheaper than --profile; process-engine workers are not sampled.")
+    parser.add_argument("--sample-interval", type=float, default=DEFAULT_SAMPLE_INTERVAL * 1000, help="Milliseconds between stack samples of --sample-profile. Default is 5.")
+    return parser
+
+def main(argv=None):
+    """
+    Main function to execute the watermarking script.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    # Batch and fan-out modes take different positionals, so they are detected before the full parse
+    mode_parser = argparse.ArgumentParser(add_help=False)
+    mode_parser.add_argument("--batch")
+    mode_parser.add_argument("--fanout")
+    mode = mode_parser.parse_known_args(argv)[0]
+    batch = mode.batch is not None
+    fanout = mode.fanout is not None and not batch
+    parser = build_parser(batch, fanout)
+    if batch and mode.fanout is not None:
+        parser.error("--batch and --fanout cannot be combined")
+    args = parser.parse_args(argv)
+    if fanout:
+        try:
+            variants = collect_fanout_variants(args.fanout)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        if not variants:
+            parser.error(f"{args.fanout} lists no variants")
+        # Variants may bring their own watermark
+        if not args.watermark_image and not args.text and any('watermark' not in variant and 'text' not in variant for variant in variants):
+            parser.error("a watermark image or --text is required for variants that set neither")
+    elif not args.watermark_image and not args.text:
+        parser.error("a watermark image or --text is required")
+    if not batch and not fanout and args.resume and not args.checkpoint_dir:
+        parser.error("--resume requires --checkpoint-dir")
+    if not batch and not fanout and args.dry_run:
+        if args.input_pdf == "-":
+            parser.error("--dry-run needs an input file")
+        analysis = preflight(args.input_pdf)
+        plan = plan_watermarking(
+            analysis, args.engine, args.workers, args.chunk_size, args.save_profile, args.incremental, bool(args.checkpoint_dir)
+        )
+        print(json.dumps({'document': analysis, 'plan': plan}, indent=2))
+        return
+    vector_options = {
+        'text': args.text,
+        'rotation': args.rotation,
+        'font': args.font,
+        'font_size': args.font_size,
+        'color': args.text_color,
+    }
+
+    # Setup logging
+    setup_logging()
+    events = EventStream(args.events) if args.events else None
+    set_event_stream(events)
+
+    set_default_cache(WatermarkCache(args.cache_dir or DEFAULT_CACHE_DIR, max_disk_bytes=args.cache_size * 1024 * 1024))
+    index = ResultIndex(args.index, max_entries=args.index_size) if args.index else None
+
+    if args.profile:
+        import cProfile
+        pr = cProfile.Profile()
+        pr.enable()
+    sampler = StackSampler(args.sample_interval / 1000) if args.sample_profile else contextlib.nullcontext()
+
+    with sampler:
+        if batch:
+            try:
+                jobs = collect_batch_jobs(args.batch, args.output_dir)
+            except (OSError, ValueError) as e:
+                parser.error(str(e))
+            records = watermark_batch(
+                jobs,
+                watermark_image_path=args.watermark_image,
+                opacity=args.opacity,
+                max_workers=args.workers or 4,
+                cpu_threshold=args.cpu_threshold,
+                memory_threshold=args.memory_threshold,
+                share_image=not args.no_share_image,
+                results_path=args.results,
+                watermark_dpi=args.watermark_dpi,
+                vector_options=vector_options,
+                save_profile=args.save_profile or "fast",
+                index=index,
+                force=args.force,
+                on_record=lambda record: print(json.dumps(record), flush=True),
+                strict=args.strict
+            )
+        elif fanout:
+            metrics = StageMetrics()
+            timing_data = watermark_fanout(
+                sys.stdin.buffer if args.input_pdf == "-" else args.input_pdf,
+                variants,
+                watermark_image_path=args.watermark_image,
+                opacity=args.opacity,
+                watermark_dpi=args.watermark_dpi,
+                vector_options=vector_options,
+                save_profile=args.save_profile or "fast",
+                strict=args.strict,
+                metrics=metrics
+            )
+            print(json.dumps(timing_data))
+        else:
+            metrics = StageMetrics()
+            timing_data = watermark_pdf(
+                input_pdf_path=sys.stdin.buffer if args.input_pdf == "-" else args.input_pdf,
+                output_pdf_path=sys.stdout.buffer if args.output_pdf == "-" else args.output_pdf,
+                watermark_image_path=args.watermark_image,
+                opacity=args.opacity,
+                max_workers=args.workers,
+                cpu_threshold=args.cpu_threshold,
+                memory_threshold=args.memory_threshold,
+                share_image=not args.no_share_image,
+                engine=args.engine,
+                watermark_dpi=args.watermark_dpi,
+                vector_options=vector_options,
+                chunk_size=args.chunk_size,
+                incremental=args.incremental,
+                save_profile=args.save_profile,
+                index=index,
+                force=args.force,
+                strict=args.strict,
+                checkpoint_dir=args.checkpoint_dir,
+                resume=args.resume,
+                metrics=metrics
+            )
+            # Timing data goes to stdout as JSON, unless the PDF itself does;
+            # on stderr it has to come after the log records
+            flush_logging()
+            print(json.dumps(timing_data), file=sys.stderr if args.output_pdf == "-" else sys.stdout)
+        if not batch and args.metrics:
+            metrics.write(args.metrics)
+
+    if args.profile:
+        pr.disable()
+        pr.dump_stats(args.profile_output)
+        logging.info("Profiling data saved to %s", args.profile_output)
+    if args.sample_profile:
+        sampler.write(args.sample_profile)
+        logging.info("Stack samples saved to %s", args.sample_profile)
+
+    if events:
+        events.close()
+
+    if batch and any(record['status'] != 'ok' for record in records):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file